@@ -1,17 +1,24 @@
-from flask import Flask, render_template, request, jsonify, session, make_response
-from flask_cors import CORS
+from flask import Blueprint, Flask, g, render_template, request, jsonify, make_response, Response, stream_with_context
 from datetime import datetime, timedelta
 import json
-import sqlite3
 from collections import defaultdict
 import os
 import hashlib
+import math
+import re
 import secrets
+import queue
+import threading
+import time
 from functools import wraps
 
-app = Flask(__name__)
-app.secret_key = 'setora_secret_key'
-# CORS(app, supports_credentials=True, origins=['http://localhost:6000', 'http://127.0.0.1:6000'])
+from jobs import JobQueue, TooManyJobs, job_params
+from ratelimit import ConcurrencyLimiter, RateLimiter
+from storage import DuplicateError, MemoryStorage, SQLiteStorage, UnknownExerciseError, parse_exercise_id
+from usage import LatencyHistograms, latency_percentiles, volume_tier, volume_totals
+
+# Routes are registered on this blueprint; create_app() builds the Flask app around it
+api = Blueprint('api', __name__)
 
 # @app.after_request
 # def after_request(response):
@@ -23,130 +30,198 @@ app.secret_key = 'setora_secret_key'
 #         response.headers.add('Access-Control-Allow-Methods', 'GET, POST, PUT, DELETE, OPTIONS')
 #     return response
 
-# Database initialization
-def init_db():
-    conn = sqlite3.connect('setora.db')
-    c = conn.cursor()
-    
-    # Users table with authentication
-    c.execute('''CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        email TEXT NOT NULL UNIQUE,
-        password_hash TEXT NOT NULL,
-        name TEXT NOT NULL,
-        age INTEGER,
-        gender TEXT,
-        height REAL,
-        weight REAL,
-        goal TEXT,
-        unit_preference TEXT DEFAULT 'kg',
-        theme_preference TEXT DEFAULT 'light',
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP
-    )''')
-    
-    # Sessions table
-    c.execute('''CREATE TABLE IF NOT EXISTS sessions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        token TEXT NOT NULL UNIQUE,
-        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-        expires_at TEXT NOT NULL,
-        FOREIGN KEY (user_id) REFERENCES users(id)
-    )''')
-    
-    # Exercises library
-    c.execute('''CREATE TABLE IF NOT EXISTS exercises (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL UNIQUE,
-        category TEXT NOT NULL,
-        equipment TEXT
-    )''')
-    
-    # Workouts
-    c.execute('''CREATE TABLE IF NOT EXISTS workouts (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        date TEXT NOT NULL,
-        notes TEXT,
-        FOREIGN KEY (user_id) REFERENCES users(id)
-    )''')
-    
-    # Workout exercises
-    c.execute('''CREATE TABLE IF NOT EXISTS workout_exercises (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        workout_id INTEGER NOT NULL,
-        exercise_id INTEGER NOT NULL,
-        sets INTEGER,
-        reps INTEGER,
-        weight REAL,
-        duration REAL,
-        notes TEXT,
-        FOREIGN KEY (workout_id) REFERENCES workouts(id),
-        FOREIGN KEY (exercise_id) REFERENCES exercises(id)
-    )''')
-    
-    # Weight logs
-    c.execute('''CREATE TABLE IF NOT EXISTS weight_logs (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        date TEXT NOT NULL,
-        weight REAL NOT NULL,
-        FOREIGN KEY (user_id) REFERENCES users(id)
-    )''')
-    
-    # Templates
-    c.execute('''CREATE TABLE IF NOT EXISTS workout_templates (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        name TEXT NOT NULL,
-        exercises TEXT NOT NULL,
-        FOREIGN KEY (user_id) REFERENCES users(id)
-    )''')
-    
-    conn.commit()
-    conn.close()
-
-def seed_exercises():
-    conn = sqlite3.connect('setora.db')
-    c = conn.cursor()
-    
-    # Check if exercises exist
-    c.execute('SELECT COUNT(*) FROM exercises')
-    if c.fetchone()[0] == 0:
-        exercises = [
-            ('Bench Press', 'Chest', 'Barbell'),
-            ('Incline Dumbbell Press', 'Chest', 'Dumbbell'),
-            ('Push-ups', 'Chest', 'Bodyweight'),
-            ('Barbell Curl', 'Biceps', 'Barbell'),
-            ('Dumbbell Curl', 'Biceps', 'Dumbbell'),
-            ('Hammer Curl', 'Biceps', 'Dumbbell'),
-            ('Tricep Dips', 'Triceps', 'Bodyweight'),
-            ('Tricep Pushdown', 'Triceps', 'Cable'),
-            ('Overhead Extension', 'Triceps', 'Dumbbell'),
-            ('Squat', 'Legs', 'Barbell'),
-            ('Leg Press', 'Legs', 'Machine'),
-            ('Lunges', 'Legs', 'Dumbbell'),
-            ('Deadlift', 'Back', 'Barbell'),
-            ('Pull-ups', 'Back', 'Bodyweight'),
-            ('Lat Pulldown', 'Back', 'Cable'),
-            ('Shoulder Press', 'Shoulders', 'Dumbbell'),
-            ('Lateral Raise', 'Shoulders', 'Dumbbell'),
-            ('Front Raise', 'Shoulders', 'Dumbbell'),
-            ('Running', 'Cardio', 'None'),
-            ('Cycling', 'Cardio', 'Machine'),
-            ('Jump Rope', 'Cardio', 'Equipment'),
-            ('Plank', 'Core', 'Bodyweight'),
-            ('Crunches', 'Core', 'Bodyweight'),
-            ('Russian Twist', 'Core', 'Bodyweight')
-        ]
-        c.executemany('INSERT INTO exercises (name, category, equipment) VALUES (?, ?, ?)', exercises)
-        conn.commit()
-    
-    conn.close()
-
-# Initialize database on startup
-init_db()
-seed_exercises()
+# Storage configuration
+DB_PATH = 'setora.db'
+SHARD_COUNT = int(os.environ.get('SETORA_SHARDS', '0'))  # 0 keeps per-user tables in DB_PATH
+SHARD_DIR = os.environ.get('SETORA_SHARD_DIR', 'shards')
+STORAGE_ENGINE = os.environ.get('SETORA_STORAGE', 'sqlite')  # 'memory' for tests and benchmarks
+JOB_RESULT_DIR = os.environ.get('SETORA_JOB_RESULT_DIR', 'job_results')  # large job results, see JOB_RESULT_INLINE_BYTES
+
+# Constructing an engine does no I/O: the schema is checked on the first request
+if STORAGE_ENGINE == 'memory':
+    store = MemoryStorage()
+else:
+    store = SQLiteStorage(DB_PATH, SHARD_COUNT, SHARD_DIR, JOB_RESULT_DIR)
+
+_storage_lock = threading.Lock()
+_storage_ready = False
+
+def ensure_storage():
+    """Create or verify the schema once per process, before the first request needs it"""
+    global _storage_ready
+    if _storage_ready:
+        return
+    with _storage_lock:
+        if not _storage_ready:
+            store.ensure_schema()
+            _storage_ready = True
+
+LAST_PERFORMANCE_MAX_IDS = 100  # exercises per /api/exercises/last request
+WORKOUT_BATCH_MAX_DAYS = 62     # days per /api/workouts/batch request
+
+# Rate limiting and admission control
+RATE_LIMITS = {
+    # policy: {key: (requests, per seconds)}, refilled continuously
+    'login': {'ip': (20, 60), 'email': (5, 60)},
+    'signup': {'ip': (10, 600)},
+    'write': {'user': (120, 60)},
+}
+RATE_LIMIT_MAX_KEYS = 10000     # keys tracked per bucket before the least recently used is evicted
+MAX_IN_FLIGHT_REQUESTS = 64     # requests beyond this are shed with 503
+MAX_CONCURRENT_WRITES = 4       # SQLite runs writers one at a time; more only queue on its lock
+WRITE_ADMISSION_WAIT = 0.5      # seconds a write may wait for a slot before it is shed
+
+rate_limiter = RateLimiter(RATE_LIMITS, RATE_LIMIT_MAX_KEYS)
+request_limiter = ConcurrencyLimiter(MAX_IN_FLIGHT_REQUESTS)
+write_limiter = ConcurrencyLimiter(MAX_CONCURRENT_WRITES, WRITE_ADMISSION_WAIT)
+
+ADMIN_TOKEN = os.environ.get('SETORA_ADMIN_TOKEN')  # sent as X-Admin-Token; unset disables admin routes
+
+# Data volume guardrails
+VOLUME_SOFT_LIMITS = {
+    # tier: {counter: rows or bytes}; the first tier with any counter over its limit applies
+    'summarize': {'sets': 200000, 'payload_bytes': 20_000_000},
+    'paginate': {'workouts': 1000, 'payload_bytes': 2_000_000},
+}
+WORKOUTS_PAGE_SIZE = 100        # workouts per /api/workouts response for accounts over a soft limit
+VOLUME_REPORT_SORTS = ('payload_bytes', 'workouts', 'workout_exercises', 'sets', 'weight_logs', 'templates',
+                       'custom_exercises', 'sessions', 'requests', 'p50_ms', 'p95_ms', 'p99_ms')
+LATENCY_FLUSH_SECONDS = 60      # how often each process adds its latency histograms to storage
+
+latency = LatencyHistograms(LATENCY_FLUSH_SECONDS)
+
+# Background jobs
+JOB_WORKERS = int(os.environ.get('SETORA_JOB_WORKERS', '0')) or os.cpu_count() or 1  # 0 uses every core
+JOB_RESULT_TTL = 3600           # seconds a finished job and its result are kept
+JOB_STALE_SECONDS = 600         # pending jobs no process refreshed for this long are failed
+MAX_ACTIVE_JOBS = 2             # queued or running jobs per user
+
+# Memory storage lives in this process, so its jobs run on threads
+job_queue = JobQueue(store, JOB_WORKERS, JOB_RESULT_TTL, JOB_STALE_SECONDS, MAX_ACTIVE_JOBS,
+                     processes=STORAGE_ENGINE != 'memory')
+
+# Live event push
+STREAM_HEARTBEAT_SECONDS = 15   # idle interval before a keep-alive comment is sent
+STREAM_QUEUE_SIZE = 100         # buffered events per connection before it must resync
+STREAM_POLL_SECONDS = 1         # change log poll interval; writes in this process wake it early
+
+class EventHub:
+    """
+    Fan out per-user change log entries to every open /api/stream
+    connection in this process. While streams are open, a single thread
+    reads the newest entry per user from each database file, then loads
+    entries only for subscribed users that have new ones, so writes made
+    by any process reach them and idle streams cost nothing per user.
+    """
+    
+    def __init__(self, store, poll_interval=STREAM_POLL_SECONDS, queue_size=STREAM_QUEUE_SIZE):
+        self.store = store
+        self.poll_interval = poll_interval
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+        self._seen = {}       # user_id -> last seq published
+        self._positions = {}  # database -> last seq read by poll, see Storage.change_heads
+        self._wake = threading.Event()
+        self._poller = None
+    
+    def subscribe(self, user_id):
+        q = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            # Started on first use so importing the app spawns nothing
+            if self._poller is None:
+                # Positions first: a user's cursor read after them leaves no gap
+                self._positions = self.store.change_heads({})[0]
+                self._poller = threading.Thread(target=self._poll_forever, name='setora-event-poller', daemon=True)
+                self._poller.start()
+        cursor = max(self.store.sync_cursor(user_id))
+        with self._lock:
+            self._subscribers[user_id].add(q)
+            self._seen.setdefault(user_id, cursor)
+        return q
+    
+    def unsubscribe(self, user_id, q):
+        with self._lock:
+            subscribers = self._subscribers.get(user_id)
+            if subscribers is not None:
+                subscribers.discard(q)
+                if not subscribers:
+                    del self._subscribers[user_id]
+                    self._seen.pop(user_id, None)
+    
+    def notify(self, user_id):
+        """A write for ``user_id`` committed in this process: poll now rather than at the next interval"""
+        with self._lock:
+            if user_id in self._subscribers:
+                self._wake.set()
+    
+    def publish(self, user_id, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for q in subscribers:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                # Slow consumer: drop its backlog and tell it to catch up via /api/sync
+                while True:
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        break
+                try:
+                    q.put_nowait({'event': 'resync'})
+                except queue.Full:
+                    pass
+    
+    def poll(self):
+        """Publish change log entries committed since the last poll for every user with a stream"""
+        with self._lock:
+            if not self._seen:
+                return
+        self._positions, heads = self.store.change_heads(self._positions)
+        # Read after the heads, so a stream opened meanwhile has a cursor at least as new
+        with self._lock:
+            seen = dict(self._seen)
+        for user_id, latest in heads.items():
+            since = seen.get(user_id)
+            if since is None or latest <= since:
+                continue
+            compacted_seq, cursor = self.store.sync_cursor(user_id)
+            changes = self.store.change_events(user_id, since, cursor)
+            if compacted_seq > since or len(changes) > self.queue_size:
+                # Entries were trimmed before we saw them, or more than a queue holds
+                self.publish(user_id, {'event': 'resync'})
+            else:
+                for seq, entity, entity_id, op in changes:
+                    self.publish(user_id, {'event': entity, 'seq': seq, 'id': entity_id, 'op': op})
+            with self._lock:
+                if user_id in self._seen:
+                    self._seen[user_id] = max(self._seen[user_id], cursor)
+    
+    def _poll_forever(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                self.poll()
+            except Exception:
+                # Storage busy or briefly unavailable; the next poll catches up
+                pass
+    
+    def connection_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+event_hub = EventHub(store)
+
+def format_sse(event):
+    """Serialize an event dict into a Server-Sent Events frame"""
+    lines = []
+    if event.get('seq') is not None:
+        lines.append(f"id: {event['seq']}")
+    lines.append(f"event: {event['event']}")
+    lines.append(f"data: {json.dumps(event, separators=(',', ':'))}")
+    return '\n'.join(lines) + '\n\n'
 
 # Authentication helpers
 def hash_password(password):
@@ -158,45 +233,16 @@ def generate_token():
 def create_session(user_id):
     token = generate_token()
     expires_at = (datetime.now() + timedelta(days=30)).isoformat()
-    
-    conn = sqlite3.connect('setora.db')
-    c = conn.cursor()
-    c.execute('INSERT INTO sessions (user_id, token, expires_at) VALUES (?, ?, ?)',
-             (user_id, token, expires_at))
-    conn.commit()
-    conn.close()
-    
+    store.create_session(user_id, token, expires_at)
     return token
 
 def get_user_from_token(token):
     if not token:
         return None
-    
-    conn = sqlite3.connect('setora.db')
-    c = conn.cursor()
-    c.execute('''SELECT u.* FROM users u
-                 JOIN sessions s ON u.id = s.user_id
-                 WHERE s.token = ? AND s.expires_at > ?''',
-             (token, datetime.now().isoformat()))
-    user = c.fetchone()
-    conn.close()
-    
-    if user:
-        return {
-            'id': user[0], 'email': user[1], 'name': user[3], 'age': user[4],
-            'gender': user[5], 'height': user[6], 'weight': user[7],
-            'goal': user[8], 'unit_preference': user[9], 'theme_preference': user[10]
-        }
-    return None
+    return store.get_user_by_token(token, datetime.now().isoformat())
 
 def check_valid_token(token):
-    conn = sqlite3.connect('setora.db')
-    c = conn.cursor()
-    c.execute('SELECT * FROM sessions WHERE token = ? AND expires_at > ?',
-             (token, datetime.now().isoformat()))
-    session = c.fetchone()
-    conn.close()
-    return session is not None
+    return store.is_session_valid(token, datetime.now().isoformat())
 
 def get_token_from_request():
     # Try Authorization header first
@@ -227,12 +273,115 @@ def require_auth(f):
         return f(*args, **kwargs)
     return decorated_function
 
-@app.route('/')
+def require_admin(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        supplied = request.headers.get('X-Admin-Token', '')
+        if not ADMIN_TOKEN or not secrets.compare_digest(supplied, ADMIN_TOKEN):
+            return jsonify({'error': 'Not found'}), 404
+        return f(*args, **kwargs)
+    return decorated_function
+
+def too_busy(status, retry_after):
+    """429 when a client exceeds its rate, 503 when the server sheds load"""
+    message = 'Too many requests, try again later' if status == 429 else 'Server busy, try again shortly'
+    response = jsonify({'error': message})
+    response.status_code = status
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+def rate_limit(policy):
+    """Throttle a route with a RATE_LIMITS policy, keyed by client IP, request email and user"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method == 'OPTIONS':
+                return f(*args, **kwargs)
+
+            data = request.get_json(silent=True)
+            email = data.get('email') if isinstance(data, dict) else None
+            user = getattr(request, 'user', None)
+            wait = rate_limiter.check(policy, {
+                'ip': request.remote_addr,
+                'email': email.strip().lower() if isinstance(email, str) else None,
+                'user': user['id'] if user else None,
+            })
+            if wait:
+                return too_busy(429, wait)
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+def admit_write(f):
+    """Bound concurrent writes so a burst of them cannot take every worker from reads"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if request.method == 'OPTIONS':
+            return f(*args, **kwargs)
+        if not write_limiter.acquire():
+            return too_busy(503, 1)
+        try:
+            return f(*args, **kwargs)
+        finally:
+            write_limiter.release()
+    return decorated_function
+
+def admit_request():
+    """Shed requests beyond MAX_IN_FLIGHT_REQUESTS before they reach storage"""
+    if request.endpoint == 'api.stream':
+        # Streams stay open for minutes and would pin a slot each
+        return None
+    if not request_limiter.acquire():
+        return too_busy(503, 1)
+    g.admitted = True
+
+def release_request(exc):
+    if g.pop('admitted', False):
+        request_limiter.release()
+
+def start_request_timer():
+    g.started = time.perf_counter()
+
+def record_request_latency(exc):
+    """Attribute the request's duration to its user, and periodically persist the histograms"""
+    started = g.pop('started', None)
+    user = getattr(request, 'user', None)
+    if started is None or user is None or request.endpoint == 'api.stream':
+        return
+    latency.record(user['id'], time.perf_counter() - started)
+    flush_latency(latency.take_due())
+
+def flush_latency(histograms):
+    if not histograms:
+        return
+    try:
+        store.add_latency_samples(histograms)
+    except Exception:
+        # Kept for the next flush rather than lost
+        latency.merge(histograms)
+
+def volume_report(limit=None, sort='payload_bytes'):
+    """Per-user row counts, payload estimate, latency percentiles and soft-limit tier, heaviest first"""
+    flush_latency(latency.take())
+    histograms = store.latency_histograms()
+    report = []
+    for user_id, volume in store.list_user_volumes().items():
+        totals = volume_totals(volume)
+        row = {'user_id': user_id, 'tier': volume_tier(totals, VOLUME_SOFT_LIMITS)}
+        row.update(totals)
+        row.update(latency_percentiles(histograms.get(user_id, {})))
+        report.append(row)
+    report.sort(key=lambda row: row.get(sort) or 0, reverse=True)
+    return report[:limit] if limit else report
+
+@api.route('/')
 def index():
     return render_template('index.html')
 
 # Authentication routes
-@app.route('/api/auth/signup', methods=['POST', 'OPTIONS'])
+@api.route('/api/auth/signup', methods=['POST', 'OPTIONS'])
+@rate_limit('signup')
+@admit_write
 def signup():
     if request.method == 'OPTIONS':
         return jsonify({'ok': True}), 200
@@ -248,31 +397,23 @@ def signup():
         
         password_hash = hash_password(password)
         
-        conn = sqlite3.connect('setora.db')
-        c = conn.cursor()
-        
         try:
-            c.execute('''INSERT INTO users (email, password_hash, name, theme_preference)
-                         VALUES (?, ?, ?, ?)''',
-                      (email, password_hash, name, 'light'))
-            user_id = c.lastrowid
-            conn.commit()
-            conn.close()
-            
-            token = create_session(user_id)
-            
-            response = make_response(jsonify({'success': True, 'user': {'id': user_id, 'name': name, 'email': email}}))
-            response.set_cookie('session_token', token, max_age=30*24*60*60, httponly=True, samesite='Lax', secure=False)
-            return response
-            
-        except sqlite3.IntegrityError:
-            conn.close()
-            return jsonify({'success': False, 'error': 'Email already exists'}), 400
+            user_id = store.create_user(email, password_hash, name)
+        except DuplicateError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
+        token = create_session(user_id)
+        
+        response = make_response(jsonify({'success': True, 'user': {'id': user_id, 'name': name, 'email': email}}))
+        response.set_cookie('session_token', token, max_age=30*24*60*60, httponly=True, samesite='Lax', secure=False)
+        return response
     except Exception as e:
         print(f"Signup error: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
-@app.route('/api/auth/login', methods=['POST', 'OPTIONS'])
+@api.route('/api/auth/login', methods=['POST', 'OPTIONS'])
+@rate_limit('login')
+@admit_write
 def login():
     if request.method == 'OPTIONS':
         return jsonify({'ok': True}), 200
@@ -288,24 +429,18 @@ def login():
             return jsonify({'success': False, 'error': 'Missing credentials'}), 400
         
         password_hash = hash_password(password)
-        
-        conn = sqlite3.connect('setora.db')
-        c = conn.cursor()
-        c.execute('SELECT * FROM users WHERE email = ? AND password_hash = ?',
-                 (email, password_hash))
-        user = c.fetchone()
-        conn.close()
+        user = store.find_user_by_credentials(email, password_hash)
         
         if user:
-            print(f"Login successful for user: {user[0]}")  # Debug log
-            token = create_session(user[0])
+            print(f"Login successful for user: {user['id']}")  # Debug log
+            token = create_session(user['id'])
             response = make_response(jsonify({
                 'success': True,
                 'user': {
-                    'id': user[0],
-                    'email': user[1],
-                    'name': user[3],
-                    'theme_preference': user[10]
+                    'id': user['id'],
+                    'email': user['email'],
+                    'name': user['name'],
+                    'theme_preference': user['theme_preference']
                 }
             }))
             response.set_cookie('session_token', token, max_age=30*24*60*60, httponly=True, samesite='Lax', secure=False)
@@ -317,7 +452,7 @@ def login():
         print(f"Login error: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
-@app.route('/api/auth/logout', methods=['POST', 'OPTIONS'])
+@api.route('/api/auth/logout', methods=['POST', 'OPTIONS'])
 def logout():
     if request.method == 'OPTIONS':
         return jsonify({'ok': True}), 200
@@ -325,15 +460,11 @@ def logout():
     token = get_token_from_request()
     
     if token:
-        conn = sqlite3.connect('setora.db')
-        c = conn.cursor()
-        c.execute('DELETE FROM sessions WHERE token = ?', (token,))
-        conn.commit()
-        conn.close()
+        store.delete_session(token)
     
     return jsonify({'success': True})
 
-@app.route('/api/auth/check', methods=['GET'])
+@api.route('/api/auth/check', methods=['GET'])
 def check_auth():
     token = get_token_from_request()
     user = get_user_from_token(token)
@@ -343,31 +474,26 @@ def check_auth():
     return jsonify({'authenticated': False}), 401
 
 # User routes
-@app.route('/api/user', methods=['GET'])
+@api.route('/api/user', methods=['GET'])
 @require_auth
 def get_user():
     return jsonify(request.user)
 
-@app.route('/api/user', methods=['PUT'])
+@api.route('/api/user', methods=['PUT'])
 @require_auth
+@rate_limit('write')
+@admit_write
 def update_user():
     data = request.json
     user_id = request.user['id']
-    
-    conn = sqlite3.connect('setora.db')
-    c = conn.cursor()
-    c.execute('''UPDATE users SET name=?, age=?, gender=?, height=?, weight=?, goal=?, unit_preference=?, theme_preference=?
-                 WHERE id=?''',
-              (data.get('name'), data.get('age'), data.get('gender'), data.get('height'),
-               data.get('weight'), data.get('goal'), data.get('unit_preference'), 
-               data.get('theme_preference'), user_id))
-    conn.commit()
-    conn.close()
+    store.update_user(user_id, data)
     return jsonify({'success': True})
 
 # custom exercise routes
-@app.route('/api/exercises/custom', methods=['POST'])
+@api.route('/api/exercises/custom', methods=['POST'])
 @require_auth
+@rate_limit('write')
+@admit_write
 def add_custom_exercise():
     """Create a custom exercise for the current user"""
     data = request.json
@@ -377,260 +503,152 @@ def add_custom_exercise():
     if not data.get('name') or not data.get('category'):
         return jsonify({'success': False, 'error': 'Name and category are required'}), 400
     
-    conn = sqlite3.connect('setora.db')
-    c = conn.cursor()
-    
     try:
-        c.execute('''INSERT INTO user_exercises (user_id, name, category, equipment, image_url)
-                     VALUES (?, ?, ?, ?, ?)''',
-                  (user_id, data['name'], data['category'], 
-                   data.get('equipment', ''), data.get('image_url', '')))
-        exercise_id = c.lastrowid
-        conn.commit()
-        conn.close()
-        
-        return jsonify({
-            'success': True, 
-            'exercise': {
-                'id': exercise_id,
-                'name': data['name'],
-                'category': data['category'],
-                'equipment': data.get('equipment', ''),
-                'image_url': data.get('image_url', ''),
-                'is_custom': True
-            }
-        })
-    except sqlite3.IntegrityError:
-        conn.close()
-        return jsonify({'success': False, 'error': 'You already have an exercise with this name'}), 400
-
-@app.route('/api/exercises/custom/<int:exercise_id>', methods=['DELETE'])
+        exercise_id, _ = store.add_custom_exercise(user_id, data['name'], data['category'],
+                                                   data.get('equipment', ''), data.get('image_url', ''))
+    except DuplicateError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    return jsonify({
+        'success': True, 
+        'exercise': {
+            'id': exercise_id,
+            'name': data['name'],
+            'category': data['category'],
+            'equipment': data.get('equipment', ''),
+            'image_url': data.get('image_url', ''),
+            'is_custom': True
+        }
+    })
+
+@api.route('/api/exercises/custom/<int:exercise_id>', methods=['DELETE'])
 @require_auth
+@rate_limit('write')
+@admit_write
 def delete_custom_exercise(exercise_id):
     """Delete a custom exercise"""
     user_id = request.user['id']
     
-    conn = sqlite3.connect('setora.db')
-    c = conn.cursor()
-    
-    # Verify ownership
-    c.execute('SELECT id FROM user_exercises WHERE id = ? AND user_id = ?', 
-              (exercise_id, user_id))
-    
-    if not c.fetchone():
-        conn.close()
+    if store.delete_custom_exercise(user_id, exercise_id) is None:
         return jsonify({'success': False, 'error': 'Exercise not found'}), 404
     
-    c.execute('DELETE FROM user_exercises WHERE id = ?', (exercise_id,))
-    conn.commit()
-    conn.close()
-    
     return jsonify({'success': True})
 
-@app.route('/api/exercises/all', methods=['GET'])
+@api.route('/api/exercises/all', methods=['GET'])
 @require_auth
 def get_all_exercises():
     """Get built-in exercises + user's custom exercises"""
     user_id = request.user['id']
     
-    conn = sqlite3.connect('setora.db')
-    c = conn.cursor()
-    
-    # Built-in exercises
-    c.execute('SELECT id, name, category, equipment FROM exercises ORDER BY category, name')
-    builtin = [{'id': row[0], 'name': row[1], 'category': row[2], 
-                'equipment': row[3], 'is_custom': False} 
-               for row in c.fetchall()]
-    
-    # User's custom exercises
-    c.execute('''SELECT id, name, category, equipment, image_url 
-                 FROM user_exercises 
-                 WHERE user_id = ? 
-                 ORDER BY category, name''', (user_id,))
-    custom = [{'id': f'custom_{row[0]}', 'name': row[1], 'category': row[2], 
-               'equipment': row[3], 'image_url': row[4], 'is_custom': True} 
-              for row in c.fetchall()]
-    
-    conn.close()
+    builtin = [dict(ex, is_custom=False) for ex in store.list_exercises()]
+    custom = store.list_custom_exercises(user_id)
     
     return jsonify(builtin + custom)
 
+@api.route('/api/exercises/last', methods=['GET'])
+@require_auth
+def get_last_performance():
+    """Sets from the most recent session of each exercise in ?ids=1,4,custom_7"""
+    user_id = request.user['id']
+    ids = [exercise_id for exercise_id in request.args.get('ids', '').split(',') if exercise_id]
+    if not ids:
+        return jsonify({'error': 'ids is required'}), 400
+    if len(ids) > LAST_PERFORMANCE_MAX_IDS:
+        return jsonify({'error': f'At most {LAST_PERFORMANCE_MAX_IDS} ids per request'}), 400
+
+    keys = {}
+    for exercise_id in ids:
+        if not re.fullmatch(r'(custom_)?[0-9]+', exercise_id):
+            return jsonify({'error': f'Invalid exercise id: {exercise_id}'}), 400
+        keys[exercise_id] = parse_exercise_id(exercise_id if exercise_id.startswith('custom_') else int(exercise_id))
+
+    last = store.last_performance(user_id, list(keys.values()))
+    return jsonify({exercise_id: last[key] for exercise_id, key in keys.items()})
+
 # Exercise routes
-@app.route('/api/exercises', methods=['GET'])
+@api.route('/api/exercises', methods=['GET'])
 @require_auth
 def get_exercises():
-    conn = sqlite3.connect('setora.db')
-    c = conn.cursor()
-    c.execute('SELECT * FROM exercises ORDER BY category, name')
-    exercises = [{'id': row[0], 'name': row[1], 'category': row[2], 'equipment': row[3]}
-                 for row in c.fetchall()]
-    conn.close()
-    return jsonify(exercises)
-
-@app.route('/api/exercises', methods=['POST'])
+    return jsonify(store.list_exercises())
+
+@api.route('/api/exercises', methods=['POST'])
 @require_auth
+@rate_limit('write')
+@admit_write
 def add_exercise():
     data = request.json
-    conn = sqlite3.connect('setora.db')
-    c = conn.cursor()
     try:
-        c.execute('INSERT INTO exercises (name, category, equipment) VALUES (?, ?, ?)',
-                 (data['name'], data['category'], data['equipment']))
-        conn.commit()
-        exercise_id = c.lastrowid
-        conn.close()
+        exercise_id = store.add_exercise(data['name'], data['category'], data['equipment'])
         return jsonify({'success': True, 'id': exercise_id})
-    except sqlite3.IntegrityError:
-        conn.close()
-        return jsonify({'success': False, 'error': 'Exercise already exists'}), 400
+    except DuplicateError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
 
 # Workout routes
-@app.route('/api/workouts', methods=['POST'])
+@api.route('/api/workouts', methods=['POST'])
 @require_auth
+@rate_limit('write')
+@admit_write
 def add_workout():
     """Add workout with merge support and rest day handling"""
     data = request.json
     user_id = request.user['id']
     workout_date = data['date']
+    is_rest_day = bool(data.get('is_rest_day'))
     
-    conn = sqlite3.connect('setora.db')
-    c = conn.cursor()
+    workout_id, merged, _ = store.save_workout(user_id, workout_date, data.get('notes', ''),
+                                                 data.get('exercises', []), is_rest_day)
     
-    # Check if workout already exists for this date
-    c.execute('SELECT id FROM workouts WHERE user_id = ? AND date = ?', 
-              (user_id, workout_date))
-    existing = c.fetchone()
-    
-    if data.get('is_rest_day'):
-        # Handle rest day
-        if existing:
-            # Update existing workout to rest day
-            c.execute('UPDATE workouts SET is_rest_day = 1, notes = ? WHERE id = ?',
-                     (data.get('notes', ''), existing[0]))
-            workout_id = existing[0]
-        else:
-            # Create new rest day workout
-            c.execute('INSERT INTO workouts (user_id, date, notes, is_rest_day) VALUES (?, ?, ?, 1)',
-                     (user_id, workout_date, data.get('notes', '')))
-            workout_id = c.lastrowid
-        
-        conn.commit()
-        conn.close()
-        return jsonify({'success': True, 'workout_id': workout_id, 'merged': bool(existing)})
-    
-    # Regular workout
-    if existing:
-        # MERGE MODE: Add exercises to existing workout
-        workout_id = existing[0]
-        c.execute('UPDATE workouts SET merged_at = ?, is_rest_day = 0 WHERE id = ?',
-                 (datetime.now().isoformat(), workout_id))
-    else:
-        # CREATE MODE: New workout
-        c.execute('INSERT INTO workouts (user_id, date, notes, is_rest_day) VALUES (?, ?, ?, 0)',
-                 (user_id, workout_date, data.get('notes', '')))
-        workout_id = c.lastrowid
-    
-    # Get current max order index for this workout
-    c.execute('SELECT COALESCE(MAX(order_index), 0) FROM workout_exercises WHERE workout_id = ?', 
-              (workout_id,))
-    current_max_order = c.fetchone()[0]
-    
-    # Add exercises
-    for idx, ex in enumerate(data['exercises']):
-        # Determine if custom exercise
-        exercise_id = ex['exercise_id']
-        is_custom = 0
-        
-        if isinstance(exercise_id, str) and exercise_id.startswith('custom_'):
-            is_custom = 1
-            exercise_id = int(exercise_id.replace('custom_', ''))
-        
-        # Insert workout exercise
-        c.execute('''INSERT INTO workout_exercises 
-                   (workout_id, exercise_id, notes, is_custom, order_index)
-                   VALUES (?, ?, ?, ?, ?)''',
-                 (workout_id, exercise_id, ex.get('notes', ''), 
-                  is_custom, current_max_order + idx + 1))
-        
-        workout_exercise_id = c.lastrowid
-        
-        # Add sets
-        for set_data in ex.get('sets', []):
-            c.execute('''INSERT INTO workout_sets 
-                       (workout_exercise_id, set_number, reps, weight, duration, notes)
-                       VALUES (?, ?, ?, ?, ?, ?)''',
-                     (workout_exercise_id, set_data['set_number'],
-                      set_data.get('reps'), set_data.get('weight'),
-                      set_data.get('duration'), set_data.get('notes', '')))
-    
-    conn.commit()
-    conn.close()
-    
-    return jsonify({'success': True, 'workout_id': workout_id, 'merged': bool(existing)})
+    event_hub.notify(user_id)
+    return jsonify({'success': True, 'workout_id': workout_id, 'merged': merged})
 
-@app.route('/api/workouts/<date>', methods=['GET'])
+@api.route('/api/workouts/batch', methods=['GET'])
+@require_auth
+def get_workouts_batch():
+    """
+    Workouts for many days in one call, keyed by date, each shaped like
+    GET /api/workouts/<date>. Pass ?dates=2024-01-01,2024-01-03 or a
+    ?start_date=&end_date= range.
+    """
+    user_id = request.user['id']
+    try:
+        if request.args.get('dates'):
+            dates = [datetime.strptime(d, '%Y-%m-%d').strftime('%Y-%m-%d')
+                     for d in request.args['dates'].split(',') if d]
+        else:
+            start = datetime.strptime(request.args['start_date'], '%Y-%m-%d')
+            days = (datetime.strptime(request.args['end_date'], '%Y-%m-%d') - start).days + 1
+            # One day past the cap is enough to reject oversized ranges below
+            dates = [(start + timedelta(days=n)).strftime('%Y-%m-%d')
+                     for n in range(min(days, WORKOUT_BATCH_MAX_DAYS + 1))]
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Pass dates=YYYY-MM-DD,... or start_date and end_date'}), 400
+    if not dates or len(dates) > WORKOUT_BATCH_MAX_DAYS:
+        return jsonify({'error': f'Between 1 and {WORKOUT_BATCH_MAX_DAYS} days per request'}), 400
+
+    workouts = store.get_workouts_by_dates(user_id, dates)
+    result = {}
+    for date in dates:
+        workout = workouts.get(date)
+        result[date] = dict(workout, exists=True) if workout else {'exists': False}
+    return jsonify(result)
+
+@api.route('/api/workouts/<date>', methods=['GET'])
 @require_auth
 def get_workout_by_date(date):
     """Get workout for a specific date"""
     user_id = request.user['id']
     
-    conn = sqlite3.connect('setora.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    
-    c.execute('SELECT * FROM workouts WHERE user_id = ? AND date = ?', 
-              (user_id, date))
-    workout = c.fetchone()
-    
+    workout = store.get_workout_by_date(user_id, date)
     if not workout:
-        conn.close()
         return jsonify({'exists': False})
     
-    workout_dict = dict(workout)
-    
-    # Get exercises and sets
-    c.execute('''SELECT we.*, e.name, e.category, e.equipment
-                 FROM workout_exercises we
-                 JOIN exercises e ON we.exercise_id = e.id
-                 WHERE we.workout_id = ? AND we.is_custom = 0
-                 ORDER BY we.order_index''', (workout_dict['id'],))
-    
-    exercises = []
-    for ex_row in c.fetchall():
-        ex = dict(ex_row)
-        
-        # Get sets for this exercise
-        c.execute('''SELECT * FROM workout_sets 
-                    WHERE workout_exercise_id = ? 
-                    ORDER BY set_number''', (ex['id'],))
-        ex['sets'] = [dict(s) for s in c.fetchall()]
-        exercises.append(ex)
-    
-    # Get custom exercises
-    c.execute('''SELECT we.*, ue.name, ue.category, ue.equipment, ue.image_url
-                 FROM workout_exercises we
-                 JOIN user_exercises ue ON we.exercise_id = ue.id
-                 WHERE we.workout_id = ? AND we.is_custom = 1
-                 ORDER BY we.order_index''', (workout_dict['id'],))
-    
-    for ex_row in c.fetchall():
-        ex = dict(ex_row)
-        ex['is_custom'] = True
-        
-        c.execute('''SELECT * FROM workout_sets 
-                    WHERE workout_exercise_id = ? 
-                    ORDER BY set_number''', (ex['id'],))
-        ex['sets'] = [dict(s) for s in c.fetchall()]
-        exercises.append(ex)
-    
-    workout_dict['exercises'] = exercises
-    workout_dict['exists'] = True
-    
-    conn.close()
-    return jsonify(workout_dict)
+    workout['exists'] = True
+    return jsonify(workout)
 
-@app.route('/api/workouts/rest', methods=['POST'])
+@api.route('/api/workouts/rest', methods=['POST'])
 @require_auth
+@rate_limit('write')
+@admit_write
 def toggle_rest_day():
     """Mark or unmark a day as rest day"""
     data = request.json
@@ -638,220 +656,260 @@ def toggle_rest_day():
     workout_date = data['date']
     is_rest = data.get('is_rest_day', True)
     
-    conn = sqlite3.connect('setora.db')
-    c = conn.cursor()
-    
-    c.execute('SELECT id FROM workouts WHERE user_id = ? AND date = ?', 
-              (user_id, workout_date))
-    existing = c.fetchone()
-    
-    if existing:
-        c.execute('UPDATE workouts SET is_rest_day = ? WHERE id = ?',
-                 (1 if is_rest else 0, existing[0]))
-        workout_id = existing[0]
-    else:
-        c.execute('INSERT INTO workouts (user_id, date, is_rest_day) VALUES (?, ?, ?)',
-                 (user_id, workout_date, 1 if is_rest else 0))
-        workout_id = c.lastrowid
-    
-    conn.commit()
-    conn.close()
+    workout_id, _ = store.set_rest_day(user_id, workout_date, is_rest)
     
+    event_hub.notify(user_id)
     return jsonify({'success': True, 'workout_id': workout_id})
 
-@app.route('/api/workouts', methods=['GET'])
+@api.route('/api/workouts', methods=['GET'])
 @require_auth
 def get_workouts():
-    """Get workouts with rest day support and new sets structure"""
+    """
+    Get workouts with rest day support and new sets structure, newest first.
+    Accounts over VOLUME_SOFT_LIMITS get pages of WORKOUTS_PAGE_SIZE, and
+    past the summarize tier each exercise's set_count with empty sets.
+    X-Next-End-Date gives the end_date of the next page.
+    """
     user_id = request.user['id']
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
-    
-    conn = sqlite3.connect('setora.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    
-    query = 'SELECT * FROM workouts WHERE user_id=?'
-    params = [user_id]
-    
-    if start_date:
-        query += ' AND date >= ?'
-        params.append(start_date)
-    if end_date:
-        query += ' AND date <= ?'
-        params.append(end_date)
-    
-    query += ' ORDER BY date DESC'
-    
-    c.execute(query, params)
-    workouts = []
-    
-    for row in c.fetchall():
-        workout = dict(row)
-        
-        if workout['is_rest_day']:
-            workout['day_type'] = 'Rest Day'
-            workout['exercises'] = []
-        else:
-            # Get built-in exercises
-            c.execute('''SELECT we.*, e.name, e.category 
-                        FROM workout_exercises we
-                        JOIN exercises e ON we.exercise_id = e.id
-                        WHERE we.workout_id = ? AND we.is_custom = 0
-                        ORDER BY we.order_index''', (workout['id'],))
-            
-            exercises = []
-            categories = set()
-            
-            for ex_row in c.fetchall():
-                ex = dict(ex_row)
-                
-                # Get sets
-                c.execute('''SELECT * FROM workout_sets 
-                            WHERE workout_exercise_id = ? 
-                            ORDER BY set_number''', (ex['id'],))
-                ex['sets'] = [dict(s) for s in c.fetchall()]
-                
-                exercises.append(ex)
-                categories.add(ex['category'])
-            
-            # Get custom exercises
-            c.execute('''SELECT we.*, ue.name, ue.category 
-                        FROM workout_exercises we
-                        JOIN user_exercises ue ON we.exercise_id = ue.id
-                        WHERE we.workout_id = ? AND we.is_custom = 1
-                        ORDER BY we.order_index''', (workout['id'],))
-            
-            for ex_row in c.fetchall():
-                ex = dict(ex_row)
-                ex['is_custom'] = True
-                
-                c.execute('''SELECT * FROM workout_sets 
-                            WHERE workout_exercise_id = ? 
-                            ORDER BY set_number''', (ex['id'],))
-                ex['sets'] = [dict(s) for s in c.fetchall()]
-                
-                exercises.append(ex)
-                categories.add(ex['category'])
-            
-            workout['exercises'] = exercises
-            
-            if len(categories) == 1:
-                workout['day_type'] = f"{list(categories)[0]} Day"
-            elif len(categories) > 1:
-                workout['day_type'] = " + ".join(sorted(categories)) + " Day"
-            else:
-                workout['day_type'] = "Workout Day"
-        
-        workouts.append(workout)
-    
-    conn.close()
-    return jsonify(workouts)
+    limit = request.args.get('limit', type=int)
+    summary = request.args.get('summary', '').lower() in ('1', 'true', 'yes')
+    if limit is not None and limit < 1:
+        return jsonify({'error': 'limit must be positive'}), 400
+
+    tier = volume_tier(volume_totals(store.user_volume(user_id)), VOLUME_SOFT_LIMITS)
+    if tier:
+        limit = min(limit or WORKOUTS_PAGE_SIZE, WORKOUTS_PAGE_SIZE)
+        summary = summary or tier == 'summarize'
+
+    workouts = store.list_workouts(user_id, start_date, end_date, limit, summary)
+    response = jsonify(workouts)
+    if tier:
+        response.headers['X-Volume-Tier'] = tier
+    if limit and len(workouts) == limit:
+        try:
+            oldest = datetime.strptime(workouts[-1]['date'], '%Y-%m-%d')
+            response.headers['X-Next-End-Date'] = (oldest - timedelta(days=1)).strftime('%Y-%m-%d')
+        except ValueError:
+            pass
+    return response
 
 # Weight routes
-@app.route('/api/weight', methods=['POST'])
+@api.route('/api/weight', methods=['POST'])
 @require_auth
+@rate_limit('write')
+@admit_write
 def add_weight():
     data = request.json
     user_id = request.user['id']
     
-    conn = sqlite3.connect('setora.db')
-    c = conn.cursor()
-    c.execute('INSERT INTO weight_logs (user_id, date, weight) VALUES (?, ?, ?)',
-             (user_id, data['date'], data['weight']))
-    conn.commit()
-    conn.close()
+    store.add_weight(user_id, data['date'], data['weight'])
     
+    event_hub.notify(user_id)
     return jsonify({'success': True})
 
-@app.route('/api/weight', methods=['GET'])
+@api.route('/api/weight', methods=['GET'])
 @require_auth
 def get_weight_logs():
     user_id = request.user['id']
-    
-    conn = sqlite3.connect('setora.db')
-    c = conn.cursor()
-    c.execute('SELECT * FROM weight_logs WHERE user_id=? ORDER BY date DESC',
-             (user_id,))
-    logs = [{'id': row[0], 'date': row[2], 'weight': row[3]}
-            for row in c.fetchall()]
-    conn.close()
-    
-    return jsonify(logs)
+    return jsonify(store.list_weights(user_id))
 
 # Progress routes
-@app.route('/api/progress', methods=['GET'])
+@api.route('/api/progress', methods=['GET'])
 @require_auth
 def get_progress():
     """Get progress stats with rest day awareness"""
     user_id = request.user['id']
-    
-    conn = sqlite3.connect('setora.db')
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    
-    # Volume stats (exclude rest days)
-    c.execute('''SELECT w.date, e.category, 
-                 SUM(ws.weight * ws.reps) as volume,
-                 COUNT(DISTINCT we.id) as exercise_count
-                 FROM workouts w
-                 JOIN workout_exercises we ON w.id = we.workout_id
-                 LEFT JOIN exercises e ON we.exercise_id = e.id AND we.is_custom = 0
-                 LEFT JOIN user_exercises ue ON we.exercise_id = ue.id AND we.is_custom = 1
-                 LEFT JOIN workout_sets ws ON we.id = ws.workout_exercise_id
-                 WHERE w.user_id = ? AND w.is_rest_day = 0
-                 GROUP BY w.date, COALESCE(e.category, ue.category)
-                 ORDER BY w.date''', (user_id,))
-    
-    workout_stats = [dict(row) for row in c.fetchall()]
-    
-    # Category frequency (exclude rest days)
-    c.execute('''SELECT COALESCE(e.category, ue.category) as category, 
-                 COUNT(DISTINCT w.date) as frequency
-                 FROM workouts w
-                 JOIN workout_exercises we ON w.id = we.workout_id
-                 LEFT JOIN exercises e ON we.exercise_id = e.id AND we.is_custom = 0
-                 LEFT JOIN user_exercises ue ON we.exercise_id = ue.id AND we.is_custom = 1
-                 WHERE w.user_id = ? AND w.is_rest_day = 0
-                 GROUP BY COALESCE(e.category, ue.category)''', (user_id,))
-    
-    category_freq = [dict(row) for row in c.fetchall()]
-    
-    conn.close()
-    
-    return jsonify({
-        'workout_stats': workout_stats,
-        'category_frequency': category_freq
-    })
+    return jsonify(store.get_progress(user_id))
 
 # Template routes
-@app.route('/api/templates', methods=['GET'])
+@api.route('/api/templates', methods=['GET'])
 @require_auth
 def get_templates():
     user_id = request.user['id']
-    conn = sqlite3.connect('setora.db')
-    c = conn.cursor()
-    c.execute('SELECT * FROM workout_templates WHERE user_id=?', (user_id,))
-    templates = [{'id': row[0], 'name': row[2], 'exercises': json.loads(row[3])}
-                 for row in c.fetchall()]
-    conn.close()
-    return jsonify(templates)
-
-@app.route('/api/templates', methods=['POST'])
+    return jsonify(store.list_templates(user_id))
+
+@api.route('/api/templates', methods=['POST'])
 @require_auth
+@rate_limit('write')
+@admit_write
 def add_template():
     data = request.json
     user_id = request.user['id']
     
-    conn = sqlite3.connect('setora.db')
-    c = conn.cursor()
-    c.execute('INSERT INTO workout_templates (user_id, name, exercises) VALUES (?, ?, ?)',
-             (user_id, data['name'], json.dumps(data['exercises'])))
-    conn.commit()
-    template_id = c.lastrowid
-    conn.close()
+    try:
+        template_id, _ = store.add_template(user_id, data['name'], data['exercises'])
+    except UnknownExerciseError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
     
     return jsonify({'success': True, 'id': template_id})
 
+@api.route('/api/templates/<int:template_id>/apply', methods=['POST'])
+@require_auth
+@rate_limit('write')
+@admit_write
+def apply_template(template_id):
+    """Create or merge into the workout for ?date= from a template, server-side"""
+    user_id = request.user['id']
+    workout_date = request.args.get('date')
+    if not workout_date:
+        return jsonify({'error': 'date is required'}), 400
+    prefill = request.args.get('prefill', '').lower() in ('1', 'true', 'yes')
+
+    try:
+        result = store.apply_template(user_id, template_id, workout_date, prefill)
+    except UnknownExerciseError as e:
+        return jsonify({'error': str(e)}), 400
+    if result is None:
+        return jsonify({'error': 'Template not found'}), 404
+    workout_id, merged, _ = result
+
+    event_hub.notify(user_id)
+    return jsonify({'success': True, 'workout_id': workout_id, 'merged': merged})
+
+# Sync routes
+@api.route('/api/sync', methods=['GET'])
+@require_auth
+def sync():
+    """Return entities changed since the ``since`` cursor, or a full snapshot"""
+    user_id = request.user['id']
+    since = request.args.get('since', 0, type=int)
+    return jsonify(store.sync(user_id, since))
+
+# Stream routes
+@api.route('/api/stream', methods=['GET'])
+@require_auth
+def stream():
+    """Push the current user's change log entries as Server-Sent Events; ids are sync cursors"""
+    user_id = request.user['id']
+    # A reconnecting client may have missed events while it was away
+    resuming = request.headers.get('Last-Event-ID') is not None
+    
+    def generate():
+        q = event_hub.subscribe(user_id)
+        try:
+            yield f'retry: {STREAM_HEARTBEAT_SECONDS * 1000}\n\n'
+            if resuming:
+                yield format_sse({'event': 'resync'})
+            while True:
+                try:
+                    event = q.get(timeout=STREAM_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ': heartbeat\n\n'
+                    continue
+                yield format_sse(event)
+        finally:
+            event_hub.unsubscribe(user_id, q)
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Job routes
+@api.route('/api/jobs', methods=['POST'])
+@require_auth
+@rate_limit('write')
+@admit_write
+def submit_job():
+    """
+    Queue a report off the request path: {"kind": "export" | "analytics" |
+    "records", "params": {"start_date": ..., "end_date": ...}}. Poll
+    GET /api/jobs/<id>, then fetch /api/jobs/<id>/result. Resubmitting
+    while the user's data is unchanged returns the existing job.
+    """
+    data = request.get_json(silent=True) or {}
+    user_id = request.user['id']
+    try:
+        params = job_params(data.get('kind'), data.get('params'))
+        job_id, reused = job_queue.submit(user_id, data['kind'], params)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except TooManyJobs:
+        return jsonify({'error': f'At most {MAX_ACTIVE_JOBS} jobs at a time; wait for one or cancel it'}), 429
+
+    job = store.get_job(job_id)
+    job['reused'] = reused
+    return jsonify(job), 200 if job['status'] == 'done' else 202
+
+@api.route('/api/jobs', methods=['GET'])
+@require_auth
+def list_jobs():
+    """The user's jobs until they expire, newest first, without results"""
+    return jsonify(store.list_jobs(request.user['id']))
+
+@api.route('/api/jobs/<int:job_id>', methods=['GET'])
+@require_auth
+def get_job(job_id):
+    job = store.get_job(job_id, request.user['id'])
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@api.route('/api/jobs/<int:job_id>/result', methods=['GET'])
+@require_auth
+def get_job_result(job_id):
+    """200 with the result once done, 202 with the job while pending, 409 if it failed or was cancelled"""
+    job = store.get_job(job_id, request.user['id'], with_result=True)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    if job['status'] == 'done':
+        return jsonify(job['result'])
+    del job['result']
+    return jsonify(job), 202 if job['status'] in ('queued', 'running') else 409
+
+@api.route('/api/jobs/<int:job_id>', methods=['DELETE'])
+@require_auth
+@rate_limit('write')
+@admit_write
+def cancel_job(job_id):
+    user_id = request.user['id']
+    if not job_queue.cancel(user_id, job_id):
+        if not store.get_job(job_id, user_id):
+            return jsonify({'error': 'Job not found'}), 404
+        return jsonify({'error': 'Job already finished'}), 409
+    return jsonify({'success': True})
+
+# Metrics routes
+@api.route('/api/metrics/limits', methods=['GET'])
+@require_admin
+def limit_metrics():
+    """Throttled and shed request counts since the process started"""
+    stats = rate_limiter.stats()
+    stats['requests'] = request_limiter.stats()
+    stats['writes'] = write_limiter.stats()
+    stats['jobs'] = job_queue.stats()
+    return jsonify(stats)
+
+@api.route('/api/metrics/volume', methods=['GET'])
+@require_admin
+def volume_metrics():
+    """Heaviest accounts first; ?sort= one of VOLUME_REPORT_SORTS, ?limit= rows (default 50)"""
+    sort = request.args.get('sort', 'payload_bytes')
+    if sort not in VOLUME_REPORT_SORTS:
+        return jsonify({'error': f"sort must be one of {', '.join(VOLUME_REPORT_SORTS)}"}), 400
+    return jsonify(volume_report(request.args.get('limit', 50, type=int), sort))
+
+def create_app():
+    """Build the Flask app; importing this module and calling this does no database work"""
+    app = Flask(__name__)
+    app.secret_key = 'setora_secret_key'
+
+    # Optional, so only cross-origin deployments import flask_cors,
+    # e.g. SETORA_CORS_ORIGINS=http://localhost:6000,http://127.0.0.1:6000
+    cors_origins = os.environ.get('SETORA_CORS_ORIGINS')
+    if cors_origins:
+        from flask_cors import CORS
+        CORS(app, supports_credentials=True, origins=cors_origins.split(','))
+
+    app.before_request(start_request_timer)
+    app.before_request(admit_request)
+    app.teardown_request(release_request)
+    app.teardown_request(record_request_latency)
+    app.before_request(ensure_storage)
+    app.register_blueprint(api)
+    return app
+
+app = create_app()
+
 if __name__ == '__main__':
     app.run(host="0.0.0.0", debug=True, port=5000)
@@ -0,0 +1,118 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from storage import MemoryStorage, SQLiteStorage
+
+SETS = [{'set_number': n, 'reps': 8, 'weight': 60 + n * 5} for n in range(1, 5)]
+EXERCISES = [{'exercise_id': exercise_id, 'sets': SETS} for exercise_id in (1, 10, 13)]
+
+# Cold start budgets, in milliseconds
+IMPORT_BUDGET_MS = 300
+FIRST_REQUEST_BUDGET_MS = 500
+
+# Runs in a fresh interpreter so nothing is already imported or cached
+STARTUP_PROBE = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.app.test_client().get('/api/auth/check')
+done = time.perf_counter()
+print(json.dumps({'import': imported - start, 'first_request': done - start}))
+"""
+
+def measure(label, fn, repeat):
+    """Run fn ``repeat`` times and print the mean cost per call"""
+    start = time.perf_counter()
+    for i in range(repeat):
+        fn(i)
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<28} {elapsed / repeat * 1e6:>10.1f} µs/op")
+    return elapsed / repeat
+
+def populate(store, user_id, days):
+    for day in range(days):
+        store.save_workout(user_id, f'2024-{day // 28 + 1:02d}-{day % 28 + 1:02d}', '', EXERCISES)
+
+def bench_storage(name, store, repeat, days):
+    """Storage calls in isolation, no HTTP or Flask involved"""
+    print(f"{name}:")
+    store.init_schema()
+    store.seed_exercises()
+    user_id = store.create_user(f'bench-{name}@example.com', 'x', 'Bench')
+    populate(store, user_id, days)
+
+    measure('save_workout (merge)', lambda i: store.save_workout(user_id, '2024-01-01', '', EXERCISES[:1]), repeat)
+    measure('get_workout_by_date', lambda i: store.get_workout_by_date(user_id, '2024-01-02'), repeat)
+    measure(f'list_workouts ({days} days)', lambda i: store.list_workouts(user_id), max(1, repeat // 10))
+    measure('add_weight', lambda i: store.add_weight(user_id, '2024-01-01', 80), repeat)
+    measure('list_weights', lambda i: store.list_weights(user_id), repeat)
+    cursor = store.sync(user_id, 0)['cursor']
+    measure('sync (delta)', lambda i: store.sync(user_id, cursor - 1), repeat)
+
+def bench_handlers(repeat):
+    """The same request through Flask, to separate handler overhead from storage cost"""
+    os.environ['SETORA_STORAGE'] = 'memory'
+    import app as setora
+
+    client = setora.app.test_client()
+    client.post('/api/auth/signup', json={'email': 'bench@example.com', 'password': 'x', 'name': 'Bench'})
+    client.post('/api/workouts', json={'date': '2024-01-02', 'exercises': EXERCISES})
+    user_id = setora.store.find_user_by_credentials('bench@example.com', setora.hash_password('x'))['id']
+
+    print("handlers (memory engine):")
+    storage_cost = measure('store.get_workout_by_date', lambda i: setora.store.get_workout_by_date(user_id, '2024-01-02'), repeat)
+    request_cost = measure('GET /api/workouts/<date>', lambda i: client.get('/api/workouts/2024-01-02'), repeat)
+    print(f"  {'handler overhead':<28} {(request_cost - storage_cost) * 1e6:>10.1f} µs/op")
+
+def bench_startup(runs):
+    """
+    Import time and time to first request, each in a new process. The first
+    run starts on an empty directory and creates the schema; the rest find
+    it at the current version and skip it.
+    """
+    print("startup (sqlite engine):")
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    env.pop('SETORA_STORAGE', None)
+    timings = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for _ in range(runs):
+            output = subprocess.run([sys.executable, '-c', STARTUP_PROBE], cwd=tmp, env=env,
+                                    capture_output=True, text=True, check=True).stdout
+            timings.append(json.loads(output.splitlines()[-1]))
+
+    def report(label, seconds, budget_ms):
+        verdict = 'ok' if seconds * 1000 <= budget_ms else 'OVER BUDGET'
+        print(f"  {label:<28} {seconds * 1000:>10.1f} ms    (budget {budget_ms} ms, {verdict})")
+        return seconds * 1000 <= budget_ms
+
+    warm = timings[1:] or timings
+    within = [
+        report('first request, new db', timings[0]['first_request'], FIRST_REQUEST_BUDGET_MS),
+        report('import app', min(t['import'] for t in warm), IMPORT_BUDGET_MS),
+        report('first request', min(t['first_request'] for t in warm), FIRST_REQUEST_BUDGET_MS),
+    ]
+    return all(within)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for storage engines and request handlers')
+    parser.add_argument('--repeat', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=90, help='workout history per user')
+    parser.add_argument('--startup-runs', type=int, default=5, help='fresh processes for the startup timings')
+    args = parser.parse_args()
+
+    startup_ok = bench_startup(args.startup_runs)
+
+    bench_storage('memory', MemoryStorage(), args.repeat, args.days)
+    with tempfile.TemporaryDirectory() as tmp:
+        bench_storage('sqlite', SQLiteStorage(os.path.join(tmp, 'bench.db')), args.repeat, args.days)
+        os.chdir(tmp)
+        bench_handlers(args.repeat)
+
+    if not startup_ok:
+        sys.exit(1)
@@ -0,0 +1,317 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import zlib
+from datetime import datetime
+
+from app import DB_PATH
+from database_shards import list_shards
+
+BACKUP_DIR = os.environ.get('SETORA_BACKUP_DIR', 'backups')
+SNAPSHOT_PREFIX = 'setora-'
+TIME_FORMAT = '%Y%m%d-%H%M%S'
+
+class BackupRestarted(Exception):
+    """Writes kept invalidating a step-wise copy"""
+
+def database_files():
+    """setora.db plus every shard file"""
+    return [DB_PATH] + list_shards()
+
+def copy_database(src_path, dst_path, pages, pause, max_restarts):
+    """
+    Hot copy src_path into dst_path with SQLite's online backup API,
+    ``pages`` pages per step with ``pause`` seconds between steps.
+
+    On a WAL database (the app's default) the copy reads from one pinned
+    read transaction: writers keep committing and the copy never restarts.
+    On a rollback-journal file every outside write restarts the copy, so
+    after ``max_restarts`` of those it finishes in one step instead.
+    Returns (pages, restarts).
+    """
+    src = sqlite3.connect(src_path, timeout=30, isolation_level=None)
+    dst = sqlite3.connect(dst_path)
+    # Scratch file, checksummed before it is kept: skip the fsyncs that compete with request traffic
+    dst.execute('PRAGMA synchronous = OFF')
+    state = {'remaining': None, 'restarts': 0}
+
+    def progress(status, remaining, total):
+        if state['remaining'] is not None and remaining > state['remaining']:
+            state['restarts'] += 1
+            if state['restarts'] > max_restarts:
+                raise BackupRestarted()
+        state['remaining'] = remaining
+        if remaining:
+            time.sleep(pause)
+
+    try:
+        if src.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+            src.execute('BEGIN')
+            src.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        try:
+            src.backup(dst, pages=pages, progress=progress)
+        except BackupRestarted:
+            src.backup(dst)
+        page_count = dst.execute('PRAGMA page_count').fetchone()[0]
+    finally:
+        src.close()
+        dst.close()
+    return page_count, state['restarts']
+
+def compress(path, archive_path, level):
+    """Gzip path into archive_path; return the sha256 of the uncompressed bytes"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as raw, gzip.open(archive_path, 'wb', compresslevel=level) as archive:
+        for chunk in iter(lambda: raw.read(1 << 20), b''):
+            digest.update(chunk)
+            archive.write(chunk)
+    return digest.hexdigest()
+
+def decompress(archive_path, path):
+    """Gunzip archive_path into path; return the sha256 of the result"""
+    digest = hashlib.sha256()
+    with gzip.open(archive_path, 'rb') as archive, open(path, 'wb') as raw:
+        for chunk in iter(lambda: archive.read(1 << 20), b''):
+            digest.update(chunk)
+            raw.write(chunk)
+    return digest.hexdigest()
+
+def list_snapshots(backup_dir):
+    """Completed snapshot directories, oldest first"""
+    if not os.path.isdir(backup_dir):
+        return []
+    return sorted(os.path.join(backup_dir, name) for name in os.listdir(backup_dir)
+                  if name.startswith(SNAPSHOT_PREFIX)
+                  and os.path.exists(os.path.join(backup_dir, name, 'manifest.json')))
+
+def snapshot_time(snapshot):
+    return datetime.strptime(os.path.basename(snapshot)[len(SNAPSHOT_PREFIX):], TIME_FORMAT)
+
+def load_manifest(snapshot):
+    with open(os.path.join(snapshot, 'manifest.json')) as f:
+        return json.load(f)
+
+def backup(backup_dir, pages, pause, level, max_restarts):
+    """Snapshot every database file into a new directory under backup_dir"""
+    os.makedirs(backup_dir, exist_ok=True)
+    created = datetime.now()
+    snapshot = os.path.join(backup_dir, SNAPSHOT_PREFIX + created.strftime(TIME_FORMAT))
+    # Written under a temporary name so list/rotate/restore never see half a snapshot
+    partial = snapshot + '.partial'
+    os.makedirs(partial)
+
+    paths = database_files()
+    print(f"Backing up {len(paths)} database files to {snapshot}...")
+    manifest = {'created': created.isoformat(timespec='seconds'), 'files': []}
+    started = time.perf_counter()
+    total_bytes = 0
+
+    with tempfile.TemporaryDirectory(dir=backup_dir) as tmp:
+        for path in paths:
+            copy_path = os.path.join(tmp, os.path.basename(path))
+            copy_started = time.perf_counter()
+            page_count, restarts = copy_database(path, copy_path, pages, pause, max_restarts)
+            copy_seconds = time.perf_counter() - copy_started
+
+            archive = os.path.basename(path) + '.gz'
+            size = os.path.getsize(copy_path)
+            sha256 = compress(copy_path, os.path.join(partial, archive), level)
+            compressed = os.path.getsize(os.path.join(partial, archive))
+            os.remove(copy_path)
+            total_bytes += size
+
+            manifest['files'].append({'path': path, 'archive': archive, 'sha256': sha256,
+                                      'bytes': size, 'compressed_bytes': compressed, 'pages': page_count})
+            print(f"  - {path}: {size / 1e6:.1f} MB copied in {copy_seconds:.2f}s "
+                  f"({size / 1e6 / max(copy_seconds, 1e-6):.1f} MB/s, {restarts} restarts), "
+                  f"{compressed / 1e6:.1f} MB compressed")
+
+    with open(os.path.join(partial, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.rename(partial, snapshot)
+
+    elapsed = time.perf_counter() - started
+    print(f"✅ {total_bytes / 1e6:.1f} MB in {elapsed:.2f}s ({total_bytes / 1e6 / max(elapsed, 1e-6):.1f} MB/s)")
+    return snapshot
+
+def rotate(backup_dir, keep):
+    """Delete all but the newest ``keep`` snapshots"""
+    snapshots = list_snapshots(backup_dir)
+    for snapshot in snapshots[:-keep] if keep > 0 else []:
+        shutil.rmtree(snapshot)
+        print(f"  - removed {snapshot}")
+
+def check_file(snapshot, entry, path):
+    """Decompress one archived file to path; return a problem description or None"""
+    try:
+        if decompress(os.path.join(snapshot, entry['archive']), path) != entry['sha256']:
+            return 'checksum mismatch'
+    except (OSError, EOFError, zlib.error) as e:
+        return f'unreadable archive: {e}'
+    conn = sqlite3.connect(path)
+    try:
+        result = conn.execute('PRAGMA integrity_check').fetchone()[0]
+    except sqlite3.DatabaseError as e:
+        result = str(e)
+    finally:
+        conn.close()
+    return None if result == 'ok' else f'integrity check failed: {result}'
+
+def verify(snapshot):
+    """Checksum and integrity-check every file in a snapshot"""
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        for entry in load_manifest(snapshot)['files']:
+            problem = check_file(snapshot, entry, os.path.join(tmp, os.path.basename(entry['path'])))
+            print(f"  - {entry['path']}: {problem or 'ok'}")
+            ok = ok and problem is None
+    print(f"{'✅' if ok else '❌'} {snapshot}")
+    return ok
+
+def last_change_seq(path):
+    """Highest change_log sequence number ever issued in a database file, 0 if none"""
+    if not os.path.exists(path):
+        return 0
+    conn = sqlite3.connect(path)
+    try:
+        row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'").fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    finally:
+        conn.close()
+    return row[0] if row else 0
+
+def reset_sync_floors(paths, floor):
+    """
+    A restored change log reissues sequence numbers that clients already
+    hold. Like database_shards.reset_sync_floor, but for every user: start
+    each file's log at ``floor`` and mark it compacted there, so every
+    client takes one snapshot on its next sync.
+    """
+    directory = sqlite3.connect(DB_PATH, timeout=30)
+    user_ids = [row[0] for row in directory.execute('SELECT id FROM users')]
+    directory.close()
+    for path in paths:
+        conn = sqlite3.connect(path, timeout=30)
+        if conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'change_log'",
+                        (floor,)).rowcount == 0:
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('change_log', ?)", (floor,))
+        conn.execute('DELETE FROM change_log WHERE seq <= ?', (floor,))
+        conn.executemany('''INSERT INTO sync_state (user_id, compacted_seq) VALUES (?, ?)
+                            ON CONFLICT(user_id) DO UPDATE SET
+                            compacted_seq = MAX(compacted_seq, excluded.compacted_seq)''',
+                         [(user_id, floor) for user_id in user_ids])
+        conn.commit()
+        conn.close()
+
+def restore(snapshot):
+    """
+    Verify every file, then copy each one into place through the backup API.
+    Each copy is a single write transaction, so a running app sees the old
+    or the restored database, never a mix. Sync floors are then raised above
+    every sequence number issued before the restore.
+    """
+    print(f"Restoring {snapshot}...")
+    with tempfile.TemporaryDirectory() as tmp:
+        entries = load_manifest(snapshot)['files']
+        for entry in entries:
+            problem = check_file(snapshot, entry, os.path.join(tmp, os.path.basename(entry['path'])))
+            if problem:
+                raise SystemExit(f"❌ {entry['path']}: {problem}; nothing was restored")
+
+        # Clients may hold any cursor issued before now, including by files left out of the snapshot
+        issued = max(last_change_seq(path) for path in set(database_files()) | {entry['path'] for entry in entries})
+
+        for entry in entries:
+            os.makedirs(os.path.dirname(entry['path']) or '.', exist_ok=True)
+            src = sqlite3.connect(os.path.join(tmp, os.path.basename(entry['path'])))
+            dst = sqlite3.connect(entry['path'], timeout=30)
+            src.backup(dst)
+            src.close()
+            dst.close()
+            print(f"  - {entry['path']}: restored")
+
+    extra = set(database_files()) - {entry['path'] for entry in entries}
+    for path in sorted(extra):
+        print(f"  - {path}: not in this snapshot, left as is")
+
+    floor = max([issued] + [last_change_seq(entry['path']) for entry in entries]) + 1
+    reset_sync_floors([entry['path'] for entry in entries], floor)
+    print(f"✅ Restore complete. Change logs restart at {floor}, so every client takes a snapshot on its next sync.")
+
+def resolve_snapshot(backup_dir, name=None, at=None):
+    """A snapshot by name or path, the newest one taken at or before ``at``, or the newest overall"""
+    snapshots = list_snapshots(backup_dir)
+    if name:
+        path = name if os.path.exists(os.path.join(name, 'manifest.json')) else os.path.join(backup_dir, name)
+        if not os.path.exists(os.path.join(path, 'manifest.json')):
+            raise SystemExit(f"No snapshot {name} in {backup_dir}")
+        return path
+    if at:
+        snapshots = [s for s in snapshots if snapshot_time(s) <= at]
+    if not snapshots:
+        raise SystemExit(f"No snapshot in {backup_dir}" + (f" taken at or before {at}" if at else ''))
+    return snapshots[-1]
+
+def schedule(backup_dir, every, keep, **options):
+    """Back up, rotate and verify every ``every`` seconds until interrupted"""
+    while True:
+        started = time.monotonic()
+        try:
+            snapshot = backup(backup_dir, **options)
+            rotate(backup_dir, keep)
+            verify(snapshot)
+        except Exception as e:
+            print(f"❌ Backup failed: {e}")
+        time.sleep(max(0, every - (time.monotonic() - started)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hot backups, verification and restore for setora.db and its shards')
+    parser.add_argument('--dir', default=BACKUP_DIR, help='snapshot directory (default: $SETORA_BACKUP_DIR or backups/)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    copy_options = argparse.ArgumentParser(add_help=False)
+    copy_options.add_argument('--pages', type=int, default=256, help='pages copied per step')
+    copy_options.add_argument('--pause', type=float, default=0.01, help='seconds between steps, when requests get the lock')
+    copy_options.add_argument('--level', type=int, default=6, help='gzip compression level')
+    copy_options.add_argument('--max-restarts', type=int, default=3,
+                              help='restarts caused by concurrent writes before copying in one step')
+    copy_options.add_argument('--keep', type=int, default=7, help='snapshots to keep, 0 keeps all')
+
+    commands.add_parser('backup', parents=[copy_options], help='Take a snapshot now, then rotate')
+    schedule_parser = commands.add_parser('schedule', parents=[copy_options], help='Take snapshots on an interval')
+    schedule_parser.add_argument('--every', type=int, default=3600, help='seconds between snapshots')
+    commands.add_parser('list', help='List snapshots')
+    verify_parser = commands.add_parser('verify', help='Check snapshot checksums and integrity')
+    verify_parser.add_argument('snapshot', nargs='?', help='default: newest')
+    verify_parser.add_argument('--all', action='store_true', help='verify every snapshot')
+    restore_parser = commands.add_parser('restore', help='Restore a snapshot into the live database files')
+    restore_parser.add_argument('snapshot', nargs='?', help='default: newest')
+    restore_parser.add_argument('--at', type=datetime.fromisoformat,
+                                help='restore the newest snapshot taken at or before this time, e.g. 2024-05-01T06:00')
+    args = parser.parse_args()
+
+    if args.command in ('backup', 'schedule'):
+        options = {'pages': args.pages, 'pause': args.pause, 'level': args.level, 'max_restarts': args.max_restarts}
+        if args.command == 'backup':
+            backup(args.dir, **options)
+            rotate(args.dir, args.keep)
+        else:
+            schedule(args.dir, args.every, args.keep, **options)
+    elif args.command == 'list':
+        for snapshot in list_snapshots(args.dir):
+            files = load_manifest(snapshot)['files']
+            size = sum(entry['compressed_bytes'] for entry in files)
+            print(f"{os.path.basename(snapshot)}  {len(files)} files  {size / 1e6:.1f} MB")
+    elif args.command == 'verify':
+        snapshots = list_snapshots(args.dir) if args.all else [resolve_snapshot(args.dir, args.snapshot)]
+        if not all([verify(snapshot) for snapshot in snapshots]):
+            raise SystemExit(1)
+    elif args.command == 'restore':
+        restore(resolve_snapshot(args.dir, args.snapshot, args.at))
@@ -1,12 +1,15 @@
 import sqlite3
+import sys
 from datetime import datetime
 
-def migrate_database():
+from storage import SQLiteStorage, columns_volume, pack_sets, unpack_set_columns
+
+def migrate_database(db_path='setora.db'):
     """
     Migration script to upgrade database schema for new workout system
     Run this ONCE before deploying new version
     """
-    conn = sqlite3.connect('setora.db')
+    conn = sqlite3.connect(db_path)
     c = conn.cursor()
     
     print("Starting database migration...")
@@ -62,11 +65,22 @@ def migrate_database():
     except sqlite3.OperationalError:
         print("  - order_index column already exists")
     
+    try:
+        c.execute('ALTER TABLE workout_exercises ADD COLUMN set_data BLOB')
+    except sqlite3.OperationalError:
+        print("  - set_data column already exists")
+    
+    try:
+        c.execute('ALTER TABLE workout_exercises ADD COLUMN volume REAL')
+    except sqlite3.OperationalError:
+        print("  - volume column already exists")
+    
     # 5. Migrate existing workout data to new sets structure
     print("Migrating existing workout data...")
     c.execute('''SELECT id, sets, reps, weight, duration 
                  FROM workout_exercises 
-                 WHERE sets IS NOT NULL OR reps IS NOT NULL OR weight IS NOT NULL''')
+                 WHERE (sets IS NOT NULL OR reps IS NOT NULL OR weight IS NOT NULL)
+                 AND set_data IS NULL''')
     
     old_exercises = c.fetchall()
     migrated_count = 0
@@ -94,17 +108,72 @@ def migrate_database():
         c.execute('CREATE INDEX IF NOT EXISTS idx_user_exercises_user ON user_exercises(user_id)')
         c.execute('CREATE INDEX IF NOT EXISTS idx_workout_sets_exercise ON workout_sets(workout_exercise_id)')
         c.execute('CREATE INDEX IF NOT EXISTS idx_workouts_date ON workouts(user_id, date)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_workout_exercises_workout ON workout_exercises(workout_id, exercise_id, is_custom)')
     except sqlite3.OperationalError as e:
         print(f"  - Index creation note: {e}")
     
+    # 7. Pack row-per-set storage into one BLOB per workout exercise
+    print("Packing workout sets...")
+    c.execute('''SELECT DISTINCT workout_exercise_id FROM workout_sets ws
+                 JOIN workout_exercises we ON we.id = ws.workout_exercise_id
+                 WHERE we.set_data IS NULL''')
+    packed_count = 0
+    
+    for (we_id,) in c.fetchall():
+        c.execute('''SELECT set_number, reps, weight, duration, notes
+                     FROM workout_sets WHERE workout_exercise_id = ?''', (we_id,))
+        sets = [{'set_number': row[0], 'reps': row[1], 'weight': row[2], 'duration': row[3], 'notes': row[4]}
+                for row in c.fetchall()]
+        set_data = pack_sets(sets)
+        if set_data is None:
+            # Sets with notes keep row storage
+            continue
+        c.execute('UPDATE workout_exercises SET set_data = ?, volume = ? WHERE id = ?',
+                  (set_data, columns_volume(*unpack_set_columns(set_data)[1:3]), we_id))
+        c.execute('DELETE FROM workout_sets WHERE workout_exercise_id = ?', (we_id,))
+        packed_count += len(sets)
+    
+    print(f"  - Packed {packed_count} set rows")
+    
+    # 8. Build the last performance pointers from existing history
+    print("Indexing last performance per exercise...")
+    c.execute('''CREATE TABLE IF NOT EXISTS last_performance (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        exercise_id INTEGER NOT NULL,
+        is_custom INTEGER NOT NULL DEFAULT 0,
+        workout_exercise_id INTEGER NOT NULL,
+        date TEXT NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users(id),
+        FOREIGN KEY (workout_exercise_id) REFERENCES workout_exercises(id),
+        UNIQUE(user_id, exercise_id, is_custom)
+    )''')
+    # Newest first, so the first row per exercise wins and older ones are ignored
+    c.execute('''INSERT OR IGNORE INTO last_performance
+                 (user_id, exercise_id, is_custom, workout_exercise_id, date)
+                 SELECT w.user_id, we.exercise_id, COALESCE(we.is_custom, 0), we.id, w.date
+                 FROM workout_exercises we
+                 JOIN workouts w ON w.id = we.workout_id
+                 WHERE COALESCE(we.is_custom, 0) = 0 OR we.exercise_id IN (SELECT id FROM user_exercises)
+                 ORDER BY w.date DESC, we.order_index DESC''')
+    print(f"  - Indexed {c.rowcount} exercises")
+    
+    # 9. Step 7 moved sets from rows into set_data: recount them where the app already keeps volume counters
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'user_volume'")
+    if c.fetchone():
+        print("Recounting per-user volume...")
+        SQLiteStorage.recount_volume(c)
+    
     conn.commit()
     conn.close()
     
     print("✅ Migration completed successfully!")
     print("\nNext steps:")
-    print("1. Backup your database before proceeding")
+    print("1. Take a backup before proceeding: python database_backup.py backup")
     print("2. Deploy the new Flask application code")
     print("3. Test the new features")
 
 if __name__ == '__main__':
-    migrate_database()
\ No newline at end of file
+    # Pass shard files as arguments to migrate them too
+    for db_path in sys.argv[1:] or ['setora.db']:
+        migrate_database(db_path)
\ No newline at end of file
@@ -0,0 +1,323 @@
+import argparse
+import glob
+import json
+import os
+import sqlite3
+from datetime import datetime
+
+from app import DB_PATH, SHARD_DIR, store
+from storage import USER_DATA_COUNTERS, parse_exercise_id
+
+# Per-user tables in copy order: (table, query selecting one user's rows, {column: parent table})
+USER_TABLES = [
+    ('user_exercises', 'SELECT * FROM user_exercises WHERE user_id = ?', {}),
+    ('workouts', 'SELECT * FROM workouts WHERE user_id = ?', {}),
+    ('workout_exercises', '''SELECT we.* FROM workout_exercises we
+                             JOIN workouts w ON w.id = we.workout_id
+                             WHERE w.user_id = ?''', {'workout_id': 'workouts'}),
+    ('workout_sets', '''SELECT ws.* FROM workout_sets ws
+                        JOIN workout_exercises we ON we.id = ws.workout_exercise_id
+                        JOIN workouts w ON w.id = we.workout_id
+                        WHERE w.user_id = ?''', {'workout_exercise_id': 'workout_exercises'}),
+    ('last_performance', 'SELECT * FROM last_performance WHERE user_id = ?',
+     {'workout_exercise_id': 'workout_exercises'}),
+    ('weight_logs', 'SELECT * FROM weight_logs WHERE user_id = ?', {}),
+    ('workout_templates', 'SELECT * FROM workout_templates WHERE user_id = ?', {}),
+]
+
+def list_shards():
+    """Paths of every shard file currently on disk"""
+    return sorted(glob.glob(os.path.join(SHARD_DIR, 'setora-*.db')))
+
+def copy_custom_exercise(dst, directory, values, old_id):
+    """
+    Copy one custom exercise into dst, keeping the id that workouts,
+    templates and clients refer to. Returns its id in dst: the user's
+    same-named exercise if one is already there, else the same id, else
+    (an id issued by a shard's own AUTOINCREMENT and already taken there)
+    a fresh one from setora.db.
+    """
+    row = dst.execute('SELECT id FROM user_exercises WHERE user_id = ? AND name = ?',
+                      (values['user_id'], values['name'])).fetchone()
+    if row:
+        return row[0]
+    new_id = old_id
+    if dst.execute('SELECT 1 FROM user_exercises WHERE id = ?', (old_id,)).fetchone():
+        new_id = directory.execute('INSERT INTO custom_exercise_ids DEFAULT VALUES').lastrowid
+    dst_columns = {row[1] for row in dst.execute('PRAGMA table_info(user_exercises)')}
+    columns = [column for column in values if column in dst_columns]
+    dst.execute(f'INSERT INTO user_exercises (id, {", ".join(columns)}) VALUES (?{", ?" * len(columns)})',
+                [new_id] + [values[column] for column in columns])
+    return new_id
+
+def remap_template_exercises(raw, custom_ids):
+    """Template JSON with custom_<id> references pointed at the ids those exercises got in dst"""
+    if all(old_id == new_id for old_id, new_id in custom_ids.items()):
+        return raw
+    exercises = json.loads(raw)
+    for ex in exercises:
+        try:
+            exercise_id, is_custom = parse_exercise_id(ex.get('exercise_id'))
+        except ValueError:
+            continue
+        if is_custom and exercise_id in custom_ids:
+            ex['exercise_id'] = f'custom_{custom_ids[exercise_id]}'
+    return json.dumps(exercises)
+
+def merge_workout(dst, user_id, values):
+    """
+    Merge into dst's workout on the same date the way save_workout does.
+    Return (its id, its highest order_index), or None if dst has none.
+    """
+    row = dst.execute('SELECT id FROM workouts WHERE user_id = ? AND date = ?', (user_id, values['date'])).fetchone()
+    if row is None:
+        return None
+    dst.execute('''UPDATE workouts SET is_rest_day = ?, merged_at = ?,
+                   notes = CASE WHEN COALESCE(notes, '') = '' THEN ? ELSE notes END
+                   WHERE id = ?''',
+                (values['is_rest_day'], datetime.now().isoformat(), values['notes'], row[0]))
+    # Counted once already: move_user_volume adds the source's count for it again
+    dst.execute('UPDATE user_volume SET workouts = workouts - 1 WHERE user_id = ?', (user_id,))
+    last_order = dst.execute('SELECT COALESCE(MAX(order_index), 0) FROM workout_exercises WHERE workout_id = ?',
+                             (row[0],)).fetchone()[0]
+    return row[0], last_order
+
+def copy_user_rows(src, dst, directory, user_id):
+    """
+    Copy one user's rows from src to dst. Custom exercises keep their ids
+    (see copy_custom_exercise); other rows get fresh ids in dst. A workout
+    written to src after an earlier pass copied its date is merged into
+    dst's workout for that date rather than duplicated.
+    Returns {table: [source ids]} so the caller can delete what was copied.
+    """
+    id_maps = {}
+    copied = {}
+    order_offsets = {}  # dst workout id -> order_index its merged exercises start after
+
+    for table, query, parents in USER_TABLES:
+        dst_columns = {row[1] for row in dst.execute(f'PRAGMA table_info({table})')}
+        id_maps[table] = {}
+        copied[table] = []
+
+        for row in src.execute(query, (user_id,)).fetchall():
+            values = dict(row)
+            old_id = values.pop('id')
+            copied[table].append(old_id)
+            if table == 'user_exercises':
+                id_maps[table][old_id] = copy_custom_exercise(dst, directory, values, old_id)
+                continue
+            if table == 'workouts':
+                merged = merge_workout(dst, user_id, values)
+                if merged is not None:
+                    id_maps[table][old_id], order_offsets[merged[0]] = merged
+                    continue
+            for column, parent in parents.items():
+                values[column] = id_maps[parent][values[column]]
+            if table == 'workout_exercises':
+                values['order_index'] += order_offsets.get(values['workout_id'], 0)
+            if table in ('workout_exercises', 'last_performance') and values.get('is_custom'):
+                values['exercise_id'] = id_maps['user_exercises'].get(values['exercise_id'], values['exercise_id'])
+            if table == 'workout_templates':
+                values['exercises'] = remap_template_exercises(values['exercises'], id_maps['user_exercises'])
+
+            columns = [column for column in values if column in dst_columns]
+            placeholders = ', '.join('?' * len(columns))
+            if table == 'last_performance':
+                # A later pass may carry an older pointer than one already copied; keep the newer date
+                dst.execute(f'''INSERT INTO last_performance ({", ".join(columns)}) VALUES ({placeholders})
+                                ON CONFLICT(user_id, exercise_id, is_custom) DO UPDATE
+                                SET workout_exercise_id = excluded.workout_exercise_id, date = excluded.date
+                                WHERE excluded.date >= last_performance.date''',
+                            [values[column] for column in columns])
+                continue
+            cur = dst.execute(f'INSERT OR IGNORE INTO {table} ({", ".join(columns)}) VALUES ({placeholders})',
+                              [values[column] for column in columns])
+            id_maps[table][old_id] = cur.lastrowid
+
+    return copied
+
+def delete_user_rows(src, copied):
+    """Delete previously copied rows from src, children first"""
+    for table, _, _ in reversed(USER_TABLES):
+        ids = copied[table]
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            src.execute(f'DELETE FROM {table} WHERE id IN ({",".join("?" * len(chunk))})', chunk)
+
+def reset_sync_floor(src, dst, user_id):
+    """
+    Sequence numbers are per database file, so a moved user's sync cursors
+    are meaningless in dst. Start dst's change log above anything the client
+    may hold and mark it compacted, which forces one snapshot on next sync.
+    """
+    def last_seq(conn):
+        row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'").fetchone()
+        return row[0] if row else 0
+
+    floor = max(last_seq(src), last_seq(dst)) + 1
+    if dst.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'change_log'", (floor,)).rowcount == 0:
+        dst.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('change_log', ?)", (floor,))
+    dst.execute('DELETE FROM change_log WHERE user_id = ?', (user_id,))
+    dst.execute('''INSERT INTO sync_state (user_id, compacted_seq) VALUES (?, ?)
+                   ON CONFLICT(user_id) DO UPDATE SET compacted_seq = excluded.compacted_seq''',
+                (user_id, floor))
+    src.execute('DELETE FROM change_log WHERE user_id = ?', (user_id,))
+    src.execute('DELETE FROM sync_state WHERE user_id = ?', (user_id,))
+
+def move_user_volume(src, dst, user_id):
+    """Carry a moved user's row counters over to dst; session counts stay in setora.db"""
+    row = src.execute(f'SELECT {", ".join(USER_DATA_COUNTERS)} FROM user_volume WHERE user_id = ?',
+                      (user_id,)).fetchone()
+    if row is None:
+        return
+    dst.execute(f'''INSERT INTO user_volume (user_id, {", ".join(USER_DATA_COUNTERS)})
+                    VALUES (?{", ?" * len(USER_DATA_COUNTERS)})
+                    ON CONFLICT(user_id) DO UPDATE SET
+                    {", ".join(f"{counter} = {counter} + excluded.{counter}" for counter in USER_DATA_COUNTERS)}''',
+                (user_id, *row))
+    src.execute(f'''UPDATE user_volume SET {", ".join(f"{counter} = 0" for counter in USER_DATA_COUNTERS)}
+                    WHERE user_id = ?''', (user_id,))
+
+def user_row_count(conn, user_id):
+    return sum(conn.execute(f'SELECT COUNT(*) FROM ({query})', (user_id,)).fetchone()[0]
+               for _, query, _ in USER_TABLES)
+
+def move_user(user_id, src_path, dst_shard, max_passes=3):
+    """
+    Move one user's data from src_path into dst_shard and repoint routing.
+
+    The source stays write-locked only while this one user is copied, so
+    other users on the same file are delayed for milliseconds, not for the
+    whole run. Writes that were routed to the source before the switch and
+    land after it are picked up by another pass.
+    """
+    moved = 0
+    for _ in range(max_passes):
+        src = sqlite3.connect(src_path, isolation_level=None, timeout=30)
+        src.row_factory = sqlite3.Row
+        dst = store.open_shard(dst_shard)
+        dst.row_factory = sqlite3.Row
+        # Migrating out of setora.db: the routing table lives in the source itself
+        directory = src if os.path.abspath(src_path) == os.path.abspath(DB_PATH) else sqlite3.connect(DB_PATH, timeout=30)
+
+        src.execute('BEGIN IMMEDIATE')
+        try:
+            done = user_row_count(src, user_id) == 0
+            if not done:
+                copied = copy_user_rows(src, dst, directory, user_id)
+                reset_sync_floor(src, dst, user_id)
+                move_user_volume(src, dst, user_id)
+                dst.commit()
+
+            directory.execute('''INSERT INTO user_shards (user_id, shard) VALUES (?, ?)
+                                 ON CONFLICT(user_id) DO UPDATE SET shard = excluded.shard''',
+                              (user_id, dst_shard))
+            if directory is not src:
+                directory.commit()
+
+            if not done:
+                delete_user_rows(src, copied)
+                moved += sum(len(ids) for ids in copied.values())
+            src.execute('COMMIT')
+        except Exception:
+            src.execute('ROLLBACK')
+            dst.rollback()
+            raise
+        finally:
+            if directory is not src:
+                directory.close()
+            src.close()
+            dst.close()
+        if done:
+            break
+
+    return moved
+
+def migrate(shard_count):
+    """Move every user's data out of setora.db into their shard"""
+    print(f"Migrating per-user data into {shard_count} shards under {SHARD_DIR}/...")
+    directory = sqlite3.connect(DB_PATH)
+    user_ids = [row[0] for row in directory.execute('SELECT id FROM users ORDER BY id')]
+    # Users already routed by a running app keep their assignment
+    assignments = dict(directory.execute('SELECT user_id, shard FROM user_shards').fetchall())
+    directory.close()
+
+    total = 0
+    for user_id in user_ids:
+        shard = assignments.get(user_id, store.shard_for_user(user_id, shard_count))
+        moved = move_user(user_id, DB_PATH, shard)
+        if moved:
+            print(f"  - user {user_id}: {moved} rows -> shard {shard}")
+        total += moved
+
+    print(f"✅ Migrated {total} rows for {len(user_ids)} users")
+
+def reshard(shard_count):
+    """Move users whose hash places them on a different shard under the new count"""
+    print(f"Resharding onto {shard_count} shards...")
+    directory = sqlite3.connect(DB_PATH)
+    assignments = directory.execute('SELECT user_id, shard FROM user_shards ORDER BY user_id').fetchall()
+    directory.close()
+
+    moved_users = 0
+    for user_id, current in assignments:
+        target = store.shard_for_user(user_id, shard_count)
+        if target == current:
+            continue
+        moved = move_user(user_id, store.shard_path(current), target)
+        print(f"  - user {user_id}: shard {current} -> {target} ({moved} rows)")
+        moved_users += 1
+
+    print(f"✅ Moved {moved_users} of {len(assignments)} users")
+    print(f"\nSet SETORA_SHARDS={shard_count} so new users are placed with the same hash.")
+
+def status():
+    """Print user and row counts for setora.db and every shard"""
+    directory = sqlite3.connect(DB_PATH)
+    users_per_shard = dict(directory.execute('SELECT shard, COUNT(*) FROM user_shards GROUP BY shard').fetchall())
+    directory.close()
+
+    for path in [DB_PATH] + list_shards():
+        conn = sqlite3.connect(path)
+        counts = ', '.join(f"{table}={conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]}"
+                           for table, _, _ in USER_TABLES)
+        conn.close()
+        shard = None if path == DB_PATH else int(os.path.basename(path)[len('setora-'):-len('.db')])
+        users = '' if shard is None else f" users={users_per_shard.get(shard, 0)}"
+        print(f"{path}:{users} {counts}")
+
+def exec_all(sql):
+    """Run one statement against every shard, e.g. a schema change"""
+    for path in list_shards():
+        conn = sqlite3.connect(path)
+        conn.executescript(sql)
+        conn.commit()
+        conn.close()
+        print(f"  - {path}: ok")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage sharded per-user database files')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('status', help='Show user and row counts per database file')
+    migrate_parser = commands.add_parser('migrate', help='Move per-user data from setora.db into shards')
+    migrate_parser.add_argument('--shards', type=int, default=int(os.environ.get('SETORA_SHARDS', '0')))
+    reshard_parser = commands.add_parser('reshard', help='Rebalance users onto a new shard count, one user at a time')
+    reshard_parser.add_argument('--shards', type=int, required=True)
+    exec_parser = commands.add_parser('exec', help='Run SQL against every shard')
+    exec_parser.add_argument('sql')
+    args = parser.parse_args()
+
+    if args.command in ('migrate', 'reshard') and args.shards < 1:
+        parser.error('--shards (or SETORA_SHARDS) must be at least 1')
+
+    # The app no longer touches the database at import time
+    store.ensure_schema()
+
+    if args.command == 'status':
+        status()
+    elif args.command == 'migrate':
+        migrate(args.shards)
+    elif args.command == 'reshard':
+        reshard(args.shards)
+    elif args.command == 'exec':
+        exec_all(args.sql)
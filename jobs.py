@@ -0,0 +1,313 @@
+"""Background jobs for the Setora API.
+
+Reports too heavy to build inside a request (a full-history export,
+per-month analytics over years of workouts, personal records) run on a
+pool of worker processes. Jobs live in storage, so any app process can
+report their progress, cancel them or serve their results until they
+expire. ``JobQueue`` owns the pool and keeps its own pending jobs fresh.
+"""
+import concurrent.futures
+import functools
+import multiprocessing
+import threading
+import time
+from datetime import datetime
+
+import math
+
+from storage import column_value, columns_volume, now_timestamp
+
+JOB_PAGE_SIZE = 200        # workouts read per step; progress and cancellation are checked between steps
+PROGRESS_INTERVAL = 0.5    # seconds between progress writes
+MAX_DISPATCHES = 3         # pools a job is given before it is failed, when each one broke under it
+
+class JobCancelled(Exception):
+    """The job was cancelled while it ran"""
+
+class TooManyJobs(Exception):
+    """The user already has the maximum number of queued or running jobs"""
+
+class JobProgress:
+    """
+    Handed to job functions as ``progress(done, total)``. Stores the
+    fraction at most every ``interval`` seconds and raises JobCancelled
+    on the first store after the job was cancelled.
+    """
+
+    def __init__(self, store, job_id, interval=PROGRESS_INTERVAL, clock=time.monotonic):
+        self.store = store
+        self.job_id = job_id
+        self.interval = interval
+        self.clock = clock
+        self._stored = None
+
+    def __call__(self, done, total):
+        now = self.clock()
+        if self._stored is not None and now - self._stored < self.interval:
+            return
+        self._stored = now
+        if not self.store.update_job_progress(self.job_id, min(1.0, done / total) if total else 0.0):
+            raise JobCancelled()
+
+def iter_workouts(store, user_id, progress, start_date=None, end_date=None, columns=False):
+    """
+    Every workout in the range, newest first, read JOB_PAGE_SIZE at a
+    time with progress reported after each page. Pages continue from the
+    oldest date seen, which holds at most one workout per user.
+    ``columns`` is passed on to list_workouts.
+    """
+    total = store.user_volume(user_id)['workouts']
+    done = 0
+    oldest = None
+    progress(done, total)
+    while True:
+        fetched = store.list_workouts(user_id, start_date, oldest or end_date, JOB_PAGE_SIZE + 1, columns=columns)
+        page = [workout for workout in fetched if oldest is None or workout['date'] < oldest]
+        yield from page
+        done += len(page)
+        progress(done, total)
+        if len(fetched) <= JOB_PAGE_SIZE or not page:
+            return
+        oldest = page[-1]['date']
+
+def export_history(store, user_id, params, progress):
+    """Everything the user has logged, in the shapes the API serves it"""
+    return {'exported_at': now_timestamp(),
+            'workouts': list(iter_workouts(store, user_id, progress)),
+            'weight_logs': store.list_weights(user_id),
+            'templates': store.list_templates(user_id),
+            'custom_exercises': store.list_custom_exercises(user_id)}
+
+def monthly_analytics(store, user_id, params, progress):
+    """Workouts, rest days, sets, volume and days per category for each month, oldest first"""
+    months = {}
+    for workout in iter_workouts(store, user_id, progress, params.get('start_date'), params.get('end_date'), columns=True):
+        key = workout['date'][:7]
+        month = months.setdefault(key, {'month': key, 'workouts': 0, 'rest_days': 0, 'sets': 0,
+                                        'volume': 0.0, 'categories': {}})
+        if workout['is_rest_day']:
+            month['rest_days'] += 1
+            continue
+        month['workouts'] += 1
+        for exercise in workout['exercises']:
+            set_numbers, reps, weights, durations = exercise['set_columns']
+            month['sets'] += len(set_numbers)
+            month['volume'] += columns_volume(reps, weights) or 0
+        for category in {exercise['category'] for exercise in workout['exercises']}:
+            month['categories'][category] = month['categories'].get(category, 0) + 1
+    for month in months.values():
+        month['volume'] = round(month['volume'], 2)
+    return {'months': [months[key] for key in sorted(months)]}
+
+def personal_records(store, user_id, params, progress):
+    """
+    Per exercise: the heaviest set, the most reps in one set and the best
+    estimated one-rep max (Epley), each with the date it was first reached
+    """
+    records = {}
+    for workout in iter_workouts(store, user_id, progress, params.get('start_date'), params.get('end_date'), columns=True):
+        for exercise in workout['exercises']:
+            exercise_id = f"custom_{exercise['exercise_id']}" if exercise.get('is_custom') else exercise['exercise_id']
+            record = records.setdefault(exercise_id, {
+                'exercise_id': exercise_id, 'name': exercise['name'], 'category': exercise['category'],
+                'heaviest': None, 'most_reps': None, 'best_e1rm': None})
+            set_numbers, set_reps, set_weights, durations = exercise['set_columns']
+            for i in range(len(set_numbers)):
+                if math.isnan(set_weights[i]) and math.isnan(set_reps[i]):
+                    continue
+                weight, reps = column_value(set_weights[i]), column_value(set_reps[i], True)
+                e1rm = None
+                if weight and reps:
+                    e1rm = weight if reps == 1 else round(weight * (1 + reps / 30), 1)
+                for name, value in (('heaviest', weight), ('most_reps', reps), ('best_e1rm', e1rm)):
+                    # Workouts arrive newest first, so a tie moves the record to the earlier date
+                    if value is not None and (record[name] is None or value >= record[name]['value']):
+                        record[name] = {'value': value, 'weight': weight, 'reps': reps, 'date': workout['date']}
+    return {'records': sorted(records.values(), key=lambda record: (record['category'], record['name']))}
+
+# kind: (function, optional YYYY-MM-DD params)
+JOB_KINDS = {
+    'export': (export_history, ()),
+    'analytics': (monthly_analytics, ('start_date', 'end_date')),
+    'records': (personal_records, ('start_date', 'end_date')),
+}
+
+def job_params(kind, params):
+    """Check a submission against JOB_KINDS; return its params normalised, else raise ValueError"""
+    if kind not in JOB_KINDS:
+        raise ValueError(f"kind must be one of {', '.join(JOB_KINDS)}")
+    params = params or {}
+    if not isinstance(params, dict):
+        raise ValueError('params must be an object')
+    allowed = JOB_KINDS[kind][1]
+    unknown = sorted(set(params) - set(allowed))
+    if unknown:
+        raise ValueError(f"{kind} jobs take no {', '.join(unknown)}")
+    cleaned = {}
+    for name in allowed:
+        if params.get(name) is None:
+            continue
+        try:
+            cleaned[name] = datetime.strptime(params[name], '%Y-%m-%d').strftime('%Y-%m-%d')
+        except (TypeError, ValueError):
+            raise ValueError(f'{name} must be YYYY-MM-DD')
+    return cleaned
+
+# Set in each worker by init_worker
+_worker_store = None
+
+def init_worker(store):
+    global _worker_store
+    _worker_store = store
+
+def run_job(job_id, kind, user_id, params, result_ttl):
+    """Worker entry point: run one job and store its outcome; return its final status"""
+    store = _worker_store
+    if not store.start_job(job_id):
+        return 'cancelled'
+    try:
+        result = JOB_KINDS[kind][0](store, user_id, params, JobProgress(store, job_id))
+    except JobCancelled:
+        return 'cancelled'
+    except Exception as e:
+        store.finish_job(job_id, 'failed', now_timestamp(result_ttl), error=f'{type(e).__name__}: {e}')
+        return 'failed'
+    store.finish_job(job_id, 'done', now_timestamp(result_ttl), result=result)
+    return 'done'
+
+class JobQueue:
+    """
+    Runs jobs on ``workers`` processes, or threads with ``processes=False``
+    for engines that live in this process. Results are kept ``result_ttl``
+    seconds, and a submission matching a pending or done job over
+    unchanged data gets that job instead of a new one. From its first
+    submission, and then every ``sweep_interval`` seconds, this process
+    refreshes its pending jobs and evicts expired ones; pending jobs
+    nobody refreshed for ``stale_after`` seconds lost their process and
+    are failed, and are never reused or counted as active meanwhile.
+    """
+
+    def __init__(self, store, workers, result_ttl, stale_after, max_active=None, sweep_interval=60, processes=True):
+        self.store = store
+        self.workers = workers
+        self.result_ttl = result_ttl
+        self.stale_after = stale_after
+        self.max_active = max_active
+        self.sweep_interval = sweep_interval
+        self.processes = processes
+        self._pool = None
+        self._sweeper = None
+        self._pending = {}  # job_id -> Future, until the worker returns
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        """The worker pool, started on first use so importing the app spawns nothing"""
+        with self._lock:
+            if self._pool is None:
+                if self.processes:
+                    # Spawned rather than forked: a fork of a threaded server can inherit held locks
+                    self._pool = concurrent.futures.ProcessPoolExecutor(
+                        self.workers, mp_context=multiprocessing.get_context('spawn'),
+                        initializer=init_worker, initargs=(self.store,))
+                else:
+                    self._pool = concurrent.futures.ThreadPoolExecutor(
+                        self.workers, 'setora-job', initializer=init_worker, initargs=(self.store,))
+            return self._pool
+
+    def _start_sweeper(self):
+        """Sweep once, clearing jobs orphaned before this process started, then keep sweeping"""
+        with self._lock:
+            if self._sweeper is not None:
+                return
+            self._sweeper = threading.Thread(target=self._sweep_forever, name='setora-job-sweeper', daemon=True)
+        try:
+            self.sweep()
+        except Exception:
+            pass
+        self._sweeper.start()
+
+    def submit(self, user_id, kind, params):
+        """Queue a job, or find the one already answering it; return (job_id, reused)"""
+        self._start_sweeper()
+        data_version = max(self.store.sync_cursor(user_id))
+        stale_before = now_timestamp(-self.stale_after)
+        job_id = self.store.find_job(user_id, kind, params, data_version, now_timestamp(), stale_before)
+        if job_id is not None:
+            return job_id, True
+        job_id = self.store.create_job(user_id, kind, params, data_version, self.max_active, stale_before)
+        if job_id is None:
+            raise TooManyJobs()
+        self._dispatch(job_id, kind, user_id, params)
+        return job_id, False
+
+    def _dispatch(self, job_id, kind, user_id, params, attempt=1):
+        pool = self._executor()
+        try:
+            future = pool.submit(run_job, job_id, kind, user_id, params, self.result_ttl)
+        except concurrent.futures.BrokenExecutor:
+            self._discard(pool)
+            pool = self._executor()
+            future = pool.submit(run_job, job_id, kind, user_id, params, self.result_ttl)
+        with self._lock:
+            self._pending[job_id] = future
+        future.add_done_callback(functools.partial(self._finished, pool, (job_id, kind, user_id, params), attempt))
+
+    def _discard(self, pool):
+        """Drop a broken pool so the next dispatch starts a fresh one"""
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def _finished(self, pool, job, attempt, future):
+        job_id = job[0]
+        with self._lock:
+            self._pending.pop(job_id, None)
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            return
+        # run_job stores its own failures, so the worker died under it or storage failed before it started
+        if isinstance(error, concurrent.futures.BrokenExecutor):
+            self._discard(pool)
+            current = self.store.get_job(job_id)
+            if current and current['status'] == 'queued' and attempt < MAX_DISPATCHES:
+                # Never started: give it to the next pool
+                self._dispatch(*job, attempt=attempt + 1)
+                return
+        self.store.fail_job(job_id, now_timestamp(self.result_ttl), f'worker lost: {error}')
+
+    def cancel(self, user_id, job_id):
+        """
+        Cancel a user's job; return False if it is unknown or finished. A
+        queued job never starts, a running one stops at its next progress report.
+        """
+        if not self.store.cancel_job(user_id, job_id, now_timestamp(self.result_ttl)):
+            return False
+        with self._lock:
+            future = self._pending.get(job_id)
+        if future is not None:
+            future.cancel()
+        return True
+
+    def sweep(self):
+        """Refresh this process's pending jobs, then evict expired jobs and fail abandoned ones"""
+        with self._lock:
+            pending = list(self._pending)
+        self.store.touch_jobs(pending)
+        return self.store.evict_jobs(now_timestamp(), now_timestamp(-self.stale_after),
+                                     now_timestamp(self.result_ttl))
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception:
+                # Storage busy or briefly unavailable; the next sweep catches up
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self.workers, 'processes': self.processes, 'pending': len(self._pending)}
@@ -0,0 +1,115 @@
+"""Rate limiting and admission control for the Setora API.
+
+``RateLimiter`` throttles clients: named policies of token buckets keyed by
+IP, email or user id. ``ConcurrencyLimiter`` protects the server: it caps
+in-flight work and sheds the excess instead of letting it queue behind
+SQLite's single writer.
+"""
+import threading
+import time
+from collections import Counter, OrderedDict
+
+class TokenBuckets:
+    """
+    One token bucket per key, refilled continuously at ``rate`` tokens per
+    second up to ``burst``. A key costs one (tokens, updated) pair; past
+    ``max_keys`` the least recently used key is evicted and starts full again.
+    """
+
+    def __init__(self, rate, burst, max_keys=10000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.clock = clock
+        self._buckets = OrderedDict()  # key -> (tokens, updated), least recently used first
+        self._lock = threading.Lock()
+
+    def take(self, key, cost=1):
+        """Spend ``cost`` tokens; return 0 if allowed, else seconds until it would be"""
+        now = self.clock()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0.0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def __len__(self):
+        return len(self._buckets)
+
+class RateLimiter:
+    """
+    Per-route policies. ``policies`` maps a policy name to
+    {key name: (requests, per seconds)}, e.g. {'login': {'ip': (20, 60)}}.
+    """
+
+    def __init__(self, policies, max_keys=10000):
+        self._buckets = {(policy, key): TokenBuckets(count / per, count, max_keys)
+                         for policy, limits in policies.items()
+                         for key, (count, per) in limits.items()}
+        self._throttled = Counter()  # 'policy:key' -> rejected requests
+        self._lock = threading.Lock()
+
+    def check(self, policy, keys):
+        """
+        Charge one request to every bucket of ``policy`` named in ``keys``
+        ({key name: value}, None values skipped). Return 0 if all allow it,
+        else the longest wait in seconds.
+        """
+        wait = 0.0
+        for name, value in keys.items():
+            bucket = self._buckets.get((policy, name))
+            if bucket is None or value is None:
+                continue
+            delay = bucket.take(value)
+            if delay:
+                with self._lock:
+                    self._throttled[f'{policy}:{name}'] += 1
+                wait = max(wait, delay)
+        return wait
+
+    def stats(self):
+        with self._lock:
+            throttled = dict(self._throttled)
+        return {'throttled': throttled,
+                'tracked_keys': {f'{policy}:{key}': len(bucket)
+                                 for (policy, key), bucket in self._buckets.items()}}
+
+class ConcurrencyLimiter:
+    """Cap in-flight work; callers that get no slot within ``wait`` seconds are shed"""
+
+    def __init__(self, limit, wait=0.0):
+        self.limit = limit
+        self.wait = wait
+        self._slots = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._shed = 0
+
+    def acquire(self):
+        """Return True with a slot held, or False if the caller should be shed"""
+        if self.wait > 0:
+            acquired = self._slots.acquire(timeout=self.wait)
+        else:
+            acquired = self._slots.acquire(blocking=False)
+        with self._lock:
+            if acquired:
+                self._in_flight += 1
+            else:
+                self._shed += 1
+        return acquired
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+        self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {'limit': self.limit, 'in_flight': self._in_flight, 'shed': self._shed}
@@ -0,0 +1,2473 @@
+"""Storage engines behind the Setora API.
+
+Routes only talk to a ``Storage``. ``SQLiteStorage`` is the production
+engine (setora.db, optionally with sharded per-user files);
+``MemoryStorage`` keeps everything in indexed dicts for tests and
+benchmarks.
+"""
+import copy
+import functools
+import glob
+import itertools
+import json
+import math
+import os
+import sqlite3
+import threading
+import zlib
+from array import array
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+SCHEMA_VERSION = 8          # stored in PRAGMA user_version; bump on every schema change
+SYNC_LOG_RETENTION = 5000   # entries kept per user before clients must re-snapshot
+SYNC_COMPACT_EVERY = 500    # compact a user's log after every N of their own changes
+JOB_RESULT_INLINE_BYTES = 64 * 1024  # larger job results go to files in the result directory, not the jobs table
+
+DEFAULT_EXERCISES = [
+    ('Bench Press', 'Chest', 'Barbell'),
+    ('Incline Dumbbell Press', 'Chest', 'Dumbbell'),
+    ('Push-ups', 'Chest', 'Bodyweight'),
+    ('Barbell Curl', 'Biceps', 'Barbell'),
+    ('Dumbbell Curl', 'Biceps', 'Dumbbell'),
+    ('Hammer Curl', 'Biceps', 'Dumbbell'),
+    ('Tricep Dips', 'Triceps', 'Bodyweight'),
+    ('Tricep Pushdown', 'Triceps', 'Cable'),
+    ('Overhead Extension', 'Triceps', 'Dumbbell'),
+    ('Squat', 'Legs', 'Barbell'),
+    ('Leg Press', 'Legs', 'Machine'),
+    ('Lunges', 'Legs', 'Dumbbell'),
+    ('Deadlift', 'Back', 'Barbell'),
+    ('Pull-ups', 'Back', 'Bodyweight'),
+    ('Lat Pulldown', 'Back', 'Cable'),
+    ('Shoulder Press', 'Shoulders', 'Dumbbell'),
+    ('Lateral Raise', 'Shoulders', 'Dumbbell'),
+    ('Front Raise', 'Shoulders', 'Dumbbell'),
+    ('Running', 'Cardio', 'None'),
+    ('Cycling', 'Cardio', 'Machine'),
+    ('Jump Rope', 'Cardio', 'Equipment'),
+    ('Plank', 'Core', 'Bodyweight'),
+    ('Crunches', 'Core', 'Bodyweight'),
+    ('Russian Twist', 'Core', 'Bodyweight')
+]
+
+USER_FIELDS = ('name', 'age', 'gender', 'height', 'weight', 'goal', 'unit_preference', 'theme_preference')
+
+class DuplicateError(Exception):
+    """Raised when a write would violate a uniqueness constraint"""
+
+class UnknownExerciseError(Exception):
+    """Raised when an exercise id names neither a library exercise nor one of the user's custom ones"""
+
+def parse_exercise_id(exercise_id):
+    """Split an API exercise id into (id, is_custom); custom ids look like 'custom_12'"""
+    if isinstance(exercise_id, str) and exercise_id.startswith('custom_'):
+        return int(exercise_id.replace('custom_', '')), 1
+    return exercise_id, 0
+
+def template_exercise_keys(exercises):
+    """Map (id, is_custom) to the API id for each template exercise; raise UnknownExerciseError if one cannot be parsed"""
+    keys = {}
+    for ex in exercises:
+        exercise_id = ex.get('exercise_id') if isinstance(ex, dict) else None
+        try:
+            exercise_id_int, is_custom = parse_exercise_id(exercise_id)
+            key = (int(exercise_id_int), is_custom)
+        except (TypeError, ValueError):
+            raise UnknownExerciseError(f'Unknown exercise {exercise_id}')
+        keys.setdefault(key, exercise_id)
+    return keys
+
+def day_type(categories):
+    if len(categories) == 1:
+        return f"{list(categories)[0]} Day"
+    elif len(categories) > 1:
+        return " + ".join(sorted(categories)) + " Day"
+    return "Workout Day"
+
+# Packed set storage: one float64 BLOB per workout exercise, laid out column by
+# column (all set numbers, then all reps, weights, durations). NaN stands for NULL.
+SET_COLUMNS = ('set_number', 'reps', 'weight', 'duration')
+
+def pack_sets(sets):
+    """
+    Pack a workout exercise's sets into a BLOB, or return None when they need
+    row storage: sets with notes or non-numeric values keep one row per set.
+    """
+    for set_data in sets:
+        if set_data.get('notes'):
+            return None
+        for column in SET_COLUMNS:
+            value = set_data.get(column)
+            if value is not None and (not isinstance(value, (int, float)) or isinstance(value, bool)):
+                return None
+
+    ordered = sorted(sets, key=lambda set_data: set_data['set_number'])
+    packed = array('d')
+    for column in SET_COLUMNS:
+        packed.extend(math.nan if set_data.get(column) is None else set_data[column] for set_data in ordered)
+    return packed.tobytes()
+
+def unpack_set_columns(blob):
+    """Zero-copy column views (set_number, reps, weight, duration) over a packed BLOB"""
+    values = memoryview(blob).cast('d')
+    n = len(values) // len(SET_COLUMNS)
+    return tuple(values[i * n:(i + 1) * n] for i in range(len(SET_COLUMNS)))
+
+def column_value(value, integer=False):
+    """A set column value as the API serves it: None for NaN, whole reps and set numbers as int"""
+    if math.isnan(value):
+        return None
+    return int(value) if integer and value.is_integer() else value
+
+def unpack_sets(blob, workout_exercise_id):
+    """Decode a packed BLOB into the same dicts a workout_sets row produces"""
+    set_numbers, reps, weights, durations = unpack_set_columns(blob)
+    return [{'id': None, 'workout_exercise_id': workout_exercise_id,
+             'set_number': column_value(set_numbers[i], True), 'reps': column_value(reps[i], True),
+             'weight': column_value(weights[i]), 'duration': column_value(durations[i]), 'notes': ''}
+            for i in range(len(set_numbers))]
+
+def set_columns(sets):
+    """The columns unpack_set_columns gives, as lists built from set dicts (NaN for NULL or non-numeric)"""
+    def value(v):
+        return float(v) if isinstance(v, (int, float)) and not isinstance(v, bool) else math.nan
+    ordered = sorted(sets, key=lambda set_data: set_data['set_number'])
+    return tuple([value(set_data.get(column)) for set_data in ordered] for column in SET_COLUMNS)
+
+def columns_volume(reps, weights):
+    """Sum of weight * reps over set columns, None when no set has both (like SQL SUM over NULLs)"""
+    products = [w * r for r, w in zip(reps, weights) if not (math.isnan(r) or math.isnan(w))]
+    return sum(products) if products else None
+
+@functools.lru_cache(maxsize=1024)
+def parse_template(raw):
+    """
+    Parsed template exercises, cached by their JSON text so unchanged
+    templates are decoded once. The result is shared: never mutate it.
+    """
+    return json.loads(raw)
+
+def expand_template(template_exercises, last_sets=None):
+    """
+    Turn template exercises into a save_workout payload. ``last_sets`` maps
+    (exercise_id, is_custom) to the sets of its last performance; their
+    weights replace the template's, set by set.
+    """
+    exercises = []
+    for ex in template_exercises:
+        previous = (last_sets or {}).get(parse_exercise_id(ex['exercise_id']))
+        sets = []
+        for number, template_set in enumerate(ex.get('sets', []), start=1):
+            set_data = {'set_number': template_set.get('set_number') or number,
+                        'reps': template_set.get('reps'), 'weight': template_set.get('weight'),
+                        'duration': template_set.get('duration'), 'notes': ''}
+            if previous:
+                # Same set number from last time, or its last set when this one is new
+                match = next((s for s in previous if s['set_number'] == set_data['set_number']), previous[-1])
+                if match['weight'] is not None:
+                    set_data['weight'] = match['weight']
+            sets.append(set_data)
+        exercises.append({'exercise_id': ex['exercise_id'], 'notes': ex.get('notes', ''), 'sets': sets})
+    return exercises
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+VOLUME_COUNTERS = ('workouts', 'workout_exercises', 'workout_sets', 'packed_sets',
+                   'weight_logs', 'templates', 'custom_exercises', 'sessions')
+
+# Counters that move with a user's rows between shard files; sessions stay in setora.db
+USER_DATA_COUNTERS = VOLUME_COUNTERS[:-1]
+
+# Recounting from scratch, per counter: (table it counts, query yielding (user_id, rows))
+VOLUME_RECOUNTS = {
+    'workouts': ('workouts', 'SELECT user_id, COUNT(*) FROM workouts GROUP BY user_id'),
+    'workout_exercises': ('workout_exercises', '''SELECT w.user_id, COUNT(*) FROM workout_exercises we
+                                               JOIN workouts w ON w.id = we.workout_id GROUP BY w.user_id'''),
+    'workout_sets': ('workout_sets', '''SELECT w.user_id, COUNT(*) FROM workout_sets ws
+                                     JOIN workout_exercises we ON we.id = ws.workout_exercise_id
+                                     JOIN workouts w ON w.id = we.workout_id GROUP BY w.user_id'''),
+    'packed_sets': ('workout_exercises', f'''SELECT w.user_id, COALESCE(SUM(LENGTH(we.set_data)), 0) / {8 * len(SET_COLUMNS)}
+                                         FROM workout_exercises we
+                                         JOIN workouts w ON w.id = we.workout_id GROUP BY w.user_id'''),
+    'weight_logs': ('weight_logs', 'SELECT user_id, COUNT(*) FROM weight_logs GROUP BY user_id'),
+    'templates': ('workout_templates', 'SELECT user_id, COUNT(*) FROM workout_templates GROUP BY user_id'),
+    'custom_exercises': ('user_exercises', 'SELECT user_id, COUNT(*) FROM user_exercises GROUP BY user_id'),
+    'sessions': ('sessions', 'SELECT user_id, COUNT(*) FROM sessions GROUP BY user_id'),
+}
+
+# Job columns returned by get_job and list_jobs; results are only read on request
+JOB_FIELDS = ('id', 'kind', 'params', 'status', 'progress', 'error',
+              'created_at', 'started_at', 'updated_at', 'finished_at', 'expires_at')
+
+def real(value):
+    """Coerce numbers the way a REAL column does"""
+    return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else value
+
+def now_timestamp(seconds=0):
+    """Same format as SQLite's CURRENT_TIMESTAMP, optionally ``seconds`` from now"""
+    return (datetime.utcnow() + timedelta(seconds=seconds)).strftime('%Y-%m-%d %H:%M:%S')
+
+class Storage:
+    """Interface implemented by every storage engine"""
+
+    # Schema
+    def init_schema(self):
+        raise NotImplementedError
+
+    def seed_exercises(self, exercises=DEFAULT_EXERCISES):
+        raise NotImplementedError
+
+    def ensure_schema(self):
+        """Create the schema and seed exercises unless already done; return True if work was done"""
+        self.init_schema()
+        self.seed_exercises()
+        return True
+
+    # Users and sessions
+    def create_user(self, email, password_hash, name):
+        """Return the new user id; raise DuplicateError if the email is taken"""
+        raise NotImplementedError
+
+    def find_user_by_credentials(self, email, password_hash):
+        raise NotImplementedError
+
+    def update_user(self, user_id, data):
+        raise NotImplementedError
+
+    def create_session(self, user_id, token, expires_at):
+        raise NotImplementedError
+
+    def get_user_by_token(self, token, now):
+        raise NotImplementedError
+
+    def is_session_valid(self, token, now):
+        raise NotImplementedError
+
+    def delete_session(self, token):
+        raise NotImplementedError
+
+    # Exercises
+    def list_exercises(self):
+        raise NotImplementedError
+
+    def add_exercise(self, name, category, equipment):
+        """Return the new exercise id; raise DuplicateError if the name is taken"""
+        raise NotImplementedError
+
+    def list_custom_exercises(self, user_id):
+        raise NotImplementedError
+
+    def add_custom_exercise(self, user_id, name, category, equipment, image_url):
+        """Return (exercise id, change seq); raise DuplicateError if the user has the name"""
+        raise NotImplementedError
+
+    def delete_custom_exercise(self, user_id, exercise_id):
+        """Return the change seq, or None if the user has no such exercise"""
+        raise NotImplementedError
+
+    # Workouts and sets
+    def save_workout(self, user_id, date, notes, exercises, is_rest_day=False):
+        """Create or merge into the workout for a date; return (workout id, merged, change seq)"""
+        raise NotImplementedError
+
+    def set_rest_day(self, user_id, date, is_rest):
+        """Return (workout id, change seq)"""
+        raise NotImplementedError
+
+    def get_workout_by_date(self, user_id, date):
+        raise NotImplementedError
+
+    def get_workouts_by_dates(self, user_id, dates):
+        """Return {date: workout} for the given dates that have one, each shaped like get_workout_by_date"""
+        workouts = {}
+        for date in dates:
+            workout = self.get_workout_by_date(user_id, date)
+            if workout:
+                workouts[date] = workout
+        return workouts
+
+    def list_workouts(self, user_id, start_date=None, end_date=None, limit=None, summary=False, columns=False):
+        """
+        Newest first, at most ``limit`` workouts. ``summary`` leaves each
+        exercise's sets empty and gives their ``set_count``, skipping the set reads.
+        ``columns`` replaces each exercise's sets with ``set_columns``, the
+        column sequences unpack_set_columns gives, for jobs that only aggregate.
+        """
+        raise NotImplementedError
+
+    def get_progress(self, user_id):
+        raise NotImplementedError
+
+    def last_performance(self, user_id, exercise_keys):
+        """
+        Map each (exercise_id, is_custom) to its most recent session as
+        {date, workout_id, notes, sets}, or None if never logged
+        """
+        raise NotImplementedError
+
+    # Weights
+    def add_weight(self, user_id, date, weight):
+        """Return (weight log id, change seq)"""
+        raise NotImplementedError
+
+    def list_weights(self, user_id):
+        raise NotImplementedError
+
+    # Templates
+    def list_templates(self, user_id):
+        raise NotImplementedError
+
+    def add_template(self, user_id, name, exercises):
+        """Return (template id, change seq); raise UnknownExerciseError for an id that resolves to no exercise"""
+        raise NotImplementedError
+
+    def apply_template(self, user_id, template_id, date, prefill=False):
+        """
+        Add a template's exercises to the workout for a date, optionally with
+        weights from each exercise's last performance. Return (workout id,
+        merged, change seq), or None if the user has no such template.
+        Raise UnknownExerciseError if an exercise it names no longer exists.
+        """
+        raise NotImplementedError
+
+    # Volume and latency accounting
+    def user_volume(self, user_id):
+        """Return {counter: rows} for VOLUME_COUNTERS"""
+        raise NotImplementedError
+
+    def list_user_volumes(self):
+        """Return {user_id: {counter: rows}} for every user with any rows"""
+        raise NotImplementedError
+
+    def add_latency_samples(self, histograms):
+        """Add {user_id: {bucket: requests}} to the stored request latency histograms"""
+        raise NotImplementedError
+
+    def latency_histograms(self):
+        """Return {user_id: {bucket: requests}} accumulated across processes and restarts"""
+        raise NotImplementedError
+
+    # Background jobs
+    def create_job(self, user_id, kind, params, data_version, max_active=None, stale_before=None):
+        """
+        Queue a job; ``params`` is a JSON-able dict. Return its id, or None
+        when the user already has ``max_active`` queued or running jobs
+        updated since ``stale_before``, counted atomically with the insert.
+        """
+        raise NotImplementedError
+
+    def get_job(self, job_id, user_id=None, with_result=False):
+        """
+        Return a job as a JOB_FIELDS dict, plus its decoded ``result`` when
+        asked for, or None. ``user_id`` restricts the lookup to its owner.
+        """
+        raise NotImplementedError
+
+    def list_jobs(self, user_id):
+        """Return a user's jobs, newest first, without results"""
+        raise NotImplementedError
+
+    def find_job(self, user_id, kind, params, data_version, now, stale_before):
+        """
+        Return the id of a queued or running job updated since
+        ``stale_before``, or an unexpired done job, with exactly these
+        inputs; else None
+        """
+        raise NotImplementedError
+
+    def start_job(self, job_id):
+        """Mark a queued job running; return False if it was cancelled first"""
+        raise NotImplementedError
+
+    def update_job_progress(self, job_id, progress):
+        """Record a running job's progress (0 to 1); return False once it is no longer running"""
+        raise NotImplementedError
+
+    def finish_job(self, job_id, status, expires_at, result=None, error=None):
+        """Mark a running job 'done' or 'failed', kept until ``expires_at``; return False if it was cancelled"""
+        raise NotImplementedError
+
+    def cancel_job(self, user_id, job_id, expires_at):
+        """Cancel a queued or running job; return False if it is unknown or already finished"""
+        raise NotImplementedError
+
+    def fail_job(self, job_id, expires_at, error):
+        """Fail a queued or running job whose worker is gone; return False if it already finished"""
+        raise NotImplementedError
+
+    def touch_jobs(self, job_ids):
+        """Mark queued or running jobs as still held by a live process"""
+        raise NotImplementedError
+
+    def evict_jobs(self, now, stale_before, expires_at):
+        """
+        Delete jobs that expired by ``now`` and fail unfinished ones not
+        updated since ``stale_before``, whose worker must be gone.
+        Return (deleted, failed).
+        """
+        raise NotImplementedError
+
+    # Sync
+    def sync_cursor(self, user_id):
+        """Return (compacted seq, latest seq) for a user's change log"""
+        raise NotImplementedError
+
+    def changes_since(self, user_id, since, cursor):
+        """Return (entity, entity_id, op) tuples with since < seq <= cursor, oldest first"""
+        raise NotImplementedError
+
+    def change_events(self, user_id, since, cursor):
+        """Like changes_since, as (seq, entity, entity_id, op) tuples"""
+        raise NotImplementedError
+
+    def change_heads(self, positions):
+        """
+        Users with change log entries past ``positions`` ({database: seq}),
+        read with one query per database file; a database missing from
+        ``positions`` starts at its current end. Return the advanced
+        positions and {user_id: latest seq}.
+        """
+        raise NotImplementedError
+
+    def load_sync_entities(self, user_id, ids=None):
+        """Load sync payloads for a user; ``ids`` maps entity -> ids, None loads everything"""
+        raise NotImplementedError
+
+    def sync(self, user_id, since):
+        """Return entities changed since the ``since`` cursor, or a full snapshot"""
+        compacted_seq, cursor = self.sync_cursor(user_id)
+        cursor = max(cursor, compacted_seq)
+
+        # Fresh clients and cursors older than the compacted log get a snapshot
+        if since <= 0 or since < compacted_seq or since > cursor:
+            payload = self.load_sync_entities(user_id)
+            payload.update({'snapshot': True, 'cursor': cursor, 'deleted': {}})
+            return payload
+
+        latest = {}
+        for entity, entity_id, op in self.changes_since(user_id, since, cursor):
+            latest[(entity, entity_id)] = op
+
+        changed = defaultdict(list)
+        deleted = defaultdict(list)
+        for (entity, entity_id), op in latest.items():
+            (deleted if op == 'delete' else changed)[entity].append(entity_id)
+
+        payload = self.load_sync_entities(user_id, changed)
+        if 'custom_exercise' in deleted:
+            deleted['custom_exercise'] = [f'custom_{i}' for i in deleted['custom_exercise']]
+        payload.update({'snapshot': False, 'cursor': cursor, 'deleted': dict(deleted)})
+        return payload
+
+
+class SQLiteStorage(Storage):
+    """setora.db, with per-user tables optionally hash-sharded into separate files"""
+
+    def __init__(self, db_path='setora.db', shard_count=0, shard_dir='shards', result_dir='job_results'):
+        self.db_path = db_path
+        self.shard_count = shard_count  # 0 keeps per-user tables in db_path
+        self.shard_dir = shard_dir
+        self.result_dir = result_dir    # job results over JOB_RESULT_INLINE_BYTES
+        self._ready_shards = set()
+
+    # Connections and shard routing
+    def connect_db(self):
+        """Connect to the directory database (users, sessions, exercises)"""
+        return sqlite3.connect(self.db_path)
+
+    def shard_for_user(self, user_id, shard_count=None):
+        """Hash a user onto one of ``shard_count`` shard files"""
+        return zlib.crc32(str(user_id).encode()) % (shard_count or self.shard_count)
+
+    def shard_path(self, shard):
+        return os.path.join(self.shard_dir, f'setora-{shard:03d}.db')
+
+    def shard_files(self):
+        """Every shard file on disk, including ones left from an earlier shard count"""
+        return sorted(glob.glob(os.path.join(self.shard_dir, 'setora-*.db')))
+
+    def open_shard(self, shard):
+        """Connect to a shard file, creating its schema on first use"""
+        path = self.shard_path(shard)
+        if path not in self._ready_shards:
+            os.makedirs(self.shard_dir, exist_ok=True)
+            conn = sqlite3.connect(path)
+            if schema_version(conn) != SCHEMA_VERSION:
+                conn.execute('PRAGMA journal_mode = WAL')
+                c = conn.cursor()
+                self.create_user_tables(c)
+                self.recount_volume(c)
+                self.rebuild_last_performance(c)
+                conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+                conn.commit()
+            self._ready_shards.add(path)
+            return conn
+        return sqlite3.connect(path)
+
+    def get_user_shard(self, user_id):
+        """Look up the shard holding a user's data, assigning one on first use"""
+        conn = self.connect_db()
+        c = conn.cursor()
+        c.execute('SELECT shard FROM user_shards WHERE user_id = ?', (user_id,))
+        row = c.fetchone()
+        if not row:
+            c.execute('INSERT OR IGNORE INTO user_shards (user_id, shard) VALUES (?, ?)',
+                      (user_id, self.shard_for_user(user_id)))
+            conn.commit()
+            c.execute('SELECT shard FROM user_shards WHERE user_id = ?', (user_id,))
+            row = c.fetchone()
+        conn.close()
+        return row[0]
+
+    def connect_user_db(self, user_id):
+        """Connect to the database holding a user's workouts, sets, weights and templates"""
+        if not self.shard_count:
+            return sqlite3.connect(self.db_path)
+        conn = self.open_shard(self.get_user_shard(user_id))
+        # Global tables such as exercises resolve through the attached directory
+        conn.execute('ATTACH DATABASE ? AS directory', (self.db_path,))
+        return conn
+
+    # Schema
+    def ensure_schema(self):
+        """
+        One PRAGMA read when this schema version is already in place, so
+        workers, CLIs and tests starting against a ready database skip the DDL
+        """
+        conn = self.connect_db()
+        version = schema_version(conn)
+        conn.close()
+        if version == SCHEMA_VERSION:
+            return False
+
+        self.init_schema()
+        self.seed_exercises()
+
+        # Recorded last: a crash half way through simply redoes the idempotent work
+        conn = self.connect_db()
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        conn.close()
+        return True
+
+    def init_schema(self):
+        conn = self.connect_db()
+        c = conn.cursor()
+
+        # Persistent per file. Readers, including online backups, no longer block writers
+        c.execute('PRAGMA journal_mode = WAL')
+
+        # Users table with authentication
+        c.execute('''CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT NOT NULL UNIQUE,
+            password_hash TEXT NOT NULL,
+            name TEXT NOT NULL,
+            age INTEGER,
+            gender TEXT,
+            height REAL,
+            weight REAL,
+            goal TEXT,
+            unit_preference TEXT DEFAULT 'kg',
+            theme_preference TEXT DEFAULT 'light',
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )''')
+
+        # Sessions table
+        c.execute('''CREATE TABLE IF NOT EXISTS sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            token TEXT NOT NULL UNIQUE,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            expires_at TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )''')
+
+        # Exercises library
+        c.execute('''CREATE TABLE IF NOT EXISTS exercises (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            category TEXT NOT NULL,
+            equipment TEXT
+        )''')
+
+        # Explicit user -> shard assignments when sharded storage is enabled
+        c.execute('''CREATE TABLE IF NOT EXISTS user_shards (
+            user_id INTEGER PRIMARY KEY,
+            shard INTEGER NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )''')
+
+        # Custom exercise ids, referenced by workouts, templates and clients. Every
+        # file takes them from here, so they are unique across shards and a user's
+        # exercises keep their ids when moved to another shard
+        c.execute('''CREATE TABLE IF NOT EXISTS custom_exercise_ids (
+            id INTEGER PRIMARY KEY AUTOINCREMENT
+        )''')
+
+        # Request latency histograms per user, added to by every app process
+        c.execute('''CREATE TABLE IF NOT EXISTS request_latency (
+            user_id INTEGER NOT NULL,
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, bucket)
+        ) WITHOUT ROWID''')
+
+        # Background jobs (see jobs.py), results kept as JSON until expires_at
+        c.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            params TEXT NOT NULL,
+            data_version INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            progress REAL NOT NULL DEFAULT 0,
+            result TEXT,
+            error TEXT,
+            result_file TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            started_at TEXT,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            finished_at TEXT,
+            expires_at TEXT,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs(user_id, kind)')
+        c.execute('PRAGMA table_info(jobs)')
+        if 'result_file' not in {row[1] for row in c.fetchall()}:
+            c.execute('ALTER TABLE jobs ADD COLUMN result_file TEXT')
+
+        # Per-user tables live here too unless they are sharded out
+        self.create_user_tables(c)
+        self.recount_volume(c)
+        self.rebuild_last_performance(c)
+        self._raise_custom_exercise_ids(c)
+
+        conn.commit()
+        conn.close()
+
+    def _raise_custom_exercise_ids(self, c):
+        """Start custom_exercise_ids above every id already issued by setora.db or a shard's own AUTOINCREMENT"""
+        issued = c.execute('SELECT COALESCE(MAX(id), 0) FROM user_exercises').fetchone()[0]
+        for path in self.shard_files():
+            conn = sqlite3.connect(path)
+            try:
+                issued = max(issued, conn.execute('SELECT COALESCE(MAX(id), 0) FROM user_exercises').fetchone()[0])
+            except sqlite3.OperationalError:
+                pass
+            conn.close()
+        if c.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'custom_exercise_ids'",
+                     (issued,)).rowcount == 0:
+            c.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('custom_exercise_ids', ?)", (issued,))
+
+    @staticmethod
+    def create_user_tables(c):
+        """Create the per-user tables, shared by setora.db and every shard file"""
+        # Workouts
+        c.execute('''CREATE TABLE IF NOT EXISTS workouts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            notes TEXT,
+            is_rest_day INTEGER DEFAULT 0,
+            merged_at TEXT,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )''')
+
+        # Workout exercises
+        c.execute('''CREATE TABLE IF NOT EXISTS workout_exercises (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            workout_id INTEGER NOT NULL,
+            exercise_id INTEGER NOT NULL,
+            sets INTEGER,
+            reps INTEGER,
+            weight REAL,
+            duration REAL,
+            notes TEXT,
+            is_custom INTEGER DEFAULT 0,
+            order_index INTEGER DEFAULT 0,
+            set_data BLOB,
+            volume REAL,
+            FOREIGN KEY (workout_id) REFERENCES workouts(id),
+            FOREIGN KEY (exercise_id) REFERENCES exercises(id)
+        )''')
+
+        # Individual sets
+        c.execute('''CREATE TABLE IF NOT EXISTS workout_sets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            workout_exercise_id INTEGER NOT NULL,
+            set_number INTEGER NOT NULL,
+            reps INTEGER,
+            weight REAL,
+            duration REAL,
+            notes TEXT,
+            FOREIGN KEY (workout_exercise_id) REFERENCES workout_exercises(id) ON DELETE CASCADE
+        )''')
+
+        # Custom exercises
+        c.execute('''CREATE TABLE IF NOT EXISTS user_exercises (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            category TEXT NOT NULL,
+            equipment TEXT,
+            image_url TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            UNIQUE(user_id, name)
+        )''')
+
+        # Weight logs
+        c.execute('''CREATE TABLE IF NOT EXISTS weight_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            weight REAL NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )''')
+
+        # Templates
+        c.execute('''CREATE TABLE IF NOT EXISTS workout_templates (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            exercises TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )''')
+
+        # Most recent workout exercise per user and exercise, maintained on insert
+        c.execute('''CREATE TABLE IF NOT EXISTS last_performance (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            exercise_id INTEGER NOT NULL,
+            is_custom INTEGER NOT NULL DEFAULT 0,
+            workout_exercise_id INTEGER NOT NULL,
+            date TEXT NOT NULL,
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            FOREIGN KEY (workout_exercise_id) REFERENCES workout_exercises(id),
+            UNIQUE(user_id, exercise_id, is_custom)
+        )''')
+
+        # Append-only change log used by delta sync
+        c.execute('''CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            entity TEXT NOT NULL,
+            entity_id INTEGER NOT NULL,
+            op TEXT NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )''')
+
+        # Highest sequence number dropped from a user's change log by compaction,
+        # and the entries the user logged since their log was last compacted
+        c.execute('''CREATE TABLE IF NOT EXISTS sync_state (
+            user_id INTEGER PRIMARY KEY,
+            compacted_seq INTEGER NOT NULL DEFAULT 0,
+            uncompacted INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        )''')
+
+        # Columns added after the first release; CREATE TABLE IF NOT EXISTS skips them on old files
+        c.execute('PRAGMA table_info(workout_exercises)')
+        existing = {row[1] for row in c.fetchall()}
+        for column, column_type in (('set_data', 'BLOB'), ('volume', 'REAL')):
+            if column not in existing:
+                c.execute(f'ALTER TABLE workout_exercises ADD COLUMN {column} {column_type}')
+        c.execute('PRAGMA table_info(sync_state)')
+        if 'uncompacted' not in {row[1] for row in c.fetchall()}:
+            c.execute('ALTER TABLE sync_state ADD COLUMN uncompacted INTEGER NOT NULL DEFAULT 0')
+
+        c.execute('CREATE INDEX IF NOT EXISTS idx_user_exercises_user ON user_exercises(user_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_workout_sets_exercise ON workout_sets(workout_exercise_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_workouts_date ON workouts(user_id, date)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_workout_exercises_workout ON workout_exercises(workout_id, exercise_id, is_custom)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_change_log_user ON change_log(user_id, seq)')
+
+        # Row counts per user for the volume report and soft limits
+        c.execute(f'''CREATE TABLE IF NOT EXISTS user_volume (
+            user_id INTEGER PRIMARY KEY,
+            {', '.join(f'{counter} INTEGER NOT NULL DEFAULT 0' for counter in VOLUME_COUNTERS)}
+        )''')
+
+    @staticmethod
+    def recount_volume(c):
+        """
+        Rebuild user_volume from the counted tables present in this file, in
+        one write transaction so concurrent writes are neither missed nor
+        counted twice. Runs when the schema version changes.
+        """
+        if not c.connection.in_transaction:
+            c.execute('BEGIN IMMEDIATE')
+        c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        tables = {row[0] for row in c.fetchall()}
+        for counter, (table, query) in VOLUME_RECOUNTS.items():
+            if table not in tables:
+                continue
+            c.execute(f'UPDATE user_volume SET {counter} = 0')
+            # WHERE true keeps ON CONFLICT from parsing as part of the SELECT
+            c.execute(f'''INSERT INTO user_volume (user_id, {counter}) SELECT * FROM ({query}) WHERE true
+                          ON CONFLICT(user_id) DO UPDATE SET {counter} = excluded.{counter}''')
+
+    @staticmethod
+    def rebuild_last_performance(c):
+        """
+        Point last_performance at each user's latest entry per exercise, so
+        history logged before the table existed is found too. Runs with
+        recount_volume when the schema version changes.
+        """
+        if not c.connection.in_transaction:
+            c.execute('BEGIN IMMEDIATE')
+        c.execute('DELETE FROM last_performance')
+        # Newest first, so the first row per exercise wins; a repeat in one workout ends on its last entry
+        c.execute('''INSERT OR IGNORE INTO last_performance
+                     (user_id, exercise_id, is_custom, workout_exercise_id, date)
+                     SELECT w.user_id, we.exercise_id, COALESCE(we.is_custom, 0), we.id, w.date
+                     FROM workout_exercises we
+                     JOIN workouts w ON w.id = we.workout_id
+                     WHERE COALESCE(we.is_custom, 0) = 0
+                     OR we.exercise_id IN (SELECT id FROM user_exercises WHERE user_id = w.user_id)
+                     ORDER BY w.date DESC, we.order_index DESC''')
+
+    def seed_exercises(self, exercises=DEFAULT_EXERCISES):
+        conn = self.connect_db()
+        c = conn.cursor()
+
+        # Check if exercises exist; OR IGNORE covers two workers seeding at once
+        c.execute('SELECT COUNT(*) FROM exercises')
+        if c.fetchone()[0] == 0:
+            c.executemany('INSERT OR IGNORE INTO exercises (name, category, equipment) VALUES (?, ?, ?)', exercises)
+            conn.commit()
+
+        conn.close()
+
+    # Change log
+    def _log_change(self, c, user_id, entity, entity_id, op='upsert'):
+        """Append a change log entry inside the caller's transaction"""
+        c.execute('INSERT INTO change_log (user_id, entity, entity_id, op) VALUES (?, ?, ?, ?)',
+                  (user_id, entity, entity_id, op))
+        seq = c.lastrowid
+        # Counted per user: seq is shared by every user in the file
+        c.execute('''INSERT INTO sync_state (user_id, uncompacted) VALUES (?, 1)
+                     ON CONFLICT(user_id) DO UPDATE SET uncompacted = uncompacted + 1''', (user_id,))
+        c.execute('SELECT uncompacted FROM sync_state WHERE user_id = ?', (user_id,))
+        if c.fetchone()[0] >= SYNC_COMPACT_EVERY:
+            self._compact_change_log(c, user_id)
+        return seq
+
+    def _compact_change_log(self, c, user_id):
+        """Drop superseded entries and trim the log to SYNC_LOG_RETENTION entries"""
+        # Only the latest entry per entity matters to a client, whatever its cursor
+        c.execute('''DELETE FROM change_log
+                     WHERE user_id = ? AND seq NOT IN (
+                         SELECT MAX(seq) FROM change_log
+                         WHERE user_id = ?
+                         GROUP BY entity, entity_id)''', (user_id, user_id))
+
+        # Anything older than the retention window forces a snapshot for stale cursors
+        c.execute('''SELECT seq FROM change_log WHERE user_id = ?
+                     ORDER BY seq DESC LIMIT 1 OFFSET ?''', (user_id, SYNC_LOG_RETENTION))
+        row = c.fetchone()
+        if row:
+            c.execute('DELETE FROM change_log WHERE user_id = ? AND seq <= ?', (user_id, row[0]))
+            c.execute('''INSERT INTO sync_state (user_id, compacted_seq) VALUES (?, ?)
+                         ON CONFLICT(user_id) DO UPDATE SET compacted_seq = excluded.compacted_seq''',
+                      (user_id, row[0]))
+        c.execute('UPDATE sync_state SET uncompacted = 0 WHERE user_id = ?', (user_id,))
+
+    # Volume counters
+    @staticmethod
+    def _count_volume(c, user_id, **deltas):
+        """Add to a user's user_volume counters inside the caller's transaction"""
+        deltas = {counter: delta for counter, delta in deltas.items() if delta}
+        if not deltas:
+            return
+        c.execute(f'''INSERT INTO user_volume (user_id, {', '.join(deltas)}) VALUES (?{', ?' * len(deltas)})
+                      ON CONFLICT(user_id) DO UPDATE SET
+                      {', '.join(f'{counter} = {counter} + excluded.{counter}' for counter in deltas)}''',
+                  (user_id, *deltas.values()))
+
+    # Users and sessions
+    @staticmethod
+    def _user_dict(user):
+        return {
+            'id': user[0], 'email': user[1], 'name': user[3], 'age': user[4],
+            'gender': user[5], 'height': user[6], 'weight': user[7],
+            'goal': user[8], 'unit_preference': user[9], 'theme_preference': user[10]
+        }
+
+    def create_user(self, email, password_hash, name):
+        conn = self.connect_db()
+        c = conn.cursor()
+        try:
+            c.execute('''INSERT INTO users (email, password_hash, name, theme_preference)
+                         VALUES (?, ?, ?, ?)''',
+                      (email, password_hash, name, 'light'))
+        except sqlite3.IntegrityError:
+            conn.close()
+            raise DuplicateError('Email already exists')
+        user_id = c.lastrowid
+        conn.commit()
+        conn.close()
+        return user_id
+
+    def find_user_by_credentials(self, email, password_hash):
+        conn = self.connect_db()
+        c = conn.cursor()
+        c.execute('SELECT * FROM users WHERE email = ? AND password_hash = ?',
+                  (email, password_hash))
+        user = c.fetchone()
+        conn.close()
+        return self._user_dict(user) if user else None
+
+    def update_user(self, user_id, data):
+        conn = self.connect_db()
+        c = conn.cursor()
+        c.execute('''UPDATE users SET name=?, age=?, gender=?, height=?, weight=?, goal=?, unit_preference=?, theme_preference=?
+                     WHERE id=?''',
+                  tuple(data.get(field) for field in USER_FIELDS) + (user_id,))
+        conn.commit()
+        conn.close()
+
+    def create_session(self, user_id, token, expires_at):
+        conn = self.connect_db()
+        c = conn.cursor()
+        c.execute('INSERT INTO sessions (user_id, token, expires_at) VALUES (?, ?, ?)',
+                  (user_id, token, expires_at))
+        self._count_volume(c, user_id, sessions=1)
+        conn.commit()
+        conn.close()
+
+    def get_user_by_token(self, token, now):
+        conn = self.connect_db()
+        c = conn.cursor()
+        c.execute('''SELECT u.* FROM users u
+                     JOIN sessions s ON u.id = s.user_id
+                     WHERE s.token = ? AND s.expires_at > ?''',
+                  (token, now))
+        user = c.fetchone()
+        conn.close()
+        return self._user_dict(user) if user else None
+
+    def is_session_valid(self, token, now):
+        conn = self.connect_db()
+        c = conn.cursor()
+        c.execute('SELECT * FROM sessions WHERE token = ? AND expires_at > ?',
+                  (token, now))
+        session = c.fetchone()
+        conn.close()
+        return session is not None
+
+    def delete_session(self, token):
+        conn = self.connect_db()
+        c = conn.cursor()
+        c.execute('SELECT user_id FROM sessions WHERE token = ?', (token,))
+        row = c.fetchone()
+        if row:
+            c.execute('DELETE FROM sessions WHERE token = ?', (token,))
+            self._count_volume(c, row[0], sessions=-1)
+        conn.commit()
+        conn.close()
+
+    # Exercises
+    def list_exercises(self):
+        conn = self.connect_db()
+        c = conn.cursor()
+        c.execute('SELECT id, name, category, equipment FROM exercises ORDER BY category, name')
+        exercises = [{'id': row[0], 'name': row[1], 'category': row[2], 'equipment': row[3]}
+                     for row in c.fetchall()]
+        conn.close()
+        return exercises
+
+    def add_exercise(self, name, category, equipment):
+        conn = self.connect_db()
+        c = conn.cursor()
+        try:
+            c.execute('INSERT INTO exercises (name, category, equipment) VALUES (?, ?, ?)',
+                      (name, category, equipment))
+        except sqlite3.IntegrityError:
+            conn.close()
+            raise DuplicateError('Exercise already exists')
+        conn.commit()
+        exercise_id = c.lastrowid
+        conn.close()
+        return exercise_id
+
+    def list_custom_exercises(self, user_id):
+        conn = self.connect_user_db(user_id)
+        c = conn.cursor()
+        c.execute('''SELECT id, name, category, equipment, image_url
+                     FROM user_exercises
+                     WHERE user_id = ?
+                     ORDER BY category, name''', (user_id,))
+        custom = [{'id': f'custom_{row[0]}', 'name': row[1], 'category': row[2],
+                   'equipment': row[3], 'image_url': row[4], 'is_custom': True}
+                  for row in c.fetchall()]
+        conn.close()
+        return custom
+
+    def add_custom_exercise(self, user_id, name, category, equipment, image_url):
+        conn = self.connect_user_db(user_id)
+        c = conn.cursor()
+        # Sharded: setora.db is attached as directory
+        c.execute(f'INSERT INTO {"directory" if self.shard_count else "main"}.custom_exercise_ids DEFAULT VALUES')
+        exercise_id = c.lastrowid
+        try:
+            c.execute('''INSERT INTO user_exercises (id, user_id, name, category, equipment, image_url)
+                         VALUES (?, ?, ?, ?, ?, ?)''',
+                      (exercise_id, user_id, name, category, equipment, image_url))
+        except sqlite3.IntegrityError:
+            conn.close()
+            raise DuplicateError('You already have an exercise with this name')
+        self._count_volume(c, user_id, custom_exercises=1)
+        seq = self._log_change(c, user_id, 'custom_exercise', exercise_id)
+        conn.commit()
+        conn.close()
+        return exercise_id, seq
+
+    def delete_custom_exercise(self, user_id, exercise_id):
+        conn = self.connect_user_db(user_id)
+        c = conn.cursor()
+
+        # Verify ownership
+        c.execute('SELECT id FROM user_exercises WHERE id = ? AND user_id = ?',
+                  (exercise_id, user_id))
+        if not c.fetchone():
+            conn.close()
+            return None
+
+        c.execute('DELETE FROM user_exercises WHERE id = ?', (exercise_id,))
+        c.execute('DELETE FROM last_performance WHERE user_id = ? AND exercise_id = ? AND is_custom = 1',
+                  (user_id, exercise_id))
+        self._count_volume(c, user_id, custom_exercises=-1)
+        seq = self._log_change(c, user_id, 'custom_exercise', exercise_id, 'delete')
+        conn.commit()
+        conn.close()
+        return seq
+
+    # Workouts and sets
+    def save_workout(self, user_id, date, notes, exercises, is_rest_day=False):
+        conn = self.connect_user_db(user_id)
+        c = conn.cursor()
+
+        # Check if workout already exists for this date
+        c.execute('SELECT id FROM workouts WHERE user_id = ? AND date = ?',
+                  (user_id, date))
+        existing = c.fetchone()
+
+        if is_rest_day:
+            if existing:
+                # Update existing workout to rest day
+                c.execute('UPDATE workouts SET is_rest_day = 1, notes = ? WHERE id = ?',
+                          (notes, existing[0]))
+                workout_id = existing[0]
+            else:
+                # Create new rest day workout
+                c.execute('INSERT INTO workouts (user_id, date, notes, is_rest_day) VALUES (?, ?, ?, 1)',
+                          (user_id, date, notes))
+                workout_id = c.lastrowid
+                self._count_volume(c, user_id, workouts=1)
+
+            seq = self._log_change(c, user_id, 'workout', workout_id)
+            conn.commit()
+            conn.close()
+            return workout_id, bool(existing), seq
+
+        workout_id = self._merge_workout(c, user_id, date, notes, existing)
+        self._insert_exercises(c, user_id, date, workout_id, exercises)
+
+        # Sets are only served nested in their workout, so they sync as a workout change
+        seq = self._log_change(c, user_id, 'workout', workout_id)
+        conn.commit()
+        conn.close()
+        return workout_id, bool(existing), seq
+
+    @staticmethod
+    def _merge_workout(c, user_id, date, notes, existing):
+        """Return the id of a regular workout for date, reopening or creating it"""
+        if existing:
+            # MERGE MODE: Add exercises to existing workout
+            c.execute('UPDATE workouts SET merged_at = ?, is_rest_day = 0 WHERE id = ?',
+                      (datetime.now().isoformat(), existing[0]))
+            return existing[0]
+
+        # CREATE MODE: New workout
+        c.execute('INSERT INTO workouts (user_id, date, notes, is_rest_day) VALUES (?, ?, ?, 0)',
+                  (user_id, date, notes))
+        workout_id = c.lastrowid
+        # Read first: the counter upsert moves lastrowid when it inserts the user's row
+        SQLiteStorage._count_volume(c, user_id, workouts=1)
+        return workout_id
+
+    @staticmethod
+    def _insert_exercises(c, user_id, date, workout_id, exercises):
+        """Append exercises to a workout with one INSERT per table, whatever their count"""
+        if not exercises:
+            return
+
+        # Get current max order index for this workout
+        c.execute('SELECT COALESCE(MAX(order_index), 0) FROM workout_exercises WHERE workout_id = ?',
+                  (workout_id,))
+        current_max_order = c.fetchone()[0]
+
+        rows = []
+        row_sets = {}
+        packed_count = 0
+        for idx, ex in enumerate(exercises):
+            exercise_id, is_custom = parse_exercise_id(ex['exercise_id'])
+            order_index = current_max_order + idx + 1
+            sets = ex.get('sets', [])
+            # Sets are packed inline when possible, see pack_sets
+            set_data = pack_sets(sets)
+            if set_data is None:
+                row_sets[order_index] = sets
+            else:
+                packed_count += len(sets)
+            rows.append((workout_id, exercise_id, ex.get('notes', ''), is_custom, order_index,
+                         set_data, columns_volume(*unpack_set_columns(set_data)[1:3]) if set_data is not None else None))
+
+        c.executemany('''INSERT INTO workout_exercises
+                       (workout_id, exercise_id, notes, is_custom, order_index, set_data, volume)
+                       VALUES (?, ?, ?, ?, ?, ?, ?)''', rows)
+
+        if row_sets:
+            c.execute('SELECT id, order_index FROM workout_exercises WHERE workout_id = ? AND order_index > ?',
+                      (workout_id, current_max_order))
+            c.executemany('''INSERT INTO workout_sets
+                           (workout_exercise_id, set_number, reps, weight, duration, notes)
+                           VALUES (?, ?, ?, ?, ?, ?)''',
+                          [(we_id, set_data['set_number'], set_data.get('reps'), set_data.get('weight'),
+                            set_data.get('duration'), set_data.get('notes', ''))
+                           for we_id, order_index in c.fetchall() if order_index in row_sets
+                           for set_data in row_sets[order_index]])
+
+        SQLiteStorage._count_volume(c, user_id, workout_exercises=len(rows), packed_sets=packed_count,
+                                    workout_sets=sum(len(sets) for sets in row_sets.values()))
+
+        # Repoint each exercise's last performance here, unless it was logged on a later date.
+        # Rows are applied in order, so an exercise repeated in this workout ends on its last entry.
+        c.execute('''INSERT INTO last_performance (user_id, exercise_id, is_custom, workout_exercise_id, date)
+                     SELECT ?, exercise_id, is_custom, id, ? FROM workout_exercises
+                     WHERE workout_id = ? AND order_index > ?
+                     ORDER BY order_index
+                     ON CONFLICT(user_id, exercise_id, is_custom) DO UPDATE
+                     SET workout_exercise_id = excluded.workout_exercise_id, date = excluded.date
+                     WHERE excluded.date >= last_performance.date''',
+                  (user_id, date, workout_id, current_max_order))
+
+    def set_rest_day(self, user_id, date, is_rest):
+        conn = self.connect_user_db(user_id)
+        c = conn.cursor()
+
+        c.execute('SELECT id FROM workouts WHERE user_id = ? AND date = ?',
+                  (user_id, date))
+        existing = c.fetchone()
+
+        if existing:
+            c.execute('UPDATE workouts SET is_rest_day = ? WHERE id = ?',
+                      (1 if is_rest else 0, existing[0]))
+            workout_id = existing[0]
+        else:
+            c.execute('INSERT INTO workouts (user_id, date, is_rest_day) VALUES (?, ?, ?)',
+                      (user_id, date, 1 if is_rest else 0))
+            workout_id = c.lastrowid
+            self._count_volume(c, user_id, workouts=1)
+
+        seq = self._log_change(c, user_id, 'workout', workout_id)
+        conn.commit()
+        conn.close()
+        return workout_id, seq
+
+    @staticmethod
+    def _attach_sets(c, ex, summary=False, columns=False):
+        """Decode packed sets, or read rows for exercises stored one row per set"""
+        set_data = ex.pop('set_data', None)
+        ex.pop('volume', None)
+        if summary:
+            # Empty rather than absent, so clients that map over sets still work
+            ex['sets'] = []
+            return
+        if set_data is not None:
+            # Column views share the BLOB; nothing is decoded per set
+            if columns:
+                ex['set_columns'] = unpack_set_columns(set_data)
+            else:
+                ex['sets'] = unpack_sets(set_data, ex['id'])
+            return
+        c.execute('''SELECT * FROM workout_sets
+                    WHERE workout_exercise_id = ?
+                    ORDER BY set_number''', (ex['id'],))
+        sets = [dict(s) for s in c.fetchall()]
+        if columns:
+            ex['set_columns'] = set_columns(sets)
+        else:
+            ex['sets'] = sets
+
+    def get_workout_by_date(self, user_id, date):
+        return self.get_workouts_by_dates(user_id, [date]).get(date)
+
+    def get_workouts_by_dates(self, user_id, dates):
+        dates = list(dict.fromkeys(dates))
+        if not dates:
+            return {}
+
+        conn = self.connect_user_db(user_id)
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+
+        # Every query below is scoped by the same workout id subquery, so the
+        # count stays at four however many days and exercises are involved
+        scope = f"SELECT id FROM workouts WHERE user_id = ? AND date IN ({','.join('?' * len(dates))})"
+        params = [user_id] + dates
+
+        c.execute(f"SELECT * FROM workouts WHERE user_id = ? AND date IN ({','.join('?' * len(dates))})", params)
+        workouts = {row['id']: dict(row) for row in c.fetchall()}
+        if not workouts:
+            conn.close()
+            return {}
+        for workout in workouts.values():
+            workout['exercises'] = []
+
+        # Built-in exercises, then custom ones, each in order within its workout
+        c.execute(f'''SELECT we.*, e.name, e.category, e.equipment
+                      FROM workout_exercises we
+                      JOIN exercises e ON we.exercise_id = e.id
+                      WHERE we.workout_id IN ({scope}) AND we.is_custom = 0
+                      ORDER BY we.workout_id, we.order_index''', params)
+        exercises = [dict(row) for row in c.fetchall()]
+
+        c.execute(f'''SELECT we.*, ue.name, ue.category, ue.equipment, ue.image_url
+                      FROM workout_exercises we
+                      JOIN user_exercises ue ON we.exercise_id = ue.id AND ue.user_id = ?
+                      WHERE we.workout_id IN ({scope}) AND we.is_custom = 1
+                      ORDER BY we.workout_id, we.order_index''', [user_id] + params)
+        for row in c.fetchall():
+            ex = dict(row)
+            ex['is_custom'] = True
+            exercises.append(ex)
+
+        row_stored = {}
+        for ex in exercises:
+            set_data = ex.pop('set_data')
+            ex.pop('volume')
+            if set_data is not None:
+                ex['sets'] = unpack_sets(set_data, ex['id'])
+            else:
+                ex['sets'] = []
+                row_stored[ex['id']] = ex
+            workouts[ex['workout_id']]['exercises'].append(ex)
+
+        if row_stored:
+            c.execute(f'''SELECT * FROM workout_sets
+                          WHERE workout_exercise_id IN (SELECT id FROM workout_exercises
+                                                        WHERE workout_id IN ({scope}) AND set_data IS NULL)
+                          ORDER BY workout_exercise_id, set_number''', params)
+            for row in c.fetchall():
+                ex = row_stored.get(row['workout_exercise_id'])
+                if ex is not None:
+                    ex['sets'].append(dict(row))
+
+        conn.close()
+        return {workout['date']: workout for workout in workouts.values()}
+
+    def _build_workout(self, c, row, summary=False, columns=False):
+        """Hydrate a workouts row with its exercises, sets (or set counts) and day type"""
+        workout = dict(row)
+
+        if workout['is_rest_day']:
+            workout['day_type'] = 'Rest Day'
+            workout['exercises'] = []
+            return workout
+
+        # Summaries count sets in the same query instead of reading them
+        set_count = f''', CASE WHEN we.set_data IS NULL
+                         THEN (SELECT COUNT(*) FROM workout_sets ws WHERE ws.workout_exercise_id = we.id)
+                         ELSE LENGTH(we.set_data) / {8 * len(SET_COLUMNS)} END AS set_count''' if summary else ''
+
+        # Get built-in exercises
+        c.execute(f'''SELECT we.*, e.name, e.category{set_count}
+                    FROM workout_exercises we
+                    JOIN exercises e ON we.exercise_id = e.id
+                    WHERE we.workout_id = ? AND we.is_custom = 0
+                    ORDER BY we.order_index''', (workout['id'],))
+
+        exercises = []
+        categories = set()
+
+        for ex_row in c.fetchall():
+            ex = dict(ex_row)
+
+            # Get sets
+            self._attach_sets(c, ex, summary, columns)
+
+            exercises.append(ex)
+            categories.add(ex['category'])
+
+        # Get custom exercises
+        c.execute(f'''SELECT we.*, ue.name, ue.category{set_count}
+                    FROM workout_exercises we
+                    JOIN user_exercises ue ON we.exercise_id = ue.id AND ue.user_id = ?
+                    WHERE we.workout_id = ? AND we.is_custom = 1
+                    ORDER BY we.order_index''', (workout['user_id'], workout['id']))
+
+        for ex_row in c.fetchall():
+            ex = dict(ex_row)
+            ex['is_custom'] = True
+
+            self._attach_sets(c, ex, summary, columns)
+
+            exercises.append(ex)
+            categories.add(ex['category'])
+
+        workout['exercises'] = exercises
+        workout['day_type'] = day_type(categories)
+        return workout
+
+    def list_workouts(self, user_id, start_date=None, end_date=None, limit=None, summary=False, columns=False):
+        conn = self.connect_user_db(user_id)
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+
+        query = 'SELECT * FROM workouts WHERE user_id=?'
+        params = [user_id]
+
+        if start_date:
+            query += ' AND date >= ?'
+            params.append(start_date)
+        if end_date:
+            query += ' AND date <= ?'
+            params.append(end_date)
+
+        query += ' ORDER BY date DESC'
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit)
+
+        c.execute(query, params)
+        workouts = [self._build_workout(c, row, summary, columns) for row in c.fetchall()]
+
+        conn.close()
+        return workouts
+
+    def get_progress(self, user_id):
+        conn = self.connect_user_db(user_id)
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+
+        # Volume stats (exclude rest days); packed exercises carry a precomputed volume
+        c.execute('''SELECT w.date, COALESCE(e.category, ue.category) as category,
+                     SUM(COALESCE(ws.weight * ws.reps, we.volume)) as volume,
+                     COUNT(DISTINCT we.id) as exercise_count
+                     FROM workouts w
+                     JOIN workout_exercises we ON w.id = we.workout_id
+                     LEFT JOIN exercises e ON we.exercise_id = e.id AND we.is_custom = 0
+                     LEFT JOIN user_exercises ue ON we.exercise_id = ue.id AND we.is_custom = 1 AND ue.user_id = w.user_id
+                     LEFT JOIN workout_sets ws ON we.id = ws.workout_exercise_id
+                     WHERE w.user_id = ? AND w.is_rest_day = 0
+                     GROUP BY w.date, COALESCE(e.category, ue.category)
+                     ORDER BY w.date, category''', (user_id,))
+
+        workout_stats = [dict(row) for row in c.fetchall()]
+
+        # Category frequency (exclude rest days)
+        c.execute('''SELECT COALESCE(e.category, ue.category) as category,
+                     COUNT(DISTINCT w.date) as frequency
+                     FROM workouts w
+                     JOIN workout_exercises we ON w.id = we.workout_id
+                     LEFT JOIN exercises e ON we.exercise_id = e.id AND we.is_custom = 0
+                     LEFT JOIN user_exercises ue ON we.exercise_id = ue.id AND we.is_custom = 1 AND ue.user_id = w.user_id
+                     WHERE w.user_id = ? AND w.is_rest_day = 0
+                     GROUP BY COALESCE(e.category, ue.category)
+                     ORDER BY category''', (user_id,))
+
+        category_freq = [dict(row) for row in c.fetchall()]
+
+        conn.close()
+        return {
+            'workout_stats': workout_stats,
+            'category_frequency': category_freq
+        }
+
+    # Weights
+    def add_weight(self, user_id, date, weight):
+        conn = self.connect_user_db(user_id)
+        c = conn.cursor()
+        c.execute('INSERT INTO weight_logs (user_id, date, weight) VALUES (?, ?, ?)',
+                  (user_id, date, weight))
+        weight_log_id = c.lastrowid
+        self._count_volume(c, user_id, weight_logs=1)
+        seq = self._log_change(c, user_id, 'weight_log', weight_log_id)
+        conn.commit()
+        conn.close()
+        return weight_log_id, seq
+
+    def list_weights(self, user_id):
+        conn = self.connect_user_db(user_id)
+        c = conn.cursor()
+        c.execute('SELECT * FROM weight_logs WHERE user_id=? ORDER BY date DESC',
+                  (user_id,))
+        logs = [{'id': row[0], 'date': row[2], 'weight': row[3]}
+                for row in c.fetchall()]
+        conn.close()
+        return logs
+
+    # Templates
+    def list_templates(self, user_id):
+        conn = self.connect_user_db(user_id)
+        c = conn.cursor()
+        c.execute('SELECT * FROM workout_templates WHERE user_id=?', (user_id,))
+        templates = [{'id': row[0], 'name': row[2], 'exercises': parse_template(row[3])}
+                     for row in c.fetchall()]
+        conn.close()
+        return templates
+
+    @staticmethod
+    def _check_template_exercises(c, user_id, exercises):
+        """Raise UnknownExerciseError unless every exercise is in the library or is one of the user's own"""
+        keys = template_exercise_keys(exercises)
+        found = set()
+        for is_custom, query, params in (
+                (0, 'SELECT id FROM exercises WHERE id IN ({})', []),
+                (1, 'SELECT id FROM user_exercises WHERE user_id = ? AND id IN ({})', [user_id])):
+            ids = [exercise_id for exercise_id, custom in keys if custom == is_custom]
+            if ids:
+                c.execute(query.format(', '.join('?' * len(ids))), params + ids)
+                found.update((row[0], is_custom) for row in c.fetchall())
+        missing = [api_id for key, api_id in keys.items() if key not in found]
+        if missing:
+            raise UnknownExerciseError(f'Unknown exercise {missing[0]}')
+
+    def add_template(self, user_id, name, exercises):
+        conn = self.connect_user_db(user_id)
+        c = conn.cursor()
+        try:
+            self._check_template_exercises(c, user_id, exercises)
+        except UnknownExerciseError:
+            conn.close()
+            raise
+        c.execute('INSERT INTO workout_templates (user_id, name, exercises) VALUES (?, ?, ?)',
+                  (user_id, name, json.dumps(exercises)))
+        template_id = c.lastrowid
+        self._count_volume(c, user_id, templates=1)
+        seq = self._log_change(c, user_id, 'template', template_id)
+        conn.commit()
+        conn.close()
+        return template_id, seq
+
+    def apply_template(self, user_id, template_id, date, prefill=False):
+        conn = self.connect_user_db(user_id)
+        c = conn.cursor()
+        c.execute('SELECT exercises FROM workout_templates WHERE id = ? AND user_id = ?',
+                  (template_id, user_id))
+        template = c.fetchone()
+        if not template:
+            conn.close()
+            return None
+
+        template_exercises = parse_template(template[0])
+        try:
+            self._check_template_exercises(c, user_id, template_exercises)
+        except UnknownExerciseError:
+            conn.close()
+            raise
+        last_sets = None
+        if prefill:
+            last = self._last_performance(c, user_id, [parse_exercise_id(ex['exercise_id'])
+                                                       for ex in template_exercises])
+            last_sets = {key: session['sets'] for key, session in last.items() if session}
+
+        c.execute('SELECT id FROM workouts WHERE user_id = ? AND date = ?', (user_id, date))
+        existing = c.fetchone()
+        workout_id = self._merge_workout(c, user_id, date, '', existing)
+        self._insert_exercises(c, user_id, date, workout_id, expand_template(template_exercises, last_sets))
+
+        seq = self._log_change(c, user_id, 'workout', workout_id)
+        conn.commit()
+        conn.close()
+        return workout_id, bool(existing), seq
+
+    def last_performance(self, user_id, exercise_keys):
+        conn = self.connect_user_db(user_id)
+        c = conn.cursor()
+        result = self._last_performance(c, user_id, exercise_keys)
+        conn.close()
+        return result
+
+    @staticmethod
+    def _last_performance(c, user_id, exercise_keys):
+        """One indexed lookup on last_performance for all keys, plus one query for row-stored sets"""
+        keys = list(dict.fromkeys(tuple(key) for key in exercise_keys))
+        result = dict.fromkeys(keys)
+        if not keys:
+            return result
+
+        # Plain IN lists let SQLite seek the (user_id, exercise_id, is_custom) index per pair;
+        # pairs that were not asked for are dropped below
+        exercise_ids = sorted({exercise_id for exercise_id, _ in keys})
+        c.execute(f'''SELECT lp.exercise_id, lp.is_custom, lp.date, we.id, we.workout_id, we.notes, we.set_data
+                      FROM last_performance lp
+                      JOIN workout_exercises we ON we.id = lp.workout_exercise_id
+                      WHERE lp.user_id = ? AND lp.exercise_id IN ({','.join('?' * len(exercise_ids))})
+                      AND lp.is_custom IN (0, 1)''',
+                  [user_id] + exercise_ids)
+
+        row_stored = {}
+        for exercise_id, is_custom, date, we_id, workout_id, notes, set_data in c.fetchall():
+            if (exercise_id, is_custom) not in result:
+                continue
+            session = {'date': date, 'workout_id': workout_id, 'notes': notes, 'sets': []}
+            if set_data is not None:
+                session['sets'] = unpack_sets(set_data, we_id)
+            else:
+                row_stored[we_id] = session
+            result[(exercise_id, is_custom)] = session
+
+        if row_stored:
+            c.execute(f'''SELECT * FROM workout_sets WHERE workout_exercise_id IN ({','.join('?' * len(row_stored))})
+                          ORDER BY set_number''', list(row_stored))
+            columns = [column[0] for column in c.description]
+            for row in c.fetchall():
+                set_row = dict(zip(columns, row))
+                row_stored[set_row['workout_exercise_id']]['sets'].append(set_row)
+        return result
+
+    # Volume and latency accounting
+    @staticmethod
+    def _read_volumes(conn, table, user_id=None):
+        """user_volume rows of one database, or attached schema, as {user_id: counts}"""
+        where = ' WHERE user_id = ?' if user_id is not None else ''
+        rows = conn.execute(f'SELECT user_id, {", ".join(VOLUME_COUNTERS)} FROM {table}{where}',
+                            () if user_id is None else (user_id,)).fetchall()
+        return {row[0]: dict(zip(VOLUME_COUNTERS, row[1:])) for row in rows}
+
+    def user_volume(self, user_id):
+        conn = self.connect_user_db(user_id)
+        volume = dict.fromkeys(VOLUME_COUNTERS, 0)
+        # Sharded: sessions are counted in setora.db, everything else in the shard
+        for table in ('main.user_volume', 'directory.user_volume') if self.shard_count else ('user_volume',):
+            for counter, rows in self._read_volumes(conn, table, user_id).get(user_id, {}).items():
+                volume[counter] += rows
+        conn.close()
+        return volume
+
+    def list_user_volumes(self):
+        volumes = {}
+        # Every shard file on disk, including ones left from an earlier shard count
+        for path in [self.db_path] + self.shard_files():
+            conn = sqlite3.connect(path)
+            try:
+                file_volumes = self._read_volumes(conn, 'user_volume')
+            except sqlite3.OperationalError:
+                # A shard file from before volume counters; open_shard upgrades it on first use
+                file_volumes = {}
+            conn.close()
+            for user_id, counts in file_volumes.items():
+                volume = volumes.setdefault(user_id, dict.fromkeys(VOLUME_COUNTERS, 0))
+                for counter, rows in counts.items():
+                    volume[counter] += rows
+        return volumes
+
+    def add_latency_samples(self, histograms):
+        conn = self.connect_db()
+        conn.executemany('''INSERT INTO request_latency (user_id, bucket, count) VALUES (?, ?, ?)
+                            ON CONFLICT(user_id, bucket) DO UPDATE SET count = count + excluded.count''',
+                         [(user_id, bucket, count)
+                          for user_id, histogram in histograms.items()
+                          for bucket, count in histogram.items()])
+        conn.commit()
+        conn.close()
+
+    def latency_histograms(self):
+        conn = self.connect_db()
+        histograms = defaultdict(dict)
+        for user_id, bucket, count in conn.execute('SELECT user_id, bucket, count FROM request_latency'):
+            histograms[user_id][bucket] = count
+        conn.close()
+        return dict(histograms)
+
+    # Background jobs
+    @staticmethod
+    def _job_dict(row, with_result=False):
+        job = {field: row[field] for field in JOB_FIELDS}
+        job['params'] = json.loads(job['params'])
+        if with_result:
+            job['result'] = json.loads(row['result']) if row['result'] is not None else None
+        return job
+
+    def create_job(self, user_id, kind, params, data_version, max_active=None, stale_before=None):
+        conn = self.connect_db()
+        c = conn.cursor()
+        # Count and insert under one write lock, so concurrent submissions cannot both pass the limit
+        c.execute('BEGIN IMMEDIATE')
+        if max_active is not None:
+            query = "SELECT COUNT(*) FROM jobs WHERE user_id = ? AND status IN ('queued', 'running')"
+            args = [user_id]
+            if stale_before is not None:
+                query += ' AND updated_at >= ?'
+                args.append(stale_before)
+            c.execute(query, args)
+            if c.fetchone()[0] >= max_active:
+                conn.rollback()
+                conn.close()
+                return None
+        c.execute('INSERT INTO jobs (user_id, kind, params, data_version) VALUES (?, ?, ?, ?)',
+                  (user_id, kind, json.dumps(params, sort_keys=True), data_version))
+        job_id = c.lastrowid
+        conn.commit()
+        conn.close()
+        return job_id
+
+    def get_job(self, job_id, user_id=None, with_result=False):
+        conn = self.connect_db()
+        conn.row_factory = sqlite3.Row
+        query = f'SELECT {", ".join(JOB_FIELDS)}{", result, result_file" if with_result else ""} FROM jobs WHERE id = ?'
+        params = [job_id]
+        if user_id is not None:
+            query += ' AND user_id = ?'
+            params.append(user_id)
+        row = conn.execute(query, params).fetchone()
+        conn.close()
+        if not row:
+            return None
+        job = self._job_dict(row, with_result)
+        if with_result and row['result_file'] is not None:
+            with open(os.path.join(self.result_dir, row['result_file']), encoding='utf-8') as f:
+                job['result'] = json.load(f)
+        return job
+
+    def list_jobs(self, user_id):
+        conn = self.connect_db()
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute(f'SELECT {", ".join(JOB_FIELDS)} FROM jobs WHERE user_id = ? ORDER BY id DESC',
+                            (user_id,)).fetchall()
+        conn.close()
+        return [self._job_dict(row) for row in rows]
+
+    def find_job(self, user_id, kind, params, data_version, now, stale_before):
+        conn = self.connect_db()
+        row = conn.execute('''SELECT id FROM jobs
+                              WHERE user_id = ? AND kind = ? AND params = ? AND data_version = ?
+                              AND ((status IN ('queued', 'running') AND updated_at >= ?)
+                                   OR (status = 'done' AND expires_at > ?))
+                              ORDER BY id DESC LIMIT 1''',
+                           (user_id, kind, json.dumps(params, sort_keys=True), data_version,
+                            stale_before, now)).fetchone()
+        conn.close()
+        return row[0] if row else None
+
+    def _update_job(self, job_id, status, assignments, params=()):
+        """UPDATE jobs SET ``assignments`` if the job is still in ``status``; return whether it was"""
+        conn = self.connect_db()
+        c = conn.cursor()
+        c.execute(f'UPDATE jobs SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = ? AND status = ?',
+                  (*params, job_id, status))
+        updated = c.rowcount == 1
+        conn.commit()
+        conn.close()
+        return updated
+
+    def start_job(self, job_id):
+        return self._update_job(job_id, 'queued', "status = 'running', started_at = CURRENT_TIMESTAMP")
+
+    def update_job_progress(self, job_id, progress):
+        return self._update_job(job_id, 'running', 'progress = ?', (progress,))
+
+    def finish_job(self, job_id, status, expires_at, result=None, error=None):
+        payload = json.dumps(result) if status == 'done' else None
+        result_file = None
+        if payload is not None and len(payload) > JOB_RESULT_INLINE_BYTES:
+            # A large export would bloat setora.db and hold its write lock while stored
+            os.makedirs(self.result_dir, exist_ok=True)
+            result_file = f'job-{job_id}.json'
+            path = os.path.join(self.result_dir, result_file)
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(payload)
+            os.replace(path + '.tmp', path)
+            payload = None
+        finished = self._update_job(job_id, 'running', '''status = ?, progress = MAX(progress, ?), result = ?,
+                                                         result_file = ?, error = ?,
+                                                         finished_at = CURRENT_TIMESTAMP, expires_at = ?''',
+                                    (status, 1.0 if status == 'done' else 0.0, payload, result_file,
+                                     error, expires_at))
+        if result_file and not finished:
+            self._remove_result_files([result_file])
+        return finished
+
+    def _remove_result_files(self, names):
+        for name in names:
+            try:
+                os.remove(os.path.join(self.result_dir, name))
+            except FileNotFoundError:
+                pass
+
+    def cancel_job(self, user_id, job_id, expires_at):
+        conn = self.connect_db()
+        c = conn.cursor()
+        c.execute('''UPDATE jobs SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP,
+                     updated_at = CURRENT_TIMESTAMP, expires_at = ?
+                     WHERE id = ? AND user_id = ? AND status IN ('queued', 'running')''',
+                  (expires_at, job_id, user_id))
+        cancelled = c.rowcount == 1
+        conn.commit()
+        conn.close()
+        return cancelled
+
+    def fail_job(self, job_id, expires_at, error):
+        conn = self.connect_db()
+        c = conn.cursor()
+        c.execute('''UPDATE jobs SET status = 'failed', error = ?, finished_at = CURRENT_TIMESTAMP,
+                     updated_at = CURRENT_TIMESTAMP, expires_at = ?
+                     WHERE id = ? AND status IN ('queued', 'running')''', (error, expires_at, job_id))
+        failed = c.rowcount == 1
+        conn.commit()
+        conn.close()
+        return failed
+
+    def touch_jobs(self, job_ids):
+        if not job_ids:
+            return
+        conn = self.connect_db()
+        conn.execute(f'''UPDATE jobs SET updated_at = CURRENT_TIMESTAMP
+                         WHERE id IN ({", ".join("?" * len(job_ids))}) AND status IN ('queued', 'running')''',
+                     list(job_ids))
+        conn.commit()
+        conn.close()
+
+    def evict_jobs(self, now, stale_before, expires_at):
+        conn = self.connect_db()
+        c = conn.cursor()
+        c.execute('SELECT result_file FROM jobs WHERE expires_at <= ? AND result_file IS NOT NULL', (now,))
+        result_files = [row[0] for row in c.fetchall()]
+        c.execute('DELETE FROM jobs WHERE expires_at <= ?', (now,))
+        deleted = c.rowcount
+        c.execute('''UPDATE jobs SET status = 'failed', error = 'worker lost', finished_at = CURRENT_TIMESTAMP,
+                     updated_at = CURRENT_TIMESTAMP, expires_at = ?
+                     WHERE status IN ('queued', 'running') AND updated_at < ?''', (expires_at, stale_before))
+        failed = c.rowcount
+        conn.commit()
+        conn.close()
+        # Only once the rows are gone, so no reader is left pointing at a missing file
+        self._remove_result_files(result_files)
+        return deleted, failed
+
+    # Sync
+    def sync_cursor(self, user_id):
+        conn = self.connect_user_db(user_id)
+        c = conn.cursor()
+        c.execute('SELECT compacted_seq FROM sync_state WHERE user_id = ?', (user_id,))
+        row = c.fetchone()
+        c.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log WHERE user_id = ?', (user_id,))
+        cursor = c.fetchone()[0]
+        conn.close()
+        return (row[0] if row else 0), cursor
+
+    def changes_since(self, user_id, since, cursor):
+        conn = self.connect_user_db(user_id)
+        c = conn.cursor()
+        c.execute('''SELECT entity, entity_id, op FROM change_log
+                     WHERE user_id = ? AND seq > ? AND seq <= ?
+                     ORDER BY seq''', (user_id, since, cursor))
+        changes = c.fetchall()
+        conn.close()
+        return changes
+
+    def change_events(self, user_id, since, cursor):
+        conn = self.connect_user_db(user_id)
+        c = conn.cursor()
+        c.execute('''SELECT seq, entity, entity_id, op FROM change_log
+                     WHERE user_id = ? AND seq > ? AND seq <= ?
+                     ORDER BY seq''', (user_id, since, cursor))
+        changes = c.fetchall()
+        conn.close()
+        return changes
+
+    def change_heads(self, positions):
+        positions = dict(positions)
+        heads = {}
+        # Plain connections: no directory lookup or ATTACH, seq is the primary key
+        for path in [self.db_path] + (self.shard_files() if self.shard_count else []):
+            conn = sqlite3.connect(path)
+            try:
+                if path not in positions:
+                    positions[path] = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log').fetchone()[0]
+                    continue
+                rows = conn.execute('SELECT user_id, MAX(seq) FROM change_log WHERE seq > ? GROUP BY user_id',
+                                    (positions[path],)).fetchall()
+            except sqlite3.OperationalError:
+                # A shard file created after this check; it is read from the next one
+                continue
+            finally:
+                conn.close()
+            for user_id, seq in rows:
+                heads[user_id] = max(heads.get(user_id, 0), seq)
+                positions[path] = max(positions[path], seq)
+        return positions, heads
+
+    def load_sync_entities(self, user_id, ids=None):
+        def scoped(query, entity):
+            if ids is None:
+                return query, [user_id]
+            wanted = ids.get(entity)
+            if not wanted:
+                return None, None
+            placeholders = ','.join('?' * len(wanted))
+            return f'{query} AND id IN ({placeholders})', [user_id] + list(wanted)
+
+        conn = self.connect_user_db(user_id)
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        result = {'workouts': [], 'weight_logs': [], 'templates': [], 'custom_exercises': []}
+
+        query, params = scoped('SELECT * FROM workouts WHERE user_id = ?', 'workout')
+        if query:
+            c.execute(query + ' ORDER BY date DESC', params)
+            result['workouts'] = [self._build_workout(c, row) for row in c.fetchall()]
+
+        query, params = scoped('SELECT id, date, weight FROM weight_logs WHERE user_id = ?', 'weight_log')
+        if query:
+            c.execute(query + ' ORDER BY date DESC', params)
+            result['weight_logs'] = [{'id': row[0], 'date': row[1], 'weight': row[2]}
+                                     for row in c.fetchall()]
+
+        query, params = scoped('SELECT id, name, exercises FROM workout_templates WHERE user_id = ?', 'template')
+        if query:
+            c.execute(query, params)
+            result['templates'] = [{'id': row[0], 'name': row[1], 'exercises': parse_template(row[2])}
+                                   for row in c.fetchall()]
+
+        query, params = scoped('''SELECT id, name, category, equipment, image_url
+                                  FROM user_exercises WHERE user_id = ?''', 'custom_exercise')
+        if query:
+            c.execute(query + ' ORDER BY category, name', params)
+            result['custom_exercises'] = [{'id': f'custom_{row[0]}', 'name': row[1], 'category': row[2],
+                                           'equipment': row[3], 'image_url': row[4], 'is_custom': True}
+                                          for row in c.fetchall()]
+
+        conn.close()
+        return result
+
+
+# In-memory engine
+class Record:
+    """Base for fixed-field records; subclasses list their fields in __slots__"""
+    __slots__ = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+class UserRecord(Record):
+    __slots__ = ('id', 'email', 'password_hash', 'name', 'age', 'gender', 'height', 'weight',
+                 'goal', 'unit_preference', 'theme_preference', 'created_at')
+
+class SessionRecord(Record):
+    __slots__ = ('id', 'user_id', 'token', 'created_at', 'expires_at')
+
+class ExerciseRecord(Record):
+    __slots__ = ('id', 'name', 'category', 'equipment')
+
+class CustomExerciseRecord(Record):
+    __slots__ = ('id', 'user_id', 'name', 'category', 'equipment', 'image_url', 'created_at')
+
+class WorkoutRecord(Record):
+    __slots__ = ('id', 'user_id', 'date', 'notes', 'is_rest_day', 'merged_at')
+
+class WorkoutExerciseRecord(Record):
+    __slots__ = ('id', 'workout_id', 'exercise_id', 'sets', 'reps', 'weight', 'duration',
+                 'notes', 'is_custom', 'order_index')
+
+class SetRecord(Record):
+    __slots__ = ('id', 'workout_exercise_id', 'set_number', 'reps', 'weight', 'duration', 'notes')
+
+class WeightRecord(Record):
+    __slots__ = ('id', 'user_id', 'date', 'weight')
+
+class TemplateRecord(Record):
+    __slots__ = ('id', 'user_id', 'name', 'exercises')
+
+class ChangeRecord(Record):
+    __slots__ = ('seq', 'user_id', 'entity', 'entity_id', 'op', 'created_at')
+
+class JobRecord(Record):
+    __slots__ = ('id', 'user_id', 'kind', 'params', 'data_version', 'status', 'progress', 'result', 'error',
+                 'created_at', 'started_at', 'updated_at', 'finished_at', 'expires_at')
+
+
+class MemoryStorage(Storage):
+    """Process-local engine on indexed dicts; mirrors SQLiteStorage's results"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._ids = defaultdict(lambda: itertools.count(1))
+
+        self._users = {}
+        self._users_by_email = {}
+        self._sessions = {}                          # token -> SessionRecord
+        self._exercises = {}
+        self._exercise_names = set()
+        self._custom = {}                            # id -> CustomExerciseRecord
+        self._custom_by_user = defaultdict(dict)     # user_id -> {name: CustomExerciseRecord}
+        self._workouts = {}
+        self._workouts_by_date = {}                  # (user_id, date) -> WorkoutRecord
+        self._workouts_by_user = defaultdict(list)   # user_id -> [WorkoutRecord]
+        self._workout_exercises = defaultdict(list)  # workout_id -> [WorkoutExerciseRecord]
+        self._sets = defaultdict(list)               # workout_exercise_id -> [SetRecord]
+        self._weights = defaultdict(list)            # user_id -> [WeightRecord]
+        self._templates = defaultdict(list)          # user_id -> [TemplateRecord]
+        self._changes = defaultdict(list)            # user_id -> [ChangeRecord]
+        self._compacted = {}                         # user_id -> compacted seq
+        self._uncompacted = defaultdict(int)         # user_id -> changes logged since the last compaction
+        self._last_performance = {}                  # (user_id, exercise_id, is_custom) -> (date, WorkoutExerciseRecord)
+        self._latency = defaultdict(lambda: defaultdict(int))  # user_id -> {bucket: requests}
+        self._jobs = {}                              # id -> JobRecord
+
+    def _next_id(self, table):
+        return next(self._ids[table])
+
+    # Schema
+    def init_schema(self):
+        # Like SQLiteStorage.rebuild_last_performance, for records loaded before this ran
+        with self._lock:
+            self._last_performance = {}
+            for workout in self._workouts.values():
+                for we in sorted(self._workout_exercises[workout.id], key=lambda we: we.order_index):
+                    if we.is_custom:
+                        exercise = self._custom.get(we.exercise_id)
+                        if exercise is None or exercise.user_id != workout.user_id:
+                            continue
+                    key = (workout.user_id, we.exercise_id, we.is_custom)
+                    last = self._last_performance.get(key)
+                    if last is None or workout.date >= last[0]:
+                        self._last_performance[key] = (workout.date, we)
+
+    def seed_exercises(self, exercises=DEFAULT_EXERCISES):
+        with self._lock:
+            if not self._exercises:
+                for name, category, equipment in exercises:
+                    self.add_exercise(name, category, equipment)
+
+    # Change log
+    def _log_change(self, user_id, entity, entity_id, op='upsert'):
+        seq = self._next_id('change_log')
+        self._changes[user_id].append(ChangeRecord(seq=seq, user_id=user_id, entity=entity,
+                                                   entity_id=entity_id, op=op, created_at=now_timestamp()))
+        self._uncompacted[user_id] += 1
+        if self._uncompacted[user_id] >= SYNC_COMPACT_EVERY:
+            self._compact_change_log(user_id)
+        return seq
+
+    def _compact_change_log(self, user_id):
+        latest = {}
+        for change in self._changes[user_id]:
+            latest[(change.entity, change.entity_id)] = change
+        changes = sorted(latest.values(), key=lambda change: change.seq)
+        if len(changes) > SYNC_LOG_RETENTION:
+            self._compacted[user_id] = changes[-SYNC_LOG_RETENTION - 1].seq
+            changes = changes[-SYNC_LOG_RETENTION:]
+        self._changes[user_id] = changes
+        self._uncompacted[user_id] = 0
+
+    # Users and sessions
+    @staticmethod
+    def _user_dict(user):
+        user = user.as_dict()
+        del user['password_hash'], user['created_at']
+        return user
+
+    def create_user(self, email, password_hash, name):
+        with self._lock:
+            if email in self._users_by_email:
+                raise DuplicateError('Email already exists')
+            user = UserRecord(id=self._next_id('users'), email=email, password_hash=password_hash,
+                              name=name, unit_preference='kg', theme_preference='light',
+                              created_at=now_timestamp())
+            self._users[user.id] = user
+            self._users_by_email[email] = user
+            return user.id
+
+    def find_user_by_credentials(self, email, password_hash):
+        user = self._users_by_email.get(email)
+        if user and user.password_hash == password_hash:
+            return self._user_dict(user)
+        return None
+
+    def update_user(self, user_id, data):
+        with self._lock:
+            user = self._users.get(user_id)
+            if user:
+                for field in USER_FIELDS:
+                    setattr(user, field, data.get(field))
+
+    def create_session(self, user_id, token, expires_at):
+        with self._lock:
+            if token in self._sessions:
+                raise DuplicateError('Session token already exists')
+            self._sessions[token] = SessionRecord(id=self._next_id('sessions'), user_id=user_id, token=token,
+                                                  created_at=now_timestamp(), expires_at=expires_at)
+
+    def get_user_by_token(self, token, now):
+        session = self._sessions.get(token)
+        if session and session.expires_at > now and session.user_id in self._users:
+            return self._user_dict(self._users[session.user_id])
+        return None
+
+    def is_session_valid(self, token, now):
+        session = self._sessions.get(token)
+        return session is not None and session.expires_at > now
+
+    def delete_session(self, token):
+        with self._lock:
+            self._sessions.pop(token, None)
+
+    # Exercises
+    def list_exercises(self):
+        with self._lock:
+            exercises = sorted(self._exercises.values(), key=lambda ex: (ex.category, ex.name))
+            return [ex.as_dict() for ex in exercises]
+
+    def add_exercise(self, name, category, equipment):
+        with self._lock:
+            if name in self._exercise_names:
+                raise DuplicateError('Exercise already exists')
+            exercise = ExerciseRecord(id=self._next_id('exercises'), name=name,
+                                      category=category, equipment=equipment)
+            self._exercises[exercise.id] = exercise
+            self._exercise_names.add(name)
+            return exercise.id
+
+    @staticmethod
+    def _custom_dict(ex):
+        return {'id': f'custom_{ex.id}', 'name': ex.name, 'category': ex.category,
+                'equipment': ex.equipment, 'image_url': ex.image_url, 'is_custom': True}
+
+    def list_custom_exercises(self, user_id):
+        with self._lock:
+            exercises = sorted(self._custom_by_user[user_id].values(), key=lambda ex: (ex.category, ex.name))
+            return [self._custom_dict(ex) for ex in exercises]
+
+    def add_custom_exercise(self, user_id, name, category, equipment, image_url):
+        with self._lock:
+            if name in self._custom_by_user[user_id]:
+                raise DuplicateError('You already have an exercise with this name')
+            exercise = CustomExerciseRecord(id=self._next_id('user_exercises'), user_id=user_id, name=name,
+                                            category=category, equipment=equipment, image_url=image_url,
+                                            created_at=now_timestamp())
+            self._custom[exercise.id] = exercise
+            self._custom_by_user[user_id][name] = exercise
+            return exercise.id, self._log_change(user_id, 'custom_exercise', exercise.id)
+
+    def delete_custom_exercise(self, user_id, exercise_id):
+        with self._lock:
+            exercise = self._custom.get(exercise_id)
+            if not exercise or exercise.user_id != user_id:
+                return None
+            del self._custom[exercise_id]
+            del self._custom_by_user[user_id][exercise.name]
+            self._last_performance.pop((user_id, exercise_id, 1), None)
+            return self._log_change(user_id, 'custom_exercise', exercise_id, 'delete')
+
+    # Workouts and sets
+    def save_workout(self, user_id, date, notes, exercises, is_rest_day=False):
+        with self._lock:
+            workout = self._workouts_by_date.get((user_id, date))
+            existing = workout is not None
+
+            if is_rest_day:
+                if workout:
+                    workout.is_rest_day = 1
+                    workout.notes = notes
+                else:
+                    workout = self._new_workout(user_id, date, notes, 1)
+                return workout.id, existing, self._log_change(user_id, 'workout', workout.id)
+
+            if workout:
+                workout.merged_at = datetime.now().isoformat()
+                workout.is_rest_day = 0
+            else:
+                workout = self._new_workout(user_id, date, notes, 0)
+
+            workout_exercises = self._workout_exercises[workout.id]
+            current_max_order = max((we.order_index for we in workout_exercises), default=0)
+
+            for idx, ex in enumerate(exercises):
+                exercise_id, is_custom = parse_exercise_id(ex['exercise_id'])
+                we = WorkoutExerciseRecord(id=self._next_id('workout_exercises'), workout_id=workout.id,
+                                           exercise_id=exercise_id, notes=ex.get('notes', ''),
+                                           is_custom=is_custom, order_index=current_max_order + idx + 1)
+                workout_exercises.append(we)
+                sets = ex.get('sets', [])
+                # Match SQLiteStorage: only sets kept as rows (see pack_sets) have ids
+                row_stored = pack_sets(sets) is None
+                self._sets[we.id] = [SetRecord(id=self._next_id('workout_sets') if row_stored else None,
+                                               workout_exercise_id=we.id,
+                                               set_number=set_data['set_number'], reps=set_data.get('reps'),
+                                               weight=real(set_data.get('weight')),
+                                               duration=real(set_data.get('duration')),
+                                               notes=set_data.get('notes', ''))
+                                     for set_data in sets]
+
+                last = self._last_performance.get((user_id, exercise_id, is_custom))
+                if last is None or date >= last[0]:
+                    self._last_performance[(user_id, exercise_id, is_custom)] = (date, we)
+
+            return workout.id, existing, self._log_change(user_id, 'workout', workout.id)
+
+    def _new_workout(self, user_id, date, notes, is_rest_day):
+        workout = WorkoutRecord(id=self._next_id('workouts'), user_id=user_id, date=date,
+                                notes=notes, is_rest_day=is_rest_day)
+        self._workouts[workout.id] = workout
+        self._workouts_by_date[(user_id, date)] = workout
+        self._workouts_by_user[user_id].append(workout)
+        return workout
+
+    def set_rest_day(self, user_id, date, is_rest):
+        with self._lock:
+            workout = self._workouts_by_date.get((user_id, date))
+            if workout:
+                workout.is_rest_day = 1 if is_rest else 0
+            else:
+                workout = self._new_workout(user_id, date, None, 1 if is_rest else 0)
+            return workout.id, self._log_change(user_id, 'workout', workout.id)
+
+    def _exercise_for(self, we, user_id):
+        """The library or custom exercise a workout exercise points at, like the SQL JOINs"""
+        if we.is_custom:
+            exercise = self._custom.get(we.exercise_id)
+            return exercise if exercise is not None and exercise.user_id == user_id else None
+        return self._exercises.get(we.exercise_id)
+
+    def _workout_exercise_dicts(self, workout, detailed, summary=False, columns=False):
+        """Exercises of a workout in the order SQLiteStorage returns them"""
+        builtin, custom = [], []
+        for we in sorted(self._workout_exercises[workout.id], key=lambda we: we.order_index):
+            exercise = self._exercise_for(we, workout.user_id)
+            if exercise is None:
+                continue
+            ex = we.as_dict()
+            ex['name'] = exercise.name
+            ex['category'] = exercise.category
+            if detailed:
+                ex['equipment'] = exercise.equipment
+            if we.is_custom:
+                if detailed:
+                    ex['image_url'] = exercise.image_url
+                ex['is_custom'] = True
+            if summary:
+                ex['sets'] = []
+                ex['set_count'] = len(self._sets[we.id])
+            elif columns:
+                ex['set_columns'] = set_columns([s.as_dict() for s in self._sets[we.id]])
+            else:
+                ex['sets'] = [s.as_dict() for s in sorted(self._sets[we.id], key=lambda s: s.set_number)]
+            (custom if we.is_custom else builtin).append(ex)
+        return builtin + custom
+
+    def get_workout_by_date(self, user_id, date):
+        with self._lock:
+            workout = self._workouts_by_date.get((user_id, date))
+            if not workout:
+                return None
+            workout_dict = workout.as_dict()
+            workout_dict['exercises'] = self._workout_exercise_dicts(workout, detailed=True)
+            return workout_dict
+
+    def _build_workout(self, workout, summary=False, columns=False):
+        workout_dict = workout.as_dict()
+        if workout.is_rest_day:
+            workout_dict['day_type'] = 'Rest Day'
+            workout_dict['exercises'] = []
+            return workout_dict
+        exercises = self._workout_exercise_dicts(workout, detailed=False, summary=summary, columns=columns)
+        workout_dict['exercises'] = exercises
+        workout_dict['day_type'] = day_type({ex['category'] for ex in exercises})
+        return workout_dict
+
+    def _user_workouts(self, user_id):
+        return sorted(self._workouts_by_user[user_id], key=lambda w: w.date, reverse=True)
+
+    def list_workouts(self, user_id, start_date=None, end_date=None, limit=None, summary=False, columns=False):
+        with self._lock:
+            workouts = [w for w in self._user_workouts(user_id)
+                        if (not start_date or w.date >= start_date) and (not end_date or w.date <= end_date)]
+            return [self._build_workout(w, summary, columns) for w in workouts[:limit]]
+
+    def get_progress(self, user_id):
+        with self._lock:
+            stats = {}
+            category_dates = defaultdict(set)
+            for workout in self._user_workouts(user_id):
+                if workout.is_rest_day:
+                    continue
+                for we in self._workout_exercises[workout.id]:
+                    exercise = self._exercise_for(we, user_id)
+                    category = exercise.category if exercise else None
+                    stat = stats.setdefault((workout.date, category), {'volume': None, 'exercises': set()})
+                    stat['exercises'].add(we.id)
+                    for s in self._sets[we.id]:
+                        if s.weight is not None and s.reps is not None:
+                            stat['volume'] = (stat['volume'] or 0) + s.weight * s.reps
+                    category_dates[category].add(workout.date)
+
+            workout_stats = [{'date': date, 'category': category, 'volume': stat['volume'],
+                              'exercise_count': len(stat['exercises'])}
+                             for (date, category), stat in sorted(stats.items(), key=lambda item: (item[0][0], item[0][1] is not None, item[0][1] or ''))]
+            # ORDER BY category: NULL first, like SQLite
+            category_freq = [{'category': category, 'frequency': len(dates)}
+                             for category, dates in sorted(category_dates.items(),
+                                                           key=lambda item: (item[0] is not None, item[0] or ''))]
+            return {
+                'workout_stats': workout_stats,
+                'category_frequency': category_freq
+            }
+
+    def last_performance(self, user_id, exercise_keys):
+        with self._lock:
+            result = {}
+            for key in exercise_keys:
+                last = self._last_performance.get((user_id,) + tuple(key))
+                if last is None:
+                    result[key] = None
+                    continue
+                date, we = last
+                result[key] = {'date': date, 'workout_id': we.workout_id, 'notes': we.notes,
+                               'sets': [s.as_dict() for s in sorted(self._sets[we.id], key=lambda s: s.set_number)]}
+            return result
+
+    # Weights
+    def add_weight(self, user_id, date, weight):
+        with self._lock:
+            log = WeightRecord(id=self._next_id('weight_logs'), user_id=user_id, date=date, weight=real(weight))
+            self._weights[user_id].append(log)
+            return log.id, self._log_change(user_id, 'weight_log', log.id)
+
+    def list_weights(self, user_id):
+        with self._lock:
+            logs = sorted(self._weights[user_id], key=lambda log: log.date, reverse=True)
+            return [{'id': log.id, 'date': log.date, 'weight': log.weight} for log in logs]
+
+    # Templates
+    def list_templates(self, user_id):
+        with self._lock:
+            return [{'id': t.id, 'name': t.name, 'exercises': copy.deepcopy(t.exercises)}
+                    for t in self._templates[user_id]]
+
+    def _exercise_exists(self, user_id, exercise_id, is_custom):
+        if is_custom:
+            exercise = self._custom.get(exercise_id)
+            return exercise is not None and exercise.user_id == user_id
+        return exercise_id in self._exercises
+
+    def _check_template_exercises(self, user_id, exercises):
+        missing = [api_id for key, api_id in template_exercise_keys(exercises).items()
+                   if not self._exercise_exists(user_id, *key)]
+        if missing:
+            raise UnknownExerciseError(f'Unknown exercise {missing[0]}')
+
+    def add_template(self, user_id, name, exercises):
+        with self._lock:
+            self._check_template_exercises(user_id, exercises)
+            template = TemplateRecord(id=self._next_id('workout_templates'), user_id=user_id,
+                                      name=name, exercises=copy.deepcopy(exercises))
+            self._templates[user_id].append(template)
+            return template.id, self._log_change(user_id, 'template', template.id)
+
+    def apply_template(self, user_id, template_id, date, prefill=False):
+        with self._lock:
+            template = next((t for t in self._templates[user_id] if t.id == template_id), None)
+            if template is None:
+                return None
+            self._check_template_exercises(user_id, template.exercises)
+            last_sets = None
+            if prefill:
+                last = self.last_performance(user_id, [parse_exercise_id(ex['exercise_id'])
+                                                       for ex in template.exercises])
+                last_sets = {key: session['sets'] for key, session in last.items() if session}
+            return self.save_workout(user_id, date, '', expand_template(template.exercises, last_sets))
+
+    # Volume and latency accounting
+    def user_volume(self, user_id):
+        with self._lock:
+            exercises = [we for w in self._workouts_by_user[user_id] for we in self._workout_exercises[w.id]]
+            # Like SQLiteStorage, only row-stored sets (see pack_sets) have ids
+            sets = [s for we in exercises for s in self._sets[we.id]]
+            return {'workouts': len(self._workouts_by_user[user_id]),
+                    'workout_exercises': len(exercises),
+                    'workout_sets': sum(1 for s in sets if s.id is not None),
+                    'packed_sets': sum(1 for s in sets if s.id is None),
+                    'weight_logs': len(self._weights[user_id]),
+                    'templates': len(self._templates[user_id]),
+                    'custom_exercises': len(self._custom_by_user[user_id]),
+                    'sessions': sum(1 for session in self._sessions.values() if session.user_id == user_id)}
+
+    def list_user_volumes(self):
+        with self._lock:
+            user_ids = (set(self._workouts_by_user) | set(self._weights) | set(self._templates)
+                        | set(self._custom_by_user) | {session.user_id for session in self._sessions.values()})
+            volumes = {user_id: self.user_volume(user_id) for user_id in user_ids}
+            return {user_id: volume for user_id, volume in volumes.items() if any(volume.values())}
+
+    def add_latency_samples(self, histograms):
+        with self._lock:
+            for user_id, histogram in histograms.items():
+                for bucket, count in histogram.items():
+                    self._latency[user_id][bucket] += count
+
+    def latency_histograms(self):
+        with self._lock:
+            return {user_id: dict(histogram) for user_id, histogram in self._latency.items()}
+
+    # Background jobs
+    def _job_dict(self, job, with_result=False):
+        result = {field: getattr(job, field) for field in JOB_FIELDS}
+        result['params'] = json.loads(job.params)
+        if with_result:
+            result['result'] = json.loads(job.result) if job.result is not None else None
+        return result
+
+    def create_job(self, user_id, kind, params, data_version, max_active=None, stale_before=None):
+        with self._lock:
+            if max_active is not None:
+                active = [job for job in self._jobs.values()
+                          if job.user_id == user_id and job.status in ('queued', 'running')
+                          and (stale_before is None or job.updated_at >= stale_before)]
+                if len(active) >= max_active:
+                    return None
+            now = now_timestamp()
+            job = JobRecord(id=self._next_id('jobs'), user_id=user_id, kind=kind,
+                            params=json.dumps(params, sort_keys=True), data_version=data_version,
+                            status='queued', progress=0.0, created_at=now, updated_at=now)
+            self._jobs[job.id] = job
+            return job.id
+
+    def get_job(self, job_id, user_id=None, with_result=False):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or (user_id is not None and job.user_id != user_id):
+                return None
+            return self._job_dict(job, with_result)
+
+    def list_jobs(self, user_id):
+        with self._lock:
+            return [self._job_dict(job) for job in sorted(self._jobs.values(), key=lambda job: -job.id)
+                    if job.user_id == user_id]
+
+    def find_job(self, user_id, kind, params, data_version, now, stale_before):
+        params = json.dumps(params, sort_keys=True)
+        with self._lock:
+            matches = [job.id for job in self._jobs.values()
+                       if (job.user_id, job.kind, job.params, job.data_version) == (user_id, kind, params, data_version)
+                       and ((job.status in ('queued', 'running') and job.updated_at >= stale_before)
+                            or (job.status == 'done' and job.expires_at > now))]
+            return max(matches) if matches else None
+
+    def _update_job(self, job_id, expected, **fields):
+        """Set ``fields`` on a job still in status ``expected``; return whether it was"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status != expected:
+                return False
+            for name, value in fields.items():
+                setattr(job, name, value)
+            job.updated_at = now_timestamp()
+            return True
+
+    def start_job(self, job_id):
+        return self._update_job(job_id, 'queued', status='running', started_at=now_timestamp())
+
+    def update_job_progress(self, job_id, progress):
+        return self._update_job(job_id, 'running', progress=progress)
+
+    def finish_job(self, job_id, status, expires_at, result=None, error=None):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status != 'running':
+                return False
+            job.status, job.error, job.expires_at = status, error, expires_at
+            job.result = json.dumps(result) if status == 'done' else None
+            if status == 'done':
+                job.progress = 1.0
+            job.finished_at = job.updated_at = now_timestamp()
+            return True
+
+    def cancel_job(self, user_id, job_id, expires_at):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.user_id != user_id or job.status not in ('queued', 'running'):
+                return False
+            job.status, job.expires_at = 'cancelled', expires_at
+            job.finished_at = job.updated_at = now_timestamp()
+            return True
+
+    def fail_job(self, job_id, expires_at, error):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status not in ('queued', 'running'):
+                return False
+            job.status, job.error, job.expires_at = 'failed', error, expires_at
+            job.finished_at = job.updated_at = now_timestamp()
+            return True
+
+    def touch_jobs(self, job_ids):
+        with self._lock:
+            now = now_timestamp()
+            for job_id in job_ids:
+                job = self._jobs.get(job_id)
+                if job is not None and job.status in ('queued', 'running'):
+                    job.updated_at = now
+
+    def evict_jobs(self, now, stale_before, expires_at):
+        with self._lock:
+            expired = [job.id for job in self._jobs.values() if job.expires_at is not None and job.expires_at <= now]
+            for job_id in expired:
+                del self._jobs[job_id]
+            stale = [job for job in self._jobs.values()
+                     if job.status in ('queued', 'running') and job.updated_at < stale_before]
+            for job in stale:
+                job.status, job.error, job.expires_at = 'failed', 'worker lost', expires_at
+                job.finished_at = job.updated_at = now_timestamp()
+            return len(expired), len(stale)
+
+    # Sync
+    def sync_cursor(self, user_id):
+        with self._lock:
+            changes = self._changes[user_id]
+            return self._compacted.get(user_id, 0), (changes[-1].seq if changes else 0)
+
+    def changes_since(self, user_id, since, cursor):
+        with self._lock:
+            return [(change.entity, change.entity_id, change.op)
+                    for change in self._changes[user_id] if since < change.seq <= cursor]
+
+    def change_events(self, user_id, since, cursor):
+        with self._lock:
+            return [(change.seq, change.entity, change.entity_id, change.op)
+                    for change in self._changes[user_id] if since < change.seq <= cursor]
+
+    def change_heads(self, positions):
+        with self._lock:
+            latest = {user_id: changes[-1].seq for user_id, changes in self._changes.items() if changes}
+        end = max(latest.values(), default=0)
+        if 'memory' not in positions:
+            return {'memory': end}, {}
+        since = positions['memory']
+        return {'memory': max(since, end)}, {user_id: seq for user_id, seq in latest.items() if seq > since}
+
+    def load_sync_entities(self, user_id, ids=None):
+        def wanted(entity, record_id):
+            return ids is None or record_id in (ids.get(entity) or ())
+
+        with self._lock:
+            return {
+                'workouts': [self._build_workout(w) for w in self._user_workouts(user_id)
+                             if wanted('workout', w.id)],
+                'weight_logs': [log for log in self.list_weights(user_id)
+                                if wanted('weight_log', log['id'])],
+                'templates': [t for t in self.list_templates(user_id)
+                              if wanted('template', t['id'])],
+                'custom_exercises': [ex for ex in self.list_custom_exercises(user_id)
+                                     if wanted('custom_exercise', int(ex['id'][len('custom_'):]))],
+            }
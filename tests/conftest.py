@@ -0,0 +1,20 @@
+import os
+import sys
+
+# The app picks its engine at import time; these tests run it on MemoryStorage
+os.environ.setdefault('SETORA_STORAGE', 'memory')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+from storage import MemoryStorage
+
+@pytest.fixture
+def store():
+    store = MemoryStorage()
+    store.ensure_schema()
+    return store
+
+@pytest.fixture
+def user_id(store):
+    return store.create_user('lifter@example.com', 'x', 'Lifter')
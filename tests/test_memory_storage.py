@@ -0,0 +1,202 @@
+import concurrent.futures
+import math
+import time
+import uuid
+
+import pytest
+
+import jobs
+import storage
+from ratelimit import TokenBuckets
+
+SETS = [{'set_number': 1, 'reps': 8, 'weight': 60.0}, {'set_number': 2, 'reps': 6, 'weight': 70.0}]
+
+# Sync compaction
+def test_compaction_counts_each_users_own_changes(store, user_id, monkeypatch):
+    monkeypatch.setattr(storage, 'SYNC_COMPACT_EVERY', 4)
+    monkeypatch.setattr(storage, 'SYNC_LOG_RETENTION', 2)
+    other = store.create_user('other@example.com', 'x', 'Other')
+
+    for day in range(1, 4):
+        store.add_weight(user_id, f'2024-01-0{day}', 80 + day)
+    # Another user's writes must not bring this user's compaction forward
+    for day in range(1, 10):
+        store.add_weight(other, f'2024-01-0{day}', 70)
+    assert store.sync_cursor(user_id)[0] == 0
+    assert len(store.change_events(user_id, 0, store.sync_cursor(user_id)[1])) == 3
+
+    store.add_weight(user_id, '2024-01-04', 84)
+    compacted, cursor = store.sync_cursor(user_id)
+    assert compacted > 0
+    assert len(store.change_events(user_id, 0, cursor)) == 2
+
+def test_sync_before_compacted_cursor_gets_snapshot(store, user_id, monkeypatch):
+    monkeypatch.setattr(storage, 'SYNC_COMPACT_EVERY', 3)
+    monkeypatch.setattr(storage, 'SYNC_LOG_RETENTION', 1)
+    first = store.sync(user_id, 0)['cursor']
+    for day in range(1, 4):
+        store.add_weight(user_id, f'2024-01-0{day}', 80)
+
+    payload = store.sync(user_id, max(first, 1))
+    assert payload['snapshot'] is True
+    assert len(payload['weight_logs']) == 3
+
+    delta = store.sync(user_id, payload['cursor'])
+    assert delta['snapshot'] is False
+    assert delta['weight_logs'] == []
+
+# Set packing
+def test_pack_round_trip():
+    sets = [{'set_number': 2, 'reps': 5, 'weight': 102.5, 'duration': None},
+            {'set_number': 1, 'reps': 8, 'weight': 60, 'duration': 30.0}]
+    blob = storage.pack_sets(sets)
+    assert len(blob) == 8 * len(storage.SET_COLUMNS) * len(sets)
+
+    unpacked = storage.unpack_sets(blob, 7)
+    assert [(s['set_number'], s['reps'], s['weight'], s['duration']) for s in unpacked] == [
+        (1, 8, 60.0, 30.0), (2, 5, 102.5, None)]
+    assert all(s['workout_exercise_id'] == 7 and s['notes'] == '' for s in unpacked)
+    assert isinstance(unpacked[0]['reps'], int)
+
+def test_nan_stands_for_null():
+    blob = storage.pack_sets([{'set_number': 1, 'reps': None, 'weight': 40},
+                              {'set_number': 2, 'reps': 10}])
+    set_numbers, reps, weights, durations = storage.unpack_set_columns(blob)
+    assert math.isnan(reps[0]) and math.isnan(weights[1])
+    assert all(math.isnan(d) for d in durations)
+    assert [(s['reps'], s['weight']) for s in storage.unpack_sets(blob, 1)] == [(None, 40.0), (10, None)]
+    # No set has both, so there is no volume rather than zero
+    assert storage.columns_volume(reps, weights) is None
+    assert math.isnan(storage.set_columns([{'set_number': 1, 'reps': 'ten'}])[1][0])
+
+def test_sets_that_need_rows_are_not_packed():
+    assert storage.pack_sets([{'set_number': 1, 'reps': 5, 'notes': 'easy'}]) is None
+    assert storage.pack_sets([{'set_number': 1, 'reps': '5'}]) is None
+    assert storage.pack_sets([{'set_number': 1, 'reps': True}]) is None
+
+# Token buckets
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_token_bucket_refills_and_throttles():
+    clock = Clock()
+    buckets = TokenBuckets(rate=1, burst=2, clock=clock)
+    assert buckets.take('a') == 0 and buckets.take('a') == 0
+    assert buckets.take('a') == pytest.approx(1.0)
+    clock.now = 1.0
+    assert buckets.take('a') == 0
+
+def test_token_bucket_evicts_least_recently_used():
+    clock = Clock()
+    buckets = TokenBuckets(rate=1, burst=1, max_keys=2, clock=clock)
+    buckets.take('a')
+    buckets.take('b')
+    buckets.take('a')  # throttled, but now the most recently used
+    buckets.take('c')
+    assert len(buckets) == 2
+    # 'a' was kept and is still empty; 'b' was evicted and starts full
+    assert buckets.take('a') > 0
+    assert buckets.take('b') == 0
+
+# Tier pagination
+@pytest.fixture
+def client(monkeypatch):
+    import app as setora
+
+    setora.ensure_storage()
+    monkeypatch.setattr(setora, 'VOLUME_SOFT_LIMITS', {'summarize': {'workouts': 5}, 'paginate': {'workouts': 2}})
+    monkeypatch.setattr(setora, 'WORKOUTS_PAGE_SIZE', 2)
+    client = setora.app.test_client()
+    response = client.post('/api/auth/signup', json={'email': f'{uuid.uuid4().hex}@example.com',
+                                                     'password': 'x', 'name': 'Pager'})
+    assert response.status_code == 200
+    return client
+
+def save_days(client, days):
+    for day in days:
+        response = client.post('/api/workouts', json={'date': f'2024-03-{day:02d}',
+                                                      'exercises': [{'exercise_id': 1, 'sets': SETS}]})
+        assert response.status_code == 200
+
+def test_small_accounts_get_every_workout(client):
+    save_days(client, (1, 2))
+    response = client.get('/api/workouts')
+    assert len(response.get_json()) == 2
+    assert 'X-Volume-Tier' not in response.headers
+    assert 'X-Next-End-Date' not in response.headers
+
+def test_paginate_tier_pages_from_next_end_date(client):
+    save_days(client, (1, 3, 5, 7))
+    first = client.get('/api/workouts')
+    assert first.headers['X-Volume-Tier'] == 'paginate'
+    assert [w['date'] for w in first.get_json()] == ['2024-03-07', '2024-03-05']
+    assert first.headers['X-Next-End-Date'] == '2024-03-04'
+    assert first.get_json()[0]['exercises'][0]['sets'][0]['reps'] == 8
+
+    second = client.get('/api/workouts', query_string={'end_date': first.headers['X-Next-End-Date']})
+    assert [w['date'] for w in second.get_json()] == ['2024-03-03', '2024-03-01']
+
+    last = client.get('/api/workouts', query_string={'end_date': '2024-03-02'})
+    assert [w['date'] for w in last.get_json()] == ['2024-03-01']
+    assert 'X-Next-End-Date' not in last.headers
+
+def test_summarize_tier_gives_set_counts(client):
+    save_days(client, range(1, 8))
+    response = client.get('/api/workouts')
+    assert response.headers['X-Volume-Tier'] == 'summarize'
+    exercise = response.get_json()[0]['exercises'][0]
+    assert exercise['sets'] == [] and exercise['set_count'] == 2
+
+# Job retry
+class BrokenPool:
+    """A pool whose worker died: every submission fails with BrokenExecutor"""
+
+    def __init__(self):
+        self.submitted = 0
+
+    def submit(self, *args):
+        self.submitted += 1
+        future = concurrent.futures.Future()
+        future.set_exception(concurrent.futures.BrokenExecutor('worker died'))
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+def wait_for_job(store, job_id, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = store.get_job(job_id)
+        if job['status'] not in ('queued', 'running'):
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f'job {job_id} still {job["status"]}')
+
+def test_job_fails_after_max_dispatches(store, user_id, monkeypatch):
+    queue = jobs.JobQueue(store, 1, 60, 600, processes=False)
+    pool = BrokenPool()
+    monkeypatch.setattr(queue, '_executor', lambda: pool)
+
+    job_id, reused = queue.submit(user_id, 'records', {})
+    job = wait_for_job(store, job_id)
+    assert not reused
+    assert pool.submitted == jobs.MAX_DISPATCHES
+    assert job['status'] == 'failed'
+    assert job['error'].startswith('worker lost')
+
+def test_job_moves_to_a_fresh_pool(store, user_id, monkeypatch):
+    store.save_workout(user_id, '2024-03-01', '', [{'exercise_id': 1, 'sets': SETS}])
+    queue = jobs.JobQueue(store, 1, 60, 600, processes=False)
+    executor = queue._executor
+    pools = [BrokenPool()]
+    monkeypatch.setattr(queue, '_executor', lambda: pools.pop() if pools else executor())
+
+    job_id, _ = queue.submit(user_id, 'records', {})
+    job = wait_for_job(store, job_id)
+    assert job['status'] == 'done'
+    record = store.get_job(job_id, with_result=True)['result']['records'][0]
+    assert record['heaviest']['value'] == 70.0
@@ -0,0 +1,103 @@
+"""Per-user latency and data volume accounting for the Setora API.
+
+``LatencyHistograms`` buckets request durations per user in memory and
+hands them over periodically to be added to storage, so percentiles
+cover every process and survive restarts. ``volume_totals`` and
+``volume_tier`` turn a user's row counters into a payload estimate and
+the soft-limit tier their responses are served with.
+"""
+import bisect
+import threading
+import time
+from collections import defaultdict
+
+# Bucket upper bounds in milliseconds; one more bucket holds anything slower
+LATENCY_BUCKETS_MS = (1, 2, 3, 5, 7, 10, 15, 20, 30, 50, 70, 100, 150, 200, 300,
+                      500, 700, 1000, 1500, 2000, 3000, 5000, 10000, 30000)
+
+# JSON bytes each row adds to a full GET /api/workouts response, measured on seeded accounts
+PAYLOAD_BYTES = {'workouts': 150, 'workout_exercises': 185, 'sets': 120}
+
+def latency_bucket(seconds):
+    return bisect.bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)
+
+def latency_percentiles(histogram, percentiles=(50, 95, 99)):
+    """
+    {'requests': n, 'p50_ms': bound, ...} from {bucket: requests}. Each
+    value is the upper bound of the bucket holding that percentile, or
+    None with no requests; the open last bucket reports the last bound.
+    """
+    total = sum(histogram.values())
+    result = {'requests': total}
+    for percentile in percentiles:
+        result[f'p{percentile}_ms'] = None
+        if not total:
+            continue
+        rank = total * percentile / 100
+        seen = 0
+        for bucket in sorted(histogram):
+            seen += histogram[bucket]
+            if seen >= rank:
+                result[f'p{percentile}_ms'] = LATENCY_BUCKETS_MS[min(bucket, len(LATENCY_BUCKETS_MS) - 1)]
+                break
+    return result
+
+def volume_totals(volume):
+    """Row counters plus total ``sets`` and the estimated ``payload_bytes`` of the full workout list"""
+    totals = dict(volume)
+    totals['sets'] = volume['workout_sets'] + volume['packed_sets']
+    totals['payload_bytes'] = sum(totals[counter] * size for counter, size in PAYLOAD_BYTES.items())
+    return totals
+
+def volume_tier(totals, soft_limits):
+    """
+    The first tier in ``soft_limits`` ({tier: {counter: limit}}) with any
+    counter over its limit, or None when the account is within all of them
+    """
+    for tier, limits in soft_limits.items():
+        if any(totals.get(counter, 0) > limit for counter, limit in limits.items()):
+            return tier
+    return None
+
+class LatencyHistograms:
+    """
+    Request latency per user, bucketed by LATENCY_BUCKETS_MS. ``take_due``
+    hands the accumulated counts to one caller every ``interval`` seconds
+    for writing to storage; ``merge`` puts them back if that write fails.
+    """
+
+    def __init__(self, interval, clock=time.monotonic):
+        self.interval = interval
+        self.clock = clock
+        self._histograms = defaultdict(lambda: defaultdict(int))  # user_id -> {bucket: requests}
+        self._taken = clock()
+        self._lock = threading.Lock()
+
+    def record(self, user_id, seconds):
+        bucket = latency_bucket(seconds)
+        with self._lock:
+            self._histograms[user_id][bucket] += 1
+
+    def take(self):
+        """Return and reset everything recorded so far"""
+        with self._lock:
+            histograms = {user_id: dict(histogram) for user_id, histogram in self._histograms.items()}
+            self._histograms.clear()
+            self._taken = self.clock()
+        return histograms
+
+    def take_due(self):
+        """``take()`` once ``interval`` seconds have passed since the last one, else None"""
+        if self.clock() - self._taken < self.interval:
+            return None
+        with self._lock:
+            if self.clock() - self._taken < self.interval:
+                return None
+            self._taken = self.clock()
+        return self.take()
+
+    def merge(self, histograms):
+        with self._lock:
+            for user_id, histogram in histograms.items():
+                for bucket, count in histogram.items():
+                    self._histograms[user_id][bucket] += count
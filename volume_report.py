@@ -0,0 +1,38 @@
+import argparse
+import json
+
+from app import LATENCY_FLUSH_SECONDS, VOLUME_REPORT_SORTS, VOLUME_SOFT_LIMITS, store, volume_report
+
+COLUMNS = ('user_id', 'tier', 'workouts', 'workout_exercises', 'sets', 'weight_logs', 'templates',
+           'custom_exercises', 'sessions', 'payload_bytes', 'requests', 'p50_ms', 'p95_ms', 'p99_ms')
+
+def print_report(report):
+    """One aligned row per user"""
+    rows = [[str('-' if row[column] is None else row[column]) for column in COLUMNS] for row in report]
+    widths = [max([len(column)] + [len(row[i]) for row in rows]) for i, column in enumerate(COLUMNS)]
+    print('  '.join(column.rjust(width) for column, width in zip(COLUMNS, widths)))
+    for row in rows:
+        print('  '.join(value.rjust(width) for value, width in zip(row, widths)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-user data volume, latency and soft-limit report')
+    parser.add_argument('--sort', choices=VOLUME_REPORT_SORTS, default='payload_bytes')
+    parser.add_argument('--limit', type=int, default=20, help='rows to show, 0 shows every user')
+    parser.add_argument('--heavy', action='store_true', help='only accounts over a soft limit')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args()
+
+    # The app no longer touches the database at import time
+    store.ensure_schema()
+
+    report = volume_report(None, args.sort)
+    if args.heavy:
+        report = [row for row in report if row['tier']]
+    report = report[:args.limit] if args.limit else report
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+        print(f"\nSoft limits (tier: counter > limit): {json.dumps(VOLUME_SOFT_LIMITS)}")
+        print(f"Latency includes what running app processes have flushed, at most {LATENCY_FLUSH_SECONDS}s behind.")